@@ -0,0 +1,409 @@
+#Chart Helper benchmarks
+#Runs whole commands (scanchart, updatechart, scancharts, and --version and writechart for start up time) against a local stand-in for ProgArchives
+#and the Spotify API, so a run never touches the network and two runs can be compared.
+#  python bench/bench.py run [-o results.json]        run every scenario and save the results
+#  python bench/bench.py compare old.json new.json     print the difference between two runs
+#  python bench/bench.py record LINK                   save real PA pages into bench/recorded for replay
+#Pages are built from the templates in bench/fixtures (copies of PA's layout) unless a recorded copy
+#of the exact page exists in bench/recorded, in which case that is served instead
+import os
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import argparse
+import itertools
+import tempfile
+import threading
+import subprocess
+import statistics
+import collections
+import http.server
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs, quote
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+RECORDED_DIR = os.path.join(BENCH_DIR, 'recorded')
+PA_HOST = '127.0.0.1' #PA and spotify get different host names so they keep separate rate limits
+SPOTIFY_HOST = 'localhost'
+FAST_RATE = (1000, 1000) #effectively unthrottled, so the numbers are about our code and not the limiter
+
+GENRES = ['Symphonic Prog', 'Progressive Metal', 'Canterbury Scene', 'Krautrock', 'RIO/Avant-Prog', 'Eclectic Prog',
+          'Jazz Rock/Fusion', 'Crossover Prog', 'Neo-Prog', 'Psychedelic/Space Rock', 'Zeuhl', 'Tech/Extreme Prog Metal']
+COUNTRIES = ['United Kingdom', 'Italy', 'Germany', 'France', 'United States', 'Sweden', 'Canada', 'Japan', 'Netherlands']
+FIRST = ['Amber', 'Black', 'Crimson', 'Dream', 'Echo', 'Gentle', 'Iron', 'Jade', 'King', 'Lunar', 'Magma', 'Night',
+         'Opal', 'Pale', 'Quiet', 'Rising', 'Silver', 'The', 'Umbra', 'Violet', 'White', 'Yellow', 'Zero']
+SECOND = ['Giant', 'Tower', 'Machine', 'Garden', 'Harvest', 'Mirror', 'Caravan', 'Orchestra', 'Circus', 'Lighthouse']
+WORDS = ['Close', 'Edge', 'Lamb', 'Court', 'Moon', 'Side', 'Red', 'Relayer', 'Thick', 'Brick', 'Foxtrot', 'Wind',
+         'Wuthering', 'Heights', 'Selling', 'England', 'Pound', 'Larks', 'Tongues', 'Aspic', 'Starless', 'Bible']
+
+#Synthetic catalogue: every album id maps to the same title, artist and page on every run
+def albumInfo(albumID):
+    rnd = random.Random(albumID)
+    artistID = albumID % 211 + 1
+    return {
+        'id' : albumID,
+        'title' : ' '.join(rnd.sample(WORDS, rnd.randint(1, 3))) + ' ' + str(albumID),
+        'artistID' : artistID,
+        'artist' : artistName(artistID),
+        'genre' : GENRES[artistID % len(GENRES)],
+        'styleID' : artistID % len(GENRES) + 1,
+        'year' : 1967 + albumID % 50,
+        'tracks' : rnd.randint(4, 12),
+    }
+def artistName(artistID):
+    return "{a} {b}".format(a=FIRST[artistID % len(FIRST)], b=SECOND[(artistID // len(FIRST)) % len(SECOND)]) + (" " + str(artistID) if artistID > len(FIRST) * len(SECOND) else "")
+#A chart's albums for a given week. Each week about a tenth of the chart is replaced and a few ranks swap
+def chartIDs(name, size, week, pool):
+    rnd = random.Random(zlib.crc32(name.encode()))
+    ids = rnd.sample(range(1, pool + 1), min(pool, size * 2))
+    spare = ids[size:]
+    ids = ids[:size]
+    for w in range(1, week):
+        for i in range(size // 10):
+            if spare:
+                ids[rnd.randrange(size)] = spare.pop()
+        for i in range(size // 20):
+            x, y = rnd.randrange(size), rnd.randrange(size)
+            ids[x], ids[y] = ids[y], ids[x]
+    return ids
+
+class Fixtures:
+    def __init__(self, size, pool):
+        self.size = size
+        self.pool = pool
+        self.week = 1
+        self.templates = {}
+        for name in ('chart', 'chartrow', 'album', 'artist'):
+            with open(os.path.join(FIXTURE_DIR, name + '.html'), 'r', encoding='utf-8') as f:
+                self.templates[name] = f.read()
+    def chart(self, name):
+        rows = []
+        for rank, albumID in enumerate(chartIDs(name, self.size, self.week, self.pool), 1):
+            info = albumInfo(albumID)
+            rating = 4.6 - rank / (self.size * 2)
+            rows.append(self.templates['chartrow'].format(rank=rank, rating="{r:.2f}".format(r=rating), noRatings=2000 - rank * 7 % 1900,
+                                                          qwr="{q:.2f}".format(q=rating - 0.1), **info))
+        return self.templates['chart'].format(rows=''.join(rows))
+    def album(self, albumID):
+        info = albumInfo(albumID)
+        rnd = random.Random(albumID)
+        lengths = [rnd.randint(150, 1200) for i in range(info['tracks'])]
+        tracks = '<br/>'.join("{n}. Track {n} ({m}:{s:02d})".format(n=n, m=t // 60, s=t % 60) for n, t in enumerate(lengths, 1))
+        total = sum(lengths)
+        return self.templates['album'].format(tracklist=tracks, total="{m}:{s:02d}".format(m=total // 60, s=total % 60),
+                                              rating="{r:.2f}".format(r=3 + rnd.random() * 1.6), noRatings=rnd.randint(20, 3000), **info)
+    def artist(self, artistID):
+        return self.templates['artist'].format(artist=artistName(artistID), genre=GENRES[artistID % len(GENRES)],
+                                               country=COUNTRIES[artistID % len(COUNTRIES)])
+
+#Stand-in for both servers. Counts every request by path so runs can be compared request for request
+class BenchServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    def __init__(self, fixtures, latency):
+        super().__init__((PA_HOST, 0), BenchHandler)
+        self.fixtures = fixtures
+        self.latency = latency
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+    def count(self, path):
+        with self.lock:
+            self.counts[path] += 1
+    def takeCounts(self):
+        with self.lock:
+            counts = dict(self.counts)
+            self.counts.clear()
+        return counts
+
+class BenchHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+    def reply(self, body, contentType):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    def do_POST(self): #spotipy's client credentials token request
+        self.server.count('/api/token')
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply(json.dumps({'access_token' : 'bench', 'token_type' : 'Bearer', 'expires_in' : 3600}), 'application/json')
+    def do_GET(self):
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        self.server.count(url.path)
+        recorded = recordedPath(self.path)
+        fixtures = self.server.fixtures
+        if os.path.isfile(recorded):
+            with open(recorded, 'r', encoding='utf-8') as f:
+                self.reply(f.read(), 'text/html')
+        elif url.path == '/v1/search':
+            #roughly a quarter of all queries come back empty, so every search pass gets exercised
+            hit = zlib.crc32(query['q'][0].encode()) % 4 != 0
+            items = [{'external_urls' : {'spotify' : 'https://open.spotify.com/album/' + str(zlib.crc32(query['q'][0].encode()))}}] if hit else []
+            self.reply(json.dumps({'albums' : {'total' : len(items), 'items' : items}}), 'application/json')
+        elif url.path == '/chart.asp':
+            self.reply(fixtures.chart(query['c'][0]), 'text/html')
+        elif url.path == '/album.asp':
+            self.reply(fixtures.album(int(query['id'][0])), 'text/html')
+        elif url.path == '/artist.asp':
+            self.reply(fixtures.artist(int(query['id'][0])), 'text/html')
+        else:
+            self.send_response(404)
+            self.end_headers()
+
+def recordedPath(path):
+    return os.path.join(RECORDED_DIR, quote(path.lstrip('/'), safe='') + '.html')
+
+#Scenarios are lists of steps. 'setup' and 'timed' steps run a main.py command in its own process
+#(like a user would), 'week' moves every synthetic chart on by a week. The full/incremental update pair
+#and scancharts-update skip the page and spotify caches, which would otherwise hide what they measure
+def chartLink(base, name):
+    return "{b}chart.asp?c={n}".format(b=base, n=quote(name))
+def scenarios(base, charts):
+    first = charts[0]
+    return {
+        'scanchart' : [('timed', ['scanchart', first, chartLink(base, first), 'A', 'B', '-w', 'bench.xlsx'])],
+        'updatechart' : [('setup', ['scanchart', first, chartLink(base, first), 'A', 'B', '-w', 'bench.xlsx']),
+                         ('week', 2),
+                         ('timed', ['updatechart', first, 'A', 'B', '-w', 'bench.xlsx'])],
+        'updatechart-full' : [('setup', ['scanchart', first, chartLink(base, first), 'A', 'B', '-w', 'bench.xlsx']),
+                              ('week', 2),
+                              ('timed', ['--no-cache', 'updatechart', first, 'A', 'B', '--update-spotify', '--update-duration', '-w', 'bench.xlsx'])],
+        'updatechart-incremental' : [('setup', ['scanchart', first, chartLink(base, first), 'A', 'B', '-w', 'bench.xlsx']),
+                                     ('week', 2),
+                                     ('timed', ['--no-cache', 'updatechart', first, 'A', 'B', '--incremental', '-w', 'bench.xlsx'])],
+        'version' : [('timed', ['--version'])],
+        'writechart' : [('setup', ['scanchart', first, chartLink(base, first), 'A', 'B']),
+                        ('timed', ['writechart', first, 'A', 'B', 'bench.xlsx'])],
+        'scancharts' : [('chartfile', charts),
+                        ('timed', ['scancharts', 'charts.txt', 'A', 'B', '-w', 'bench.xlsx'])],
+        'scancharts-update' : [('chartfile', charts),
+                               ('timed', ['--no-cache', 'scancharts', 'charts.txt', 'A', 'B', '-us', '-ud', '-w', 'bench.xlsx'])],
+    }
+
+#Everything a command needs to run on its own: settings.ini and a music library where every 4th album is on disk
+def makeWorkdir(pool):
+    workdir = tempfile.mkdtemp(prefix='chartbench')
+    library = os.path.join(workdir, 'library')
+    os.mkdir(library)
+    for albumID in range(4, pool + 1, 4):
+        info = albumInfo(albumID)
+        os.makedirs(os.path.join(library, info['artist'][0], info['artist'], info['title']), exist_ok=True)
+    with open(os.path.join(workdir, 'settings.ini'), 'w') as f:
+        f.write("[settings]\nSPOTIPY_CLIENT_ID=bench\nSPOTIPY_CLIENT_SECRET=bench\nLIBRARY_DIR={l}/\nCHARTLIB=chartLib.pkl\nALBUMLIB=albumLib.pkl\nARTISTLIB=artistLib.pkl".format(l=library))
+    return workdir
+
+def runStep(args, workdir, command):
+    resultFile = os.path.join(workdir, 'step.json')
+    cmd = [sys.executable, os.path.abspath(__file__), 'step', '--port', str(args.port), '--result', resultFile]
+    if args.real_rates:
+        cmd.append('--real-rates')
+    if args.tracemalloc:
+        cmd.append('--tracemalloc')
+    env = dict(os.environ, SPOTIPY_CLIENT_ID='bench', SPOTIPY_CLIENT_SECRET='bench')
+    start = time.perf_counter()
+    proc = subprocess.run(cmd + ['--'] + command, cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    wall = time.perf_counter() - start
+    if proc.returncode != 0 or not os.path.isfile(resultFile):
+        sys.stderr.write(proc.stderr[-2000:])
+        raise RuntimeError("{c} exited with {r}".format(c=' '.join(command), r=proc.returncode))
+    with open(resultFile, 'r') as f:
+        result = json.load(f)
+    os.remove(resultFile)
+    result['wall'] = wall
+    return result
+
+def runScenario(args, server, steps):
+    workdir = makeWorkdir(server.fixtures.pool)
+    server.fixtures.week = 1
+    result = None
+    try:
+        for kind, value in steps:
+            if kind == 'week':
+                server.fixtures.week = value
+            elif kind == 'chartfile':
+                with open(os.path.join(workdir, 'charts.txt'), 'w') as f:
+                    f.write('\n'.join("{n}::{l}".format(n=name, l=chartLink(args.base, name)) for name in value) + '\n')
+            else:
+                server.takeCounts()
+                stepResult = runStep(args, workdir, value)
+                counts = server.takeCounts()
+                if kind == 'timed':
+                    stepResult['requests'] = counts
+                    result = stepResult
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+def gitRevision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+def run(args):
+    fixtures = Fixtures(args.albums, args.albums * 3)
+    server = BenchServer(fixtures, args.latency / 1000)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    args.port = server.server_address[1]
+    args.base = "http://{h}:{p}/".format(h=PA_HOST, p=args.port)
+    charts = ["Bench Chart {n}".format(n=n) for n in range(1, args.charts + 1)]
+    results = {
+        'meta' : {'date' : datetime.now().isoformat(timespec='seconds'), 'revision' : gitRevision(), 'python' : sys.version.split()[0],
+                  'albums' : args.albums, 'charts' : args.charts, 'latency_ms' : args.latency, 'repeat' : args.repeat,
+                  'real_rates' : args.real_rates},
+        'scenarios' : {},
+    }
+    allScenarios = scenarios(args.base, charts)
+    for name in args.scenario or allScenarios.keys():
+        runs = []
+        for i in range(args.repeat):
+            runs.append(runScenario(args, server, allScenarios[name]))
+            print("{n} run {i}: {w:.2f}s".format(n=name, i=i + 1, w=runs[-1]['wall']))
+        summary = {
+            'wall' : statistics.median(r['wall'] for r in runs),
+            'command' : statistics.median(r['command'] for r in runs),
+            'import' : statistics.median(r['import'] for r in runs),
+            'maxrss_kb' : max(r['maxrss_kb'] for r in runs),
+            'requests' : runs[-1]['requests'],
+            'runs' : [r['wall'] for r in runs],
+        }
+        if args.tracemalloc:
+            summary['tracemalloc_peak_kb'] = max(r['tracemalloc_peak_kb'] for r in runs)
+        results['scenarios'][name] = summary
+    server.shutdown()
+    printResults(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to {o}".format(o=args.output))
+
+def printResults(results):
+    print("{s:<24}{w:>10}{c:>10}{i:>10}{m:>12}{r:>10}".format(s='scenario', w='wall s', c='cmd s', i='import s', m='maxrss MB', r='requests'))
+    for name, s in results['scenarios'].items():
+        print("{s:<24}{w:>10.2f}{c:>10.2f}{i:>10.3f}{m:>12.1f}{r:>10}".format(s=name, w=s['wall'], c=s['command'], i=s['import'],
+                                                                         m=s['maxrss_kb'] / 1024, r=sum(s['requests'].values())))
+
+def compare(args):
+    with open(args.old, 'r') as f:
+        old = json.load(f)
+    with open(args.new, 'r') as f:
+        new = json.load(f)
+    for key in ('albums', 'charts', 'latency_ms', 'real_rates'):
+        if old['meta'].get(key) != new['meta'].get(key):
+            print("WARNING: runs used different {k} ({o} vs {n})".format(k=key, o=old['meta'].get(key), n=new['meta'].get(key)))
+    print("{s:<24}{m:<12}{o:>12}{n:>12}{d:>10}".format(s='scenario', m='metric', o=old['meta'].get('revision') or 'old',
+                                                      n=new['meta'].get('revision') or 'new', d='change'))
+    for name in old['scenarios'].keys():
+        if name not in new['scenarios'].keys():
+            continue
+        o = old['scenarios'][name]
+        n = new['scenarios'][name]
+        rows = [('wall s', o['wall'], n['wall']), ('cmd s', o['command'], n['command'])]
+        if 'import' in o.keys() and 'import' in n.keys(): #runs from before import times were recorded
+            rows.append(('import s', o['import'], n['import']))
+        rows.append(('maxrss MB', o['maxrss_kb'] / 1024, n['maxrss_kb'] / 1024))
+        for path in sorted(set(o['requests'].keys()) | set(n['requests'].keys())):
+            rows.append((path, o['requests'].get(path, 0), n['requests'].get(path, 0)))
+        for metric, ov, nv in rows:
+            change = "{c:+.1f}%".format(c=(nv - ov) / ov * 100) if ov else ''
+            print("{s:<24}{m:<12}{o:>12.2f}{n:>12.2f}{d:>10}".format(s=name, m=metric, o=ov, n=nv, d=change))
+
+#Runs inside the scenario's working directory: point main.py at the bench server and time one command
+def step(args):
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+    import resource
+    sys.path.insert(0, REPO_DIR)
+    start = time.perf_counter()
+    import main
+    imported = time.perf_counter() - start
+    main.PA_BASE = "http://{h}:{p}/".format(h=PA_HOST, p=args.port)
+    main.SPOTIFY_API = "http://{h}:{p}/v1/".format(h=SPOTIFY_HOST, p=args.port)
+    main.SPOTIFY_HOST = SPOTIFY_HOST
+    main.SPOTIFY_TOKEN_URL = "http://{h}:{p}/api/token".format(h=SPOTIFY_HOST, p=args.port)
+    if args.real_rates:
+        main.HOST_RATES[PA_HOST] = main.HOST_RATES['www.progarchives.com']
+        main.HOST_RATES[SPOTIFY_HOST] = main.HOST_RATES['api.spotify.com']
+    else:
+        main.HOST_RATES[PA_HOST] = FAST_RATE
+        main.HOST_RATES[SPOTIFY_HOST] = FAST_RATE
+    sys.argv = ['main.py'] + args.argv
+    start = time.perf_counter()
+    try:
+        code = main.main()
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+    else:
+        if code not in (None, 0): #a failed command returns its code rather than exiting
+            sys.exit(code)
+    result = {'command' : time.perf_counter() - start, 'import' : imported, 'maxrss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+    if args.tracemalloc:
+        result['tracemalloc_peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+    with open(args.result, 'w') as f:
+        json.dump(result, f)
+
+#Saves a real chart page and the album and artist pages it links to, politely, for the server to replay
+def record(args):
+    import requests
+    sys.path.insert(0, REPO_DIR)
+    import main
+    os.makedirs(RECORDED_DIR, exist_ok=True)
+    def save(link):
+        url = urlsplit(link)
+        path = url.path + ('?' + url.query if url.query else '')
+        res = requests.get(link)
+        res.raise_for_status()
+        with open(recordedPath(path), 'w', encoding='utf-8') as f:
+            f.write(res.text)
+        time.sleep(1)
+        return res.content
+    content = save(args.link[0])
+    rows = list(itertools.islice(main.iterChartRows(content), args.limit))
+    for row in rows:
+        save(row['albumLink'])
+        save(row['artistLink'])
+    print("Recorded {n} albums from {l}".format(n=len(rows), l=args.link[0]))
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description="Offline Chart Helper benchmarks")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    parser_run = subparsers.add_parser('run')
+    parser_run.add_argument('--output', '-o', action='store', help='Save results to this JSON file')
+    parser_run.add_argument('--albums', '-a', action='store', type=int, default=100, help='Albums per chart')
+    parser_run.add_argument('--charts', '-c', action='store', type=int, default=3, help='Charts in the scancharts scenario')
+    parser_run.add_argument('--repeat', '-r', action='store', type=int, default=3, help='Runs per scenario (the median is reported)')
+    parser_run.add_argument('--latency', action='store', type=float, default=20, help='Milliseconds the server waits before every reply')
+    parser_run.add_argument('--real-rates', action='store_true', help="Use main.py's real rate limits instead of none")
+    parser_run.add_argument('--tracemalloc', action='store_true', help='Also record the tracemalloc peak (slows every run down)')
+    parser_run.add_argument('--scenario', '-s', action='append', choices=['version', 'writechart', 'scanchart', 'updatechart', 'updatechart-full', 'updatechart-incremental', 'scancharts', 'scancharts-update'], help='Only run these scenarios')
+    parser_compare = subparsers.add_parser('compare')
+    parser_compare.add_argument('old', action='store')
+    parser_compare.add_argument('new', action='store')
+    parser_record = subparsers.add_parser('record')
+    parser_record.add_argument('link', nargs=1, action='store', help='ProgArchives chart link')
+    parser_record.add_argument('--limit', action='store', type=int, default=25, help='Albums to record from the chart')
+    parser_step = subparsers.add_parser('step')
+    parser_step.add_argument('--port', action='store', type=int, required=True)
+    parser_step.add_argument('--result', action='store', required=True)
+    parser_step.add_argument('--real-rates', action='store_true')
+    parser_step.add_argument('--tracemalloc', action='store_true')
+    parser_step.add_argument('argv', nargs=argparse.REMAINDER, help='main.py command line')
+    args = parser.parse_args()
+    if args.action == 'step' and args.argv and args.argv[0] == '--':
+        args.argv = args.argv[1:]
+    return args
+
+if __name__ == '__main__':
+    args = parseArgs()
+    {'run' : run, 'compare' : compare, 'record' : record, 'step' : step}[args.action](args)
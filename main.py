@@ -1,72 +1,513 @@
-from datetime import date
-from decouple import config
-from lxml import html
+from datetime import date, datetime
 from time import sleep
-from openpyxl import Workbook
-from openpyxl import load_workbook
-from openpyxl.styles import PatternFill, Border, Side, Alignment, Protection, Font
-from openpyxl.worksheet.dimensions import ColumnDimension, DimensionHolder
-from openpyxl.utils import get_column_letter
-from openpyxl.formatting.rule import FormulaRule
-from openpyxl.formatting import Rule
-from openpyxl.styles.differential import DifferentialStyle
+from xml.etree import ElementTree
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+from urllib.parse import urlsplit
+from array import array
 import os
 import re
+import shutil
+import gzip
+import json
+import importlib.util
+import csv
+import io
+import atexit
+import hashlib
+import time
+import threading
 import pickle
-import requests
-import spotipy
+import sqlite3
+import copy
+import itertools
+import functools
+import contextlib
+import math
+import zipfile
+import posixpath
 import argparse
-import tqdm
 import sys
 import logging
-from spotipy.oauth2 import SpotifyClientCredentials
+import logging.handlers
+import queue
+#lxml, openpyxl, requests, spotipy, decouple and tqdm are imported by the functions that use them.
+#Between them they're most of a cold start, and plenty of commands (--version, setup, writechart
+#from the library) never touch half of them
 
 
 albumLib = {} #IMPORTANT. Contains a KV pair of album ids (defined by PA) and album objects
 chartLib = {}
+artistLib = {} #KV pair of artist ids (also defined by PA) and artist objects
 class TqdmLoggingHandler(logging.StreamHandler):
     def __init__(self):
         logging.StreamHandler.__init__(self)
 
     def emit(self, record):
         msg = self.format(record)
-        tqdm.tqdm.write(msg)
+        bars = sys.modules.get('tqdm')
+        if bars is None: #nothing has made a progress bar yet, so there's nothing to write around
+            sys.stdout.write(msg + '\n')
+        else:
+            bars.tqdm.write(msg)
+#Logging goes through a queue: the fetch and chart threads only drop records on it and a background
+#listener does the formatting and writing, so a slow terminal or disk never holds up a row. The logger's
+#own level follows the most verbose handler, so a disabled debug call costs next to nothing
+LOG_FILE = 'charthelper.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024 #rotate the log file past this size
+LOG_BACKUPS = 3 #charthelper.log.1 ... .3, the previous run is always .1
+LOG_LEVELS = {'debug' : logging.DEBUG, 'info' : logging.INFO, 'warning' : logging.WARNING, 'error' : logging.ERROR}
 log = logging.getLogger(__name__)
-
-log.setLevel(logging.DEBUG)
-filehandler = logging.FileHandler('charthelper.log', 'w')
-filehandler.setLevel(logging.DEBUG)
-fileformatter = logging.Formatter('%(name)s | %(asctime)s | %(levelname)s | %(funcName)s | %(message)s', '%Y-%m-%d %H:%M:%S')
-filehandler.setFormatter(fileformatter)
+log.propagate = False
 tqdmhandler = TqdmLoggingHandler()
 formatter = logging.Formatter('%(levelname)s | %(funcName)s: %(message)s')
 tqdmhandler.setFormatter(formatter)
-log.addHandler(filehandler)
-log.addHandler(tqdmhandler)
-termsize = int(os.get_terminal_size()[0])
+tqdmhandler.setLevel(logging.WARNING)
+logQueue = queue.SimpleQueue()
+logListener = logging.handlers.QueueListener(logQueue, tqdmhandler, respect_handler_level=True)
+log.addHandler(logging.handlers.QueueHandler(logQueue))
+log.setLevel(logging.WARNING)
+logListener.start()
+atexit.register(logListener.stop) #registered first so it runs last, after everything else that logs on the way out
+#Starts the log file for this run. The last run's log is rotated out to .1 rather than overwritten
+def openLogFile(filename=LOG_FILE, level=logging.INFO):
+    filehandler = logging.handlers.RotatingFileHandler(filename, 'a', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, delay=True)
+    if os.path.isfile(filename) and os.path.getsize(filename) > 0:
+        filehandler.doRollover()
+    filehandler.setLevel(level)
+    fileformatter = logging.Formatter('%(name)s | %(asctime)s | %(levelname)s | %(funcName)s | %(message)s', '%Y-%m-%d %H:%M:%S')
+    filehandler.setFormatter(fileformatter)
+    logListener.handlers = logListener.handlers + (filehandler,)
+    gateLogging()
+    return filehandler
+#Call after changing any handler's level
+def gateLogging():
+    log.setLevel(min(handler.level for handler in logListener.handlers))
+def setVerbosity(a): #what the --verbose and --debug flags let through to the screen
+    if a.verbose:
+        tqdmhandler.setLevel(logging.INFO)
+    elif a.debug:
+        tqdmhandler.setLevel(logging.DEBUG)
+    else:
+        tqdmhandler.setLevel(logging.WARNING)
+    gateLogging()
+def drainLog(): #blocks until everything logged so far has been written
+    logListener.stop()
+    logListener.start()
+termsize = shutil.get_terminal_size().columns #falls back to 80 columns when there is no terminal
+#Progress bars. tqdm only gets imported once something actually wants a bar
+def progress(*args, **kwargs):
+    import tqdm
+    return tqdm.tqdm(*args, **kwargs)
+
+PA_BASE = "http://www.progarchives.com/"
+SPOTIFY_API = "https://api.spotify.com/v1/"
+SPOTIFY_HOST = urlsplit(SPOTIFY_API).hostname
+FETCH_WORKERS = 8
+#(requests per second, burst) allowed for each host. Anything not listed here gets DEFAULT_RATE
+#PA is slow and old, so keep it polite. This replaces the old sleep(1) between every row
+HOST_RATES = {'www.progarchives.com' : (1.5, 3), SPOTIFY_HOST : (5, 5)}
+DEFAULT_RATE = (1, 1)
+albumIdRE = re.compile(r"(?<=\?id\=).*")
+yearRE = re.compile(r"\d{4}")
+qwrRE = re.compile(r"\d\.\d*")
+
+#Stage timing for --profile: how often each stage ran, for how long in total, and its p50/p95
+#Stages are http, ratelimit, cache, parse, spotify, library, storage, read and render. Fetch threads
+#record in parallel, so stage totals can add up to more than the wall time
+#With profiling off timed() hands back one shared do-nothing context, so the hot paths stay cheap
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+    def report(self):
+        stages = {}
+        with self.lock:
+            for stage, samples in self.samples.items():
+                ordered = sorted(samples)
+                stages[stage] = {'count' : len(ordered), 'total' : sum(ordered), 'p50' : percentile(ordered, 50),
+                                 'p95' : percentile(ordered, 95), 'max' : ordered[-1]}
+        return {'wall' : time.perf_counter() - self.start, 'stages' : stages}
+    def summary(self, report):
+        print("{s:<14}{c:>8}{t:>11}{p50:>11}{p95:>11}".format(s='stage', c='count', t='total s', p50='p50 ms', p95='p95 ms'))
+        for stage, s in sorted(report['stages'].items(), key=lambda item : -item[1]['total']):
+            print("{s:<14}{c:>8}{t:>11.3f}{p50:>11.2f}{p95:>11.2f}".format(s=stage, c=s['count'], t=s['total'], p50=s['p50'] * 1000, p95=s['p95'] * 1000))
+        print("wall time: {w:.3f}s".format(w=report['wall']))
+class Timed:
+    __slots__ = ('timer', 'stage', 'start')
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *exc):
+        self.timer.add(self.stage, time.perf_counter() - self.start)
+NOT_TIMED = contextlib.nullcontext()
+stageTimer = None #a StageTimer while --profile is on
+def timed(stage):
+    if stageTimer is None:
+        return NOT_TIMED
+    return Timed(stageTimer, stage)
+def timedStage(stage): #decorator version of timed, for functions that are a stage all by themselves
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+def timedIter(stage, items): #times producing each item of a generator, but not what the caller does in between
+    items = iter(items)
+    end = object()
+    while True:
+        with timed(stage):
+            item = next(items, end)
+        if item is end:
+            return
+        yield item
+def reportStages(command, filename): #summary table on screen, full report as JSON
+    report = stageTimer.report()
+    report['command'] = command
+    stageTimer.summary(report)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+    log.info("Saved stage timings to %s", filename)
+def percentile(ordered, pct): #nearest rank on an already sorted list
+    return ordered[max(0, math.ceil(len(ordered) * pct / 100) - 1)]
+
+#TokenBucket: thread safe token bucket used to rate limit a single host
+#Every request takes a token, and tokens trickle back in at a fixed rate (up to the burst size)
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+#PageCache: persistent, gzipped, URL keyed archive of every page we fetch
+#Entries are fresh for the TTL of the first CACHE_TTLS pattern matching their url. Stale entries are
+#revalidated with ETag/Last-Modified when the server gave us one, and the least recently used pages
+#are evicted once the archive grows past CACHE_MAX_BYTES. The raw HTML stays around so the
+#extraction code can be re-run with --offline after a parser fix
+CACHE_DIR = "pagecache"
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+DAY = 24 * 60 * 60
+CACHE_TTLS = [(re.compile(r"album\.asp"), 14 * DAY), (re.compile(r"artist\.asp"), 60 * DAY)]
+DEFAULT_TTL = 0 #charts and anything else always get revalidated
+class PageCache:
+    def __init__(self, directory=CACHE_DIR, maxBytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.enabled = True
+        self.offline = False #never touch the network, serve whatever we have
+        self.refresh = False #treat every entry as stale
+        self.index = None #key -> metadata, loaded on first use
+        self.dirty = 0
+        self.lock = threading.Lock()
+    def key(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest()
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.gz')
+    def indexPath(self):
+        return os.path.join(self.directory, 'index.json')
+    def load(self):
+        if self.index is None:
+            self.index = {}
+            if os.path.isfile(self.indexPath()):
+                with open(self.indexPath(), 'r') as f:
+                    self.index = json.load(f)
+                log.debug("Loaded %s cached pages", len(self.index))
+        return self.index
+    def ttl(self, url):
+        for pattern, ttl in CACHE_TTLS:
+            if re.search(pattern, url):
+                return ttl
+        return DEFAULT_TTL
+    def lookup(self, url): #returns (metadata, content) or (None, None)
+        if not self.enabled:
+            return None, None
+        with self.lock:
+            meta = self.load().get(self.key(url))
+        if meta is None:
+            return None, None
+        try:
+            with gzip.open(self.path(self.key(url)), 'rb') as f:
+                content = f.read()
+        except OSError:
+            log.debug("Cached page for %s is missing, dropping it", url)
+            with self.lock:
+                self.index.pop(self.key(url), None)
+            return None, None
+        with self.lock:
+            meta['accessed'] = time.time()
+            self.dirty += 1
+        return meta, content
+    def isFresh(self, url, meta):
+        if self.offline:
+            return True
+        if self.refresh:
+            return False
+        return time.time() - meta['stored'] < self.ttl(url)
+    def validators(self, meta): #conditional request headers for a stale entry
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('lastModified'):
+            headers['If-Modified-Since'] = meta['lastModified']
+        return headers
+    def touch(self, url): #a 304 came back, so the cached copy is good for another TTL
+        with self.lock:
+            meta = self.load().get(self.key(url))
+            if meta is not None:
+                meta['stored'] = time.time()
+                self.dirty += 1
+    def store(self, url, response):
+        if not self.enabled:
+            return
+        key = self.key(url)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.' + threading.current_thread().name + '.tmp'
+        with gzip.open(tmp, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp, path)
+        with self.lock:
+            now = time.time()
+            self.load()[key] = {
+                'url' : url,
+                'stored' : now,
+                'accessed' : now,
+                'size' : os.path.getsize(path),
+                'etag' : response.headers.get('ETag'),
+                'lastModified' : response.headers.get('Last-Modified'),
+            }
+            self.dirty += 1
+            self.evict()
+        if self.dirty > 50:
+            self.flush()
+    def evict(self): #call with the lock held
+        total = sum(meta['size'] for meta in self.index.values())
+        if total <= self.maxBytes:
+            return
+        log.info("Page cache is %sMB, evicting old pages", total // (1024 * 1024))
+        for key in sorted(self.index.keys(), key=lambda k: self.index[k]['accessed']):
+            if total <= self.maxBytes * 0.9:
+                break
+            total -= self.index.pop(key)['size']
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+    def flush(self):
+        with self.lock:
+            if self.index is None or self.dirty == 0:
+                return
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = self.indexPath() + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(tmp, self.indexPath())
+            self.dirty = 0
+
+#Fetcher: the fetch engine. Owns a worker pool, one requests session per worker thread, and
+#a token bucket per host, so we can have lots of requests in flight while the total load
+#on any one site stays the same. Everything goes through the page cache first
+class Fetcher:
+    def __init__(self, workers=FETCH_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.cache = PageCache()
+        self.budget = None #the RequestBudget every request goes against, while schedule is refreshing
+    def session(self):
+        if not hasattr(self.local, 'session'):
+            import requests
+            self.local.session = requests.Session()
+        return self.local.session
+    def throttle(self, host): #blocks until the host's bucket lets us through, every request we send comes here first
+        if self.budget is not None:
+            self.budget.count()
+        with self.lock:
+            if host not in self.buckets:
+                rate, burst = HOST_RATES.get(host, DEFAULT_RATE)
+                self.buckets[host] = TokenBucket(rate, burst)
+            bucket = self.buckets[host]
+        with timed('ratelimit'):
+            bucket.acquire()
+    def get(self, url): #returns the raw page content, raises requests.HTTPError for a 4xx or 5xx reply
+        with timed('cache'):
+            meta, content = self.cache.lookup(url)
+        if meta is not None and self.cache.isFresh(url, meta):
+            log.debug("Serving %s from the page cache", url)
+            return content
+        if self.cache.offline:
+            log.error("%s is not in the page cache and we are offline", url)
+            raise LookupError(url)
+        headers = self.cache.validators(meta) if meta is not None else {}
+        self.throttle(urlsplit(url).hostname)
+        log.debug("Requesting %s", url)
+        with timed('http'):
+            page = self.session().get(url, headers=headers)
+        log.debug("Status code: %s", page.status_code)
+        if page.status_code == 304 and meta is not None:
+            log.debug("%s has not changed, using cached copy", url)
+            self.cache.touch(url)
+            return content
+        page.raise_for_status() #an error page isn't the page we asked for, so callers never get to parse one
+        if page.status_code == 200:
+            with timed('cache'):
+                self.cache.store(url, page)
+        return page.content
+    def submit(self, fn, *args):
+        return self.pool.submit(fn, *args)
+fetcher = Fetcher()
+atexit.register(fetcher.cache.flush)
+
+#Turns a single <tr> from a PA chart table into a dict of everything we can read off the chart itself
+#Chart pages are parsed as a stream. Rows come out of the chart table as soon as the parser reaches
+#them, so their fetches go on the pool while the rest of the page is still being parsed, and nothing
+#after the chart table is parsed at all. A row's fields all come out of one compiled XPath
+CHART_TABLE_PATH = '/html[1]/body[1]/div[2]/div[2]/div[1]/table[1]'
+CHART_ROW_FIELDS = (('albumLink', 'td[4]/a[1]/@href'),
+                    ('artistLink', 'td[4]/a[2]/@href'),
+                    ('title', 'td[4]/a[1]'),
+                    ('artist', 'td[4]/a[2]'),
+                    ('genre', 'td[5]/a[1]'),
+                    ('year', 'td[5]'),
+                    ('rating', 'td[3]/*[3]'),
+                    ('noRatings', 'td[3]/*[4]'),
+                    ('qwr', 'td[3]/*[5]'))
+FIELD_SEP = '\u241f' #never shows up on PA
+@functools.lru_cache(maxsize=None)
+def chartRowSelector():
+    from lxml import etree
+    return etree.XPath("concat({f})".format(f=', "{s}", '.format(s=FIELD_SEP).join(path for field, path in CHART_ROW_FIELDS)), smart_strings=False)
+def parseChartRow(albumTR):
+    fields = dict(zip((field for field, path in CHART_ROW_FIELDS), chartRowSelector()(albumTR).split(FIELD_SEP)))
+    albumLink = PA_BASE + fields['albumLink']
+    qwr = re.search(qwrRE, fields['qwr']) #this should never fail
+    return {
+        'id' : re.search(albumIdRE, albumLink).group(0),
+        'albumLink' : albumLink,
+        'artistLink' : PA_BASE + fields['artistLink'],
+        'title' : fields['title'],
+        'artist' : fields['artist'],
+        'genre' : fields['genre'],
+        'year' : re.search(yearRE, fields['year']).group(0),
+        'rating' : fields['rating'],
+        'noRatings' : fields['noRatings'],
+        'qwr' : qwr.group(0) if qwr else None,
+    }
+def streamPath(elem): #like getpath, but only counts earlier siblings, which are all a streaming parser has seen yet
+    steps = []
+    while elem is not None:
+        n = 1 + sum(1 for sibling in elem.itersiblings(elem.tag, preceding=True))
+        steps.append("{t}[{n}]".format(t=elem.tag, n=n))
+        elem = elem.getparent()
+    return '/' + '/'.join(reversed(steps))
+def iterChartRows(content):
+    from lxml import etree
+    chartTable = None
+    for event, elem in etree.iterparse(io.BytesIO(content), events=('end',), tag=('tr', 'table'), html=True, remove_comments=True):
+        if elem.tag == 'table':
+            if chartTable is not None and elem == chartTable:
+                return #that's the whole chart
+            continue
+        table = elem.getparent()
+        if chartTable is None and streamPath(table) == CHART_TABLE_PATH:
+            chartTable = table
+        if chartTable is None or table != chartTable:
+            continue
+        row = parseChartRow(elem)
+        elem.clear() #we have what we need, don't keep the row around
+        yield row
+def getChartRows(link): #generator, rows come out in chart order as they are parsed
+    return timedIter('parse', iterChartRows(fetcher.get(link)))
+#Kicks off every web lookup a chart row needs on the fetch pool, and hands back the futures
+#The processing loop in scanChart/updateChart then consumes these in chart order
+#The album page is parsed on the pool too, so 'duration' resolves to the album length
+def fetchRow(row, spObj, albumPage=False, artist=False, spotify=False):
+    jobs = {}
+    if albumPage:
+        jobs['duration'] = lookupOnce('duration', row['id'], getTimestamp, row['albumLink'])
+    if artist:
+        jobs['artist'] = requestArtist(row['artistLink'])
+    if spotify:
+        jobs['spotify'] = lookupOnce('spotify', row['id'], lookupSpotify, spObj, row['artist'], row['title'], row['year'])
+    return jobs
+def scanJobs(row, spObj, updateSpotify, updateDuration): #what scanChart fetches for a row
+    if row['id'] in albumLib.keys():
+        return fetchRow(row, spObj, albumPage=updateDuration, spotify=updateSpotify)
+    return fetchRow(row, spObj, albumPage=True, artist=True, spotify=True)
+#Run wide registry of album lookups. An album that shows up on several charts in one run (or twice
+#while charts are scanned in parallel) only has each lookup made once; finished ones stay in here
+albumLookups = {} #(kind, album id) -> Future
+albumLock = threading.RLock() #held while a chart's processing loop touches albumLib/chartLib
+def lookupOnce(kind, albumID, fn, *args):
+    with fetcher.lock:
+        if (kind, albumID) not in albumLookups.keys():
+            albumLookups[(kind, albumID)] = fetcher.submit(fn, *args)
+        return albumLookups[(kind, albumID)]
+#The chart row fields the album page and spotify search depend on. Ratings come off the chart row
+#itself, so a rating change never needs a fetch
+LOOKUP_FIELDS = ('title', 'artist', 'year')
+def rowChanged(album, row):
+    return any(getattr(album, field) != row[field] for field in LOOKUP_FIELDS)
 #Ranking: basically a class wrapper that contains the rank info and history for a single chart and album
 #this class is used by the Album class to keep track of where an album appears in multiple charts
 # (and how that's changed over time)
 # Eg, Album will store unique instances of this class for "top 100 all time" and "top 100 prog metal"
 # While there is a separate chart object, this is meant as a way to store information relative to
 # a single album.  
+#There is one of these per album per chart, so it is kept small: slots instead of a dict, dates as
+#day ordinals (0 = never) and the history as two parallel int arrays instead of a list of lists
 class Ranking:
+    __slots__ = ('chart', 'ranking', 'updated', 'histRanks', 'histDates', 'isRejected')
     def __init__(self, chart): #Set initial ranking state for some chart
         self.chart = chart
         self.ranking = -1
-        self.lastUpdated = "" #date string of when this ranking was last made
-        self.rankHistory = [] #log of previous rank numbers. Positive = rank. Neg = rejected status.
+        self.updated = 0 #ordinal of the day this ranking was last made
+        self.histRanks = array('i') #log of previous rank numbers. Positive = rank. Neg = rejected status.
+        self.histDates = array('i') #ordinal of the day each of those ranks was made
         self.isRejected = False  #def of rejection: when *this* album *was* on a chart once but not anymore
+    @property
+    def lastUpdated(self): #date string of when this ranking was last made
+        return dateString(self.updated)
+    @lastUpdated.setter
+    def lastUpdated(self, dateStr):
+        self.updated = dateOrdinal(dateStr) if dateStr else 0
+    @property
+    def rankHistory(self): #read-only [rank, date string] view of the history
+        return [[rank, dateString(day)] for rank, day in zip(self.histRanks, self.histDates)]
+    def addHistory(self, rank, day):
+        self.histRanks.append(rank)
+        self.histDates.append(day)
+        log.debug("Added hist entry %s", [rank, dateString(day)])
     def setRanking(self, rank, dateStr):  
-        if len(self.rankHistory) < 1:
+        if len(self.histRanks) < 1:
             log.debug("Ranking album for the first time")
             self.ranking = rank
             if rank == -1:
                 self.isRejected = True
             self.lastUpdated = dateStr
-            histEntry = [self.ranking, self.lastUpdated]
-            log.debug("Added hist entry {s}".format(s=str(histEntry)))
-            self.rankHistory.append(histEntry)
+            self.addHistory(self.ranking, self.updated)
             
         else:
             log.debug("Adding new ranking")
@@ -74,28 +515,51 @@ class Ranking:
                 self.isRejected = True
             else:
                 self.isRejected = False
-            histEntry = [self.ranking, self.lastUpdated]
-            log.debug("Added hist entry {s}".format(s=str(histEntry)))
-            self.rankHistory.append(histEntry)
+            self.addHistory(self.ranking, self.updated)
             self.ranking = rank
             self.lastUpdated = dateStr
+    def __getstate__(self):
+        return {name : getattr(self, name) for name in self.__slots__}
+    def __setstate__(self, state):
+        if 'rankHistory' in state.keys(): #pickled before slots, dates were strings and history a list of lists
+            state = dict(state)
+            history = state.pop('rankHistory')
+            state['updated'] = dateOrdinal(state.pop('lastUpdated')) if state.get('lastUpdated') else 0
+            state['histRanks'] = array('i', [entry[0] for entry in history])
+            state['histDates'] = array('i', [dateOrdinal(entry[1]) if entry[1] else 0 for entry in history])
+        for name in self.__slots__:
+            setattr(self, name, state[name])
 
 #Links: this class is also tied to the album class. While less necessary (you can view this as an 
 # extension of the Album class anyhow), it's neater to put the bulk of the API calls in its own container
 #A Links instance contains all the web links related to this album, as well as the library status
 #it also generates some of these links. In the future I would like this to fetch RYM links,
 #but they do not have a functional API, and scraping otherwise appears convoluted
+#The album/artist/year used for queries are read off the owning album rather than copied in
 class Links:
-    def __init__(self, album, artist, year):
-        self.album = album #just passing this for query purposes
-        self.artist = artist
-        self.year = year
+    __slots__ = ('owner', 'albumLink', 'artistLink', 'spotifyLink', 'inLibrary', 'onSpotify')
+    def __init__(self, owner):
+        self.owner = owner #the Album these links belong to
         self.albumLink = "" 
         self.artistLink = ""
         self.spotifyLink = ""
         self.inLibrary = False
         self.onSpotify = False
-        self.spotifyLink = ""
+    def __setattr__(self, name, value): #a link changing is a change to its album
+        changed = name != 'owner' and getattr(self, name, None) != value
+        object.__setattr__(self, name, value)
+        owner = getattr(self, 'owner', None)
+        if changed and owner is not None:
+            changedAlbums.add(owner.idNo)
+    @property
+    def album(self):
+        return self.owner.title
+    @property
+    def artist(self):
+        return self.owner.artist
+    @property
+    def year(self):
+        return self.owner.year
     def setSpotifyLink(self, spotifyLink): #manual streaming entry helper
         self.spotifyLink = spotifyLink
         self.onSpotify = True
@@ -104,105 +568,277 @@ class Links:
         self.onSpotify = False
     def findInLibrary(self): #determine whether the album is in a user's music directory
         log.info("Seeking album in library")
-        with open("settings.ini", 'r') as file:
-            lines=file.readlines()
-            libdir=lines[3].split('=')[1].strip('\n')
-        root = libdir + self.artist[0] + '/' #This is fixed for now
-        if os.path.isdir(root + self.artist):
-            log.debug("Artist {a} found on disc".format(a=self.artist))
-            path = root + self.artist + '/' + self.album
-            if os.path.isdir(path):
-                log.debug("{a} by {ar} found at {p}".format(a=self.album,ar=self.artist,p=path))
+        index = getLibraryIndex()
+        with timed('library'):
+            letter = self.artist[0] #This is fixed for now
+            if index.hasAlbum(letter, self.artist, self.album):
+                log.debug("%s by %s found on disc", self.album, self.artist)
                 self.inLibrary = True
                 return
-        log.info("Album not found, trying again with articles removed")
-        doublecheck = self.artist.removeprefix("The ")
-        if os.path.isdir(root + doublecheck):
-            log.debug("Artist {a} found on disc".format(a=doublecheck))
-            path = root + doublecheck + '/' + self.album
-            if os.path.isdir(path):
-                log.debug("{a} by {ar} found at {p}".format(a=self.album,ar=self.artist,p=path))
+            log.info("Album not found, trying again with articles removed")
+            doublecheck = self.artist.removeprefix("The ")
+            if index.hasAlbum(letter, doublecheck, self.album):
+                log.debug("%s by %s found on disc", self.album, doublecheck)
                 self.inLibrary = True
                 return
-        log.info("Album not found on disc")
-        self.inLibrary = False
-    def findSpotify(self, spObj):
-        log.info("Seeking spotify status for {a} by {ar}".format(a=self.album, ar=self.artist))
-        
-        artist = " ".join(re.split('\W+', self.artist))
-        if not artist:
-            log.debug("Artist sanitization failed, falling back")
-            #WHY DID YOU PICK THAT BAND NAME???
-            artist = self.artist
-        else:
-            artist= artist.group(0)
-        log.debug("Sanitized artist name: {ar}".format(ar=artist))
-        album = " ".join(re.split('\W+', self.album))
-        if not album:
-            log.debug("Album sanitization failed, falling back")
-            album = self.album
-        else:
-            album = album.group(0)
-        log.debug("Sanitized album name: {a}".format(a=album))
-        albumQuery1 = "artist:{artist} album:{album}".format(artist=self.artist, album=self.album)
-        log.info("Sending query for {s}".format(s=albumQuery1))
-        res = spObj.search(albumQuery1, limit=3, type='album', market='US')
-        link = ''
-        #3 passes, querying spotify for the top 3 albums. This is pedantic
-        if res['albums']['total'] == 0:
-            log.info("No results for prev. query, trying again")
-            albumQuery2 = "artist:{artist} year:{year}".format(artist=self.artist, year=self.year)
-            log.info("Sending query for {s}".format(s=albumQuery2))
-            res2 = spObj.search(albumQuery2, limit=3, type='album', market='US')
-            if res2['albums']['total'] == 0:
-                log.info("No results for prev. query, trying again (x2)")
-                albumQuery3 = "album:{album} year:{year}".format(album=self.album, year=self.year)
-                log.info("Sending query for {s}".format(s=albumQuery3))
-                res3 = spObj.search(albumQuery3, limit=3, type='album', market='US')
-                if res3['albums']['total'] == 0:
-                    log.info("Could not find spotify link, setting status to false")
-                    self.notOnSpotify()
-                else:
-                    log.info("Found spotify link!")
-                    link = res3['albums']['items'][0]['external_urls']['spotify']
-                    log.debug(link)
-                    self.setSpotifyLink(link) 
-            else:
-                log.info("Found spotify link!")
-                link = res2['albums']['items'][0]['external_urls']['spotify']
-                log.debug(link)
-                self.setSpotifyLink(link) 
+            log.info("Album not found on disc")
+            self.inLibrary = False
+    def setSpotify(self, link): #applies the result of lookupSpotify
+        if link:
+            self.setSpotifyLink(link)
         else:
+            self.notOnSpotify()
+    def findSpotify(self, spObj):
+        self.setSpotify(lookupSpotify(spObj, self.artist, self.album, self.year))
+    def __getstate__(self): #the owner pickles us, and hands itself back on load
+        return {name : getattr(self, name) for name in self.__slots__ if name != 'owner'}
+    def __setstate__(self, state): #older pickles also carry album/artist/year copies, which are dropped
+        for name in self.__slots__:
+            if name in state.keys():
+                setattr(self, name, state[name])
+#Queries spotify for an album, returns the link of the best match or '' if there isn't one
+#This doesn't touch any album state, so it is safe to run on the fetch pool
+def lookupSpotify(spObj, artist, album, year):
+    log.info("Seeking spotify status for %s by %s", album, artist)
+    found, link = spotifyCache.get(artist, album, year)
+    if found:
+        log.info("Using cached spotify status for %s by %s", album, artist)
+        return link
+    link = searchSpotify(spObj, artist, album, year)
+    spotifyCache.put(artist, album, year, link)
+    return link
+def searchSpotify(spObj, artist, album, year):
+    #3 passes, querying spotify for the top 3 albums. This is pedantic
+    queries = ["artist:{artist} album:{album}".format(artist=artist, album=album),
+               "artist:{artist} year:{year}".format(artist=artist, year=year),
+               "album:{album} year:{year}".format(album=album, year=year)]
+    for query in queries:
+        log.info("Sending query for %s", query)
+        fetcher.throttle(SPOTIFY_HOST)
+        with timed('spotify'):
+            res = spObj.search(query, limit=3, type='album', market='US')
+        if res['albums']['total'] != 0:
             log.info("Found spotify link!")
             link = res['albums']['items'][0]['external_urls']['spotify']
             log.debug(link)
-            self.setSpotifyLink(link) 
+            return link
+        log.info("No results for prev. query, trying again")
+    log.info("Could not find spotify link, setting status to false")
+    return ''
+#SpotifyClient: stands in for the spotipy client until the first search. Building the real one means
+#importing spotipy and reading the credentials out of settings.ini, which only the commands that
+#go to spotify (and then only on a cache miss) ever need. Safe to share across the fetch pool
+SPOTIFY_TOKEN_URL = "https://accounts.spotify.com/api/token"
+FETCH_COMMANDS = ('scanchart', 'updatechart', 'updateworkbook', 'scancharts', 'schedule', 'readchart', 'readworkbook') #readChart fetches albums and artists it doesn't know
+class SpotifyClient:
+    def __init__(self):
+        self.client = None
+        self.lock = threading.Lock()
+    def connect(self):
+        with self.lock:
+            if self.client is None:
+                import spotipy
+                from spotipy.oauth2 import SpotifyClientCredentials
+                from decouple import config
+                log.info("Logging in to spotify")
+                SpotifyClientCredentials.OAUTH_TOKEN_URL = SPOTIFY_TOKEN_URL
+                auth_handler = SpotifyClientCredentials(config('SPOTIPY_CLIENT_ID'), config('SPOTIPY_CLIENT_SECRET'))
+                client = spotipy.Spotify(auth_manager=auth_handler)
+                client.prefix = SPOTIFY_API
+                self.client = client
+            return self.client
+    def search(self, *args, **kwargs):
+        return self.connect().search(*args, **kwargs)
+#SpotifyCache: remembers what spotify told us about an album, keyed by normalized artist, album and year
+#Hits and misses are kept apart with their own expiry. Misses are worth remembering (albums not on
+#spotify cost all 3 queries every time), but they expire sooner since albums do get added
+SPOTIFY_CACHE = "spotifyCache.pkl"
+SPOTIFY_HIT_TTL = 90 * DAY
+SPOTIFY_MISS_TTL = 14 * DAY
+normalizeRE = re.compile(r"\W+")
+class SpotifyCache:
+    def __init__(self, filename=SPOTIFY_CACHE, hitTTL=SPOTIFY_HIT_TTL, missTTL=SPOTIFY_MISS_TTL):
+        self.filename = filename
+        self.hitTTL = hitTTL
+        self.missTTL = missTTL
+        self.enabled = True
+        self.hits = None #key -> (link, time stored)
+        self.misses = None #key -> time stored
+        self.dirty = False
+        self.lock = threading.Lock()
+    def key(self, artist, album, year):
+        artist = " ".join(re.split(normalizeRE, str(artist).lower())).strip()
+        album = " ".join(re.split(normalizeRE, str(album).lower())).strip()
+        return (artist, album, str(year).strip())
+    def load(self): #call with the lock held
+        if self.hits is None:
+            self.hits = {}
+            self.misses = {}
+            if os.path.isfile(self.filename):
+                with open(self.filename, 'rb') as f:
+                    self.hits, self.misses = pickle.load(f)
+                log.debug("Loaded %s spotify hits and %s misses", len(self.hits), len(self.misses))
+    def get(self, artist, album, year): #returns (found, link). A fresh miss is (True, '')
+        if not self.enabled:
+            return False, ''
+        key = self.key(artist, album, year)
+        now = time.time()
+        with self.lock:
+            self.load()
+            if key in self.hits.keys() and now - self.hits[key][1] < self.hitTTL:
+                return True, self.hits[key][0]
+            if key in self.misses.keys() and now - self.misses[key] < self.missTTL:
+                return True, ''
+        return False, ''
+    def put(self, artist, album, year, link):
+        if not self.enabled:
+            return
+        key = self.key(artist, album, year)
+        with self.lock:
+            self.load()
+            if link:
+                self.hits[key] = (link, time.time())
+                self.misses.pop(key, None)
+            else:
+                self.misses[key] = time.time()
+                self.hits.pop(key, None)
+            self.dirty = True
+    @timedStage('storage')
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                pickle.dump((self.hits, self.misses), f)
+            os.replace(tmp, self.filename)
+            self.dirty = False
+spotifyCache = SpotifyCache()
+atexit.register(spotifyCache.save)
+#LibraryIndex: in memory picture of the music library ([directory]/[first letter]/[artist]/[album])
+#Built with one scandir walk (one thread per letter directory) and pickled with the mtime of every
+#letter and artist directory, so later runs only rescan the directories that changed since.
+#After that every findInLibrary is a dictionary lookup instead of a handful of (slow, on a NAS) stats
+LIBRARY_INDEX = "libraryIndex.pkl"
+LIBRARY_WORKERS = 8
+class LibraryIndex:
+    def __init__(self, root, filename=LIBRARY_INDEX):
+        self.root = root
+        self.filename = filename
+        self.letters = {} #letter -> [mtime, {artist -> [mtime, set of albums]}]
+        self.dirty = False
+    @timedStage('library index')
+    def load(self):
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                root, letters = pickle.load(f)
+            if root == self.root:
+                self.letters = letters
+            else:
+                log.info("Music library moved from %s to %s, reindexing", root, self.root)
+        self.refresh()
+        return self
+    def refresh(self):
+        log.info("Indexing music library at %s", self.root)
+        if not os.path.isdir(self.root):
+            log.warning("Music library %s does not exist", self.root)
+            return
+        with os.scandir(self.root) as it:
+            letters = [entry.name for entry in it if entry.is_dir()]
+        with ThreadPoolExecutor(max_workers=LIBRARY_WORKERS, thread_name_prefix="library") as pool:
+            results = list(pool.map(self.scanLetter, letters))
+        fresh = dict(zip(letters, results))
+        if fresh != self.letters:
+            self.letters = fresh
+            self.dirty = True
+        log.info("Indexed %s artists", sum(len(artists) for mtime, artists in self.letters.values()))
+    def scanLetter(self, letter):
+        path = os.path.join(self.root, letter)
+        mtime = os.stat(path).st_mtime
+        oldMtime, oldArtists = self.letters.get(letter, [None, {}])
+        if mtime == oldMtime: #no artists came or went, only check the artists we know about
+            names = oldArtists.keys()
+        else:
+            with os.scandir(path) as it:
+                names = [entry.name for entry in it if entry.is_dir()]
+        artists = {}
+        for name in names:
+            artistPath = os.path.join(path, name)
+            try:
+                artistMtime = os.stat(artistPath).st_mtime
+            except OSError:
+                continue
+            if name in oldArtists.keys() and oldArtists[name][0] == artistMtime:
+                artists[name] = oldArtists[name]
+            else:
+                with os.scandir(artistPath) as it:
+                    artists[name] = [artistMtime, set(entry.name for entry in it if entry.is_dir())]
+        return [mtime, artists]
+    def hasAlbum(self, letter, artist, album):
+        artists = self.letters.get(letter, [None, {}])[1]
+        return artist in artists.keys() and album in artists[artist][1]
+    @timedStage('storage')
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump((self.root, self.letters), f)
+        os.replace(tmp, self.filename)
+        self.dirty = False
+libraryIndex = None
+libraryLock = threading.Lock()
+def getLibraryIndex(): #the index is built the first time anything asks for it
+    global libraryIndex
+    with libraryLock:
+        if libraryIndex is None:
+            with open("settings.ini", 'r') as file:
+                lines=file.readlines()
+                libdir=lines[3].split('=')[1].strip()
+            libraryIndex = LibraryIndex(libdir).load()
+            atexit.register(libraryIndex.save)
+        return libraryIndex
+#Albums and charts changed since the libraries were last saved, so a .db save only has to serialize
+#those (see SqliteStore). Setting a field marks its album or chart, and so do the methods that change
+#their lists and dicts in place. Loading from a pickle doesn't count as a change
+changedAlbums = set() #album ids
+changedCharts = set() #chart names
 #Album Class
 #Represents all the metadata for an album in a general package
 #Invokes and handles 2 subclasses for rankings and links
 #to do: move the other classes to be inner classes of album just to make things clearer
 class Album:
+    __slots__ = ('idNo', 'title', 'artist', 'artistID', 'year', 'genre', 'qwr', 'duration', 'country', 'rank', 'links',
+                 'rating', 'noRatings', 'houseListened', 'bought', 'numListeners', 'profiles')
     def __init__(self, idNo, title, artist, year ):
         self.idNo = idNo #PA id, retrieved from the PA link
         self.title = title
         self.artist = artist
+        self.artistID = None #key into artistLib
         self.year = year
-        self.locations = []
-        self.duration = "Unknown"
+        self.genre = "Unknown"
+        self.qwr = None
+        self.duration = None #seconds
         self.country = "Unknown"
         self.rank = {}
-        self.links = Links(title, artist, year)
+        self.links = Links(self)
         self.rating = 0
         self.noRatings = 0
         self.houseListened = False
         self.bought = '?' #must be manually done
         self.numListeners = 0 
         self.profiles = {'Listened?' : '?'}
+    def __setattr__(self, name, value): #setting a field to what it already was isn't a change
+        changed = getattr(self, name, None) != value
+        object.__setattr__(self, name, value)
+        if changed:
+            changedAlbums.add(self.idNo)
 
     def setListeningInfo(self, infoBlock, profileNames):#
+        changedAlbums.add(self.idNo)
         log.debug("Setting listening info")
-        log.debug("Profiles: {pf}".format(pf=str(profileNames)))
-        log.debug("Info: {pi}".format(pi=str(infoBlock)))
+        log.debug("Profiles: %s", profileNames)
+        log.debug("Info: %s", infoBlock)
         if len(profileNames) == 0 and len(infoBlock) == 1:
             log.debug("Empty profile given, filling out generic profile instead")
             self.profiles['Listened?'] = infoBlock
@@ -213,7 +849,8 @@ class Album:
                 self.profiles[profileNames[i]] = infoBlock[i] #local storage
             self.numListeners = len(infoBlock)
     def addRanking(self, chartName, rank, dateStr):#assign a ranking to a chart (str) and rank (positive int if on chart, negative for reject)
-        log.debug("Adding rank {r} to album {t} on chart {c}".format(r=rank,t=self.title,c=chartName))
+        changedAlbums.add(self.idNo)
+        log.debug("Adding rank %s to album %s on chart %s", rank, self.title, chartName)
         if chartName not in self.rank.keys():
             log.debug("Album is new to chart")
             ranking = Ranking(chartName)
@@ -223,20 +860,23 @@ class Album:
             log.debug("Updating rank for album")
             self.rank[chartName].setRanking(rank, dateStr)
     def deleteRanking(self, chartName): #only use when deleting a chart altogether
+        changedAlbums.add(self.idNo)
         return self.rank.pop(chartName, None)
     def enterRanking(self, rankObj):
+        changedAlbums.add(self.idNo)
         self.rank[rankObj.chart] = rankObj
     def syncListened(self, newBlock, newListeners, literalRule=False):
+        changedAlbums.add(self.idNo)
         log.debug("Syncing listening info")
         if len(newBlock) == len(newListeners):
             for i in range(len(newBlock)):
                 listener = newListeners[i]
                 if listener in self.profiles.keys():
-                    log.debug("Updating existing profile entry for {l}".format(l=listener))
+                    log.debug("Updating existing profile entry for %s", listener)
                     if literalRule:
                         old = self.profiles[listener]
                         self.profiles[listener] = newBlock[i]
-                        log.debug("Overwrote {old} with {new}".format(old=old, new=newBlock[i]))
+                        log.debug("Overwrote %s with %s", old, newBlock[i])
                     elif newBlock[i] == "Yes":
                         log.debug("Updated profile entry to Yes")
                         self.profiles[listener] = newBlock[i]
@@ -245,27 +885,110 @@ class Album:
                     else:
                         log.debug("No change")
                 else:
-                    log.debug("New listener profile detected: {n}".format(n=listener))
+                    log.debug("New listener profile detected: %s", listener)
                     self.profiles[listener] = newBlock[i]
-def addTimes(t1, t2):
-    log.debug("Adding times {t1} and {t2}".format(t1=t1, t2=t2))
-    first = t1.split(':')
-    second = t2.split(':')
-    mins = int(first[0]) + int(second[0])
-    secs = int(first[1]) + int(second[1])
-    if secs > 59:
-        mins += secs // 60
-        secs = secs % 60
-    if secs < 10:
-        secs = '0' + str(secs)
-    res = str(mins) + ":" + str(secs)
-    log.debug("Result: {res}".format(res=res))
-    return res
+    def __getstate__(self):
+        return {name : getattr(self, name) for name in self.__slots__}
+    def __setstate__(self, state): #also reads albums pickled before slots (their unused locations list is dropped) and string durations
+        state = dict({'artistID' : None, 'genre' : "Unknown", 'qwr' : None}, **state)
+        for name in self.__slots__: #object.__setattr__, so loading doesn't mark the album changed
+            if name in state.keys():
+                object.__setattr__(self, name, state[name])
+        if isinstance(self.duration, str): #durations used to be stored as "mm:ss" or "Unknown"
+            object.__setattr__(self, 'duration', parseDuration(self.duration))
+        if getattr(self.links, 'owner', None) is None: #a copy keeps sharing the original's links
+            self.links.owner = self
+#Artist: header info for a PA artist, keyed by the id in their artist link
+#Prog charts repeat artists constantly, so every artist is fetched once and then lives in artistLib
+class Artist:
+    def __init__(self, idNo, link):
+        self.idNo = idNo
+        self.link = link
+        self.name = ""
+        self.genre = "Unknown"
+        self.country = "Unknown"
+        self.lastUpdated = ""
+    @timedStage('parse')
+    def readHeader(self, content): #fills in name, genre and country from an artist page, False if it had no header
+        from lxml import html
+        artInfo = html.fromstring(content)
+        nameInfo = artInfo.xpath("/html/body/div[2]/div[2]/div/h1/text()")
+        if len(nameInfo) > 0:
+            self.name = nameInfo[0].strip()
+        headerInfo = artInfo.xpath("/html/body/div[2]/div[2]/div/h2/text()")
+        if len(headerInfo) == 0:
+            log.warning("Could not find a header on %s, country stays unknown", self.link)
+            return False
+        parts = headerInfo[0].split(' • ')
+        self.genre = parts[0].strip()
+        if len(parts) > 1:
+            self.country = parts[1].strip()
+        self.lastUpdated = date.today().strftime("%m/%d/%Y")
+        log.debug("Artist %s: %s, %s", self.name, self.genre, self.country)
+        return True
+#Older libraries have countries on albums but no artist library. Rather than refetch every
+#artist page, build what we can from the albums we already have
+def seedArtists(artistLib, albumLib):
+    for album in albumLib.values():
+        gettingID = re.search(albumIdRE, album.links.artistLink)
+        if gettingID and gettingID.group(0) not in artistLib.keys() and album.country != "Unknown":
+            artist = Artist(gettingID.group(0), album.links.artistLink)
+            artist.name = album.artist
+            artist.country = album.country
+            artistLib[artist.idNo] = artist
+        if gettingID and getattr(album, 'artistID', None) is None:
+            album.artistID = gettingID.group(0)
+    return artistLib
+#Durations are kept as whole seconds (None when unknown) and only turned back into text for a sheet.
+#Lengths on PA come as m:ss, mmm:ss for long albums, and now and then h:mm:ss
+DURATION_RE = re.compile(r"(?<![\d:])(?:(\d{1,2}):)?(\d{1,3}):(\d{2})(?![\d:])")
+TOTAL_TIME_RE = re.compile(r"total(?:[\ ]|[\ ]\w+[\ ])time.*", re.IGNORECASE)
+def durationsIn(text): #every length in a piece of text, in seconds
+    return [int(h or 0) * 3600 + int(m) * 60 + int(sec) for h, m, sec in DURATION_RE.findall(text)]
+def parseDuration(text): #the first length in text, None if there isn't one
+    if isinstance(text, int):
+        return text
+    found = durationsIn(str(text))
+    return found[0] if found else None
+def formatDuration(seconds):
+    if seconds is None:
+        return "Unknown"
+    h, rest = divmod(seconds, 3600)
+    m, sec = divmod(rest, 60)
+    if h:
+        return "{h}:{m:02d}:{s:02d}".format(h=h, m=m, s=sec)
+    return "{m}:{s:02d}".format(m=m, s=sec)
 
+#What a chart row shows of an album, one entry per ROW_FIELDS name. An album's state is taken before and after
+#it changes, and the fields that differ get marked on every chart the album is on (see Chart.markRow)
+ROW_FIELDS = ('artist', 'album', 'year', 'genre', 'rating', 'ratings', 'length', 'country', 'listeners', 'spotify', 'bought', 'library', 'house')
+def rowState(a):
+    return ((a.artist, a.links.artistLink), (a.title, a.links.albumLink), a.year, a.genre, a.rating, a.noRatings, a.duration, a.country,
+            dict(a.profiles), (a.links.onSpotify, a.links.spotifyLink), a.bought, a.links.inLibrary, a.houseListened)
+def changedFields(before, after):
+    return {field for field, old, new in zip(ROW_FIELDS, before, after) if old != new}
+def markAlbum(album, fields): #call with albumLock held if charts are running in parallel
+    if not fields:
+        return
+    for name, ranking in album.rank.items():
+        chart = chartLib.get(name)
+        if chart is not None and 0 < ranking.ranking <= len(chart.entries) and chart.entries[ranking.ranking - 1] == album.idNo:
+            chart.markRow(ranking.ranking - 1, fields)
+def fieldColumns(fields, profileCount): #the (0 based) sheet columns showing those fields, listeners take one column each
+    columns = []
+    for field in fields:
+        i = ROW_FIELDS.index(field)
+        if field == 'listeners':
+            columns.extend(range(i, i + profileCount))
+        elif i < ROW_FIELDS.index('listeners'):
+            columns.append(i)
+        else:
+            columns.append(i - 1 + profileCount)
+    return sorted(columns)
 class Chart:
     def __init__(self, name, size, link, date):
-        self.scanned = False
         self.name = name
+        self.scanned = False
         self.link = link
         self.isRejectChart = False
         if link == "REJECT":
@@ -274,365 +997,574 @@ class Chart:
         self.size = size 
         self.entries = [None] * size
         self.heading = ['Artist', 'Album', 'Year', 'PA Genre', 'PA Rating', '# of Ratings', 'Album Length', 'Country', 'On Spotify?', 'Bought?', 'In Library?', 'House Listened?']
+        #reverse index, so nothing has to trawl the whole album library to find this chart's albums
+        self.members = set() #every album that has ever been on this chart
+        self.rejected = {} #album id -> date its current rejection started
+        self.rejections = [] #(date, album id) for every rejection, oldest first
+        #what changed since the last write, so writing again only touches those cells (see markRow)
+        self.dirty = None #row index -> set of ROW_FIELDS names, None if the next write has to do everything
+        self.written = None #(workbook file, sheet title, heading, row count) of the last write
+    def __setattr__(self, name, value):
+        changed = getattr(self, name, None) != value
+        object.__setattr__(self, name, value)
+        if changed:
+            changedCharts.add(self.name)
+    #Charts pickled before the index existed get it built once from the album library
+    def ensureIndex(self):
+        if getattr(self, 'members', None) is not None:
+            return
+        log.info("Building album index for %s", self.name)
+        self.members = set()
+        self.rejected = {}
+        self.rejections = []
+        for album in albumLib.values():
+            if self.name in album.rank.keys():
+                self.members.add(album.idNo)
+                thisRank = album.rank[self.name]
+                if thisRank.ranking == -1:
+                    start = thisRank.lastUpdated
+                    for entry in reversed(thisRank.rankHistory): #find the start of album's reject period
+                        if entry[0] == -1:
+                            start = entry[1]
+                        else:
+                            break
+                    self.rejected[album.idNo] = start
+                    self.rejections.append((start, album.idNo))
+        self.rejections.sort(key=lambda event : dateOrdinal(event[0]))
+    def inheritIndex(self, oldChart): #a rescan replaces the chart object, but its history carries on
+        oldChart.ensureIndex()
+        self.members = set(oldChart.members)
+        self.rejected = dict(oldChart.rejected)
+        self.rejections = list(oldChart.rejections)
     def resize(self, newSize):
-        log.debug("Resizing {name} to {size}".format(name=self.name, size=newSize))
+        log.debug("Resizing %s to %s", self.name, newSize)
         oldEntries = self.entries.copy()
         oldLen = len(self.entries)
         if newSize >= oldLen:
             tail = [None] * (newSize - oldLen)
             if not (len(tail) == 0):
-                self.entries.append(tail)
-            log.debug("Expanded entries from {old} to {new}".format(old=oldLen, new=newSize))
+                self.entries.extend(tail)
+            log.debug("Expanded entries from %s to %s", oldLen, newSize)
         else:
             end = newSize - oldLen
             self.entries = self.entries[:end]
-            log.debug("Truncated entries from {old} to {new}".format(old=oldLen, new=newSize))
+            log.debug("Truncated entries from %s to %s", oldLen, newSize)
         self.size = newSize
         return oldEntries
     def addAlbum(self, albumID, rank):
+        changedCharts.add(self.name)
+        if self.entries[rank - 1] != albumID:
+            self.markRow(rank - 1)
         self.entries[rank - 1] = albumID#rank starts at 1, so we adjust to get the proper 0 indexing
         albumLib[albumID].addRanking(self.name, rank, self.date)
-    def writeChart(self, sheet, profileIDs = ["Listened?"]):
-        log.info("Writing chart {name} to sheet {sname} with profiles {pf}".format(name=self.name, sname=sheet.title, pf=str(profileIDs)))
-        headerFont = Font('Times New Roman', 11, True, underline='single')
-        heading = ['Artist', 'Album', 'Year', 'PA Genre', 'PA Rating', '# of Ratings', 'Album Length', 'Country'] + profileIDs + [ 'On Spotify?', 'Bought?', 'In Library?', 'House Listened?']
-        log.debug(str(heading))
-        for i in range(len(heading)):
-            addr = str(get_column_letter(i + 1))+'1'
-            sheet[addr] = heading[i]
-            sheet[addr].font = headerFont
-        plainFont = Font('Times New Roman', 11)
+        self.ensureIndex()
+        self.members.add(albumID)
+        self.rejected.pop(albumID, None) #back on the chart
+    def rejectAlbum(self, albumID, dateStr):
+        changedCharts.add(self.name)
+        albumLib[albumID].addRanking(self.name, -1, dateStr)
+        self.ensureIndex()
+        self.members.add(albumID)
+        if albumID not in self.rejected.keys():
+            self.rejected[albumID] = dateStr
+            self.rejections.append((dateStr, albumID))
+    #albums that fell off the chart on or after dateStr and haven't come back
+    def rejectedSince(self, dateStr):
+        self.ensureIndex()
+        since = dateOrdinal(dateStr)
+        albums = []
+        for rejDate, albumID in reversed(self.rejections):
+            if dateOrdinal(rejDate) < since:
+                break
+            if self.rejected.get(albumID) == rejDate:
+                albums.append(albumID)
+        albums.reverse()
+        return albums
+    #Charts pickled before change tracking have no dirty rows to go on, so their next write does everything
+    def markRow(self, index, fields=ROW_FIELDS):
+        dirty = getattr(self, 'dirty', None)
+        if dirty is not None:
+            dirty.setdefault(index, set()).update(fields)
+            changedCharts.add(self.name)
+    #The sheet still holds our last write of this chart, so only the dirty rows need rewriting. The sheet
+    #has to have been read from the same file we last saved the chart to, a sheet from anywhere else
+    #(or from a file we weren't told about) could be older than the dirty rows and gets a full write
+    def canPatch(self, sheet, heading, filename):
+        written = getattr(self, 'written', None)
+        if self.isRejectChart or getattr(self, 'dirty', None) is None or written is None or len(written) != 4 or filename is None:
+            return False
+        oldFile, title, oldHeading, oldRows = written
+        if (oldFile, title, oldHeading) != (os.path.realpath(filename), sheet.title, tuple(heading)) or sheet.max_row != oldRows + 1:
+            return False
+        return [cell.value for cell in sheet[1][:len(heading)]] == heading
+    def isStale(self, sheet, profileIDs, filename): #whether writing the chart to sheet would change anything
+        return not self.canPatch(sheet, self.headingFor(profileIDs), filename) or len(self.dirty) > 0 or self.written[3] != self.size
+    def headingFor(self, profileIDs):
+        return ['Artist', 'Album', 'Year', 'PA Genre', 'PA Rating', '# of Ratings', 'Album Length', 'Country'] + profileIDs + [ 'On Spotify?', 'Bought?', 'In Library?', 'House Listened?']
+    #Every row of the sheet as a list of (value, hyperlink, style) cells. Reject charts get a date row per section
+    def renderRows(self, profileIDs):
+        width = len(self.headingFor(profileIDs))
         if self.isRejectChart:
-            log.info("Chart is a reject chart")
-            rowCount = 2
             readCount = 0
-            for rejSection in tqdm.tqdm(self.rejSections, total=len(self.rejSections), unit="Reject Section"):
-                date = rejSection[0]
-                albumCount = rejSection[1]
-                sheet['A'+str(rowCount)] = date
-                rowCount += 1
-                with tqdm.tqdm(total=albumCount, position=1, bar_format='{desc}', desc='writeChart: Writing section {d}'.format(d=date)) as desc:
-                    for i in tqdm.tqdm(range(albumCount), total=albumCount, unit="album", position=0):
-                        a = albumLib[self.entries[readCount + i]]
-                        r = str(rowCount)
-                        sheet['A'+r].font = plainFont
-                        sheet['A'+r]  = a.artist
-                        sheet['A'+r].hyperlink = a.links.artistLink
-                        sheet['B'+r].font = plainFont
-                        sheet['B'+r]  = a.title
-                        sheet['B'+r].hyperlink = a.links.albumLink
-                        sheet['C'+r].font = plainFont
-                        sheet['C'+r]  = a.year
-                        sheet['D'+r].font = plainFont
-                        sheet['D'+r]  = a.genre
-                        sheet['E'+r].font = plainFont
-                        sheet['E'+r]  = a.rating
-                        sheet['F'+r].font = plainFont
-                        sheet['F'+r]  = a.noRatings
-                        sheet['G'+r].font = plainFont
-                        sheet['G'+r]  = a.duration
-                        sheet['H'+r].font = plainFont
-                        sheet['H'+r]  = a.country
-                        sheet['I'+r].font = plainFont
-                        desc.set_description("writeChart: Section {d}: writing {a} by {ar} onto row {r}".format(d=date, a=a.title, ar=a.artist, r=r))
-                        for j in range(len(profileIDs)):
-                            listener_col = get_column_letter(9 + j) + r
-                            thisAlbum = albumLib[a.idNo]
-                            thisProfile = profileIDs[j]
-                            if thisProfile in thisAlbum.profiles.keys():
-                                sheet[listener_col] = thisAlbum.profiles[thisProfile] #yes, no, or ?
-                            else:
-                                sheet[listener_col] = "?"
-                            sheet[listener_col].font = plainFont
-                        offset = 9 + len(profileIDs)
-                        next_col = get_column_letter(offset)
-                        sheet[next_col+r].font = plainFont
-                        if a.links.onSpotify:
-                            sheet[next_col+r] = 'Yes'
-                            sheet[next_col+r].hyperlink = a.links.spotifyLink
-                            sheet[next_col+r].style='Hyperlink'
-                        else:
-                            sheet[next_col+r] = 'No'
-                        sheet[next_col+r].font = plainFont
-                        next_col = get_column_letter(offset + 1)
-                        sheet[next_col+r].font = plainFont
-                        sheet[next_col+r] = 'Yes' if a.bought == "Yes" else 'No'
-                        next_col = get_column_letter(offset + 2)
-                        sheet[next_col+r].font = plainFont
-                        sheet[next_col+r] = 'Yes' if a.links.inLibrary == "Yes" else 'No'
-                        next_col = get_column_letter(offset + 3)
-                        sheet[next_col +r].font = plainFont
-                        sheet[next_col +r] = 'Yes' if a.houseListened == "Yes" else 'No'
-                        rowCount += 1
-                    desc.set_description("writeChart: Completed writing chart {name} with {noAlbums} albums".format(name=self.name, noAlbums=self.size))
-            return 
+            for date, albumCount in self.rejSections:
+                yield [(date, None, None)] + [(None, None, None)] * (width - 1)
+                for i in range(albumCount):
+                    yield renderAlbum(albumLib[self.entries[readCount + i]], profileIDs)
+                readCount += albumCount
         else:
-            with tqdm.tqdm(total=len(self.entries), position=1, bar_format='{desc}', desc='writeChart: Beginning process') as desc:
-                for row in tqdm.tqdm(range(len(self.entries))):
-                    a = albumLib[self.entries[row]]
-                    r = str(row+2)
-                    sheet['A'+r].font = plainFont
-                    sheet['A'+r]  = a.artist
-                    sheet['A'+r].hyperlink = a.links.artistLink
-                    sheet['B'+r].font = plainFont
-                    sheet['B'+r]  = a.title
-                    sheet['B'+r].hyperlink = a.links.albumLink
-                    sheet['C'+r].font = plainFont
-                    sheet['C'+r]  = a.year
-                    sheet['D'+r].font = plainFont
-                    sheet['D'+r]  = a.genre
-                    sheet['E'+r].font = plainFont
-                    sheet['E'+r]  = a.rating
-                    sheet['F'+r].font = plainFont
-                    sheet['F'+r]  = a.noRatings
-                    sheet['G'+r].font = plainFont
-                    sheet['G'+r]  = a.duration
-                    sheet['H'+r].font = plainFont
-                    sheet['H'+r]  = a.country
-                    sheet['I'+r].font = plainFont
-                    desc.set_description("writeChart: Writing {a} by {ar} to row {r}".format(a=a.title,ar=a.artist,r=r))
-                    for i in range(len(profileIDs)):
-                        listener_col = get_column_letter(9 + i) + r
-                        thisAlbum = albumLib[a.idNo]
-                        thisProfile = profileIDs[i]
-                        if thisProfile in thisAlbum.profiles.keys():
-                            sheet[listener_col] = thisAlbum.profiles[thisProfile] #yes, no, or ?
-                        else:
-                            sheet[listener_col] = "?"
-                        sheet[listener_col].font = plainFont
-                    offset = 9 + len(profileIDs)
-                    next_col = get_column_letter(offset)
-                    sheet[next_col+r].font = plainFont
-                    if a.links.onSpotify:
-                        sheet[next_col+r] = 'Yes'
-                        sheet[next_col+r].hyperlink = a.links.spotifyLink
-                        sheet[next_col+r].style='Hyperlink'
-                    else:
-                        sheet[next_col+r] = 'No'
-                    sheet[next_col+r].font = plainFont
-                    next_col = get_column_letter(offset + 1)
-                    sheet[next_col+r].font = plainFont
-                    sheet[next_col+r] = 'Yes' if a.bought == "Yes" else 'No'
-                    next_col = get_column_letter(offset + 2)
-                    sheet[next_col+r].font = plainFont
-                    sheet[next_col+r] = 'Yes' if a.links.inLibrary == "Yes" else 'No'
-                    next_col = get_column_letter(offset + 3)
-                    sheet[next_col +r].font = plainFont
-                    sheet[next_col +r] = 'Yes' if a.houseListened == "Yes" else 'No'
-                desc.set_description("writeChart: Completed writing chart {name} with {noAlbums} albums".format(name=self.name, noAlbums=self.size))
-        return 
+            for albumID in self.entries:
+                yield renderAlbum(albumLib[albumID], profileIDs)
+    #Renders the chart in one row oriented pass. Column widths are worked out as the rows go by instead of
+    #walking the finished sheet again. Write only sheets (from newChartBook) get streamed out with shared
+    #styles, while a sheet in an existing workbook gets its cells overwritten in place. If that sheet is
+    #the one we last wrote the chart to, only the cells of dirty rows are rewritten (full turns this off).
+    #filename is the workbook the sheet was read from and saveAs where it's going, if that's somewhere else
+    @timedStage('render')
+    def writeChart(self, sheet, profileIDs = ["Listened?"], full=False, filename=None, saveAs=None):
+        log.info("Writing chart %s to sheet %s with profiles %s", self.name, sheet.title, profileIDs)
+        heading = self.headingFor(profileIDs)
+        log.debug("%s", heading)
+        widths = [0] * len(heading)
+        styles = {}
+        rowCount = self.size + (len(self.rejSections) if self.isRejectChart else 0)
+        if sheet.parent.write_only:
+            #write only sheets need their widths and panes before the first row goes out, so render to memory first
+            rows = [[(h, None, 'header') for h in heading]]
+            for row in progress(self.renderRows(profileIDs), total=rowCount, unit="album", desc="writeChart: Rendering"):
+                measureRow(row, widths)
+                rows.append(row)
+            measureRow(rows[0], widths)
+            setWidths(sheet, widths)
+            sheet.freeze_panes = 'C2'
+            from openpyxl.cell import WriteOnlyCell
+            for row in rows:
+                cells = []
+                for value, link, style in row:
+                    cell = WriteOnlyCell(sheet, value=value)
+                    styleCell(cell, link, style, styles)
+                    cells.append(cell)
+                sheet.append(cells)
+        elif not full and self.canPatch(sheet, heading, filename):
+            log.info("Rewriting %s changed rows of %s", len(self.dirty), self.name)
+            for index in progress(sorted(self.dirty), unit="album", desc="writeChart: Patching"):
+                if index >= self.size: #fell off the end, goes with the rows below
+                    continue
+                row = renderAlbum(albumLib[self.entries[index]], profileIDs)
+                for c in fieldColumns(self.dirty[index], len(profileIDs)):
+                    value, link, style = row[c]
+                    putCell(sheet, index + 2, c + 1, value, link, style, styles)
+                measureRow(row, widths)
+            if sheet.max_row > self.size + 1:
+                sheet.delete_rows(self.size + 2, sheet.max_row - self.size - 1)
+            setWidths(sheet, widths, widenOnly=True) #the rows we skipped still need their old widths
+        else:
+            sheet.freeze_panes = sheet['C2']
+            r = 1
+            for row in itertools.chain([[(h, None, 'header') for h in heading]], progress(self.renderRows(profileIDs), total=rowCount, unit="album", desc="writeChart: Writing")):
+                measureRow(row, widths)
+                for c in range(len(row)):
+                    value, link, style = row[c]
+                    putCell(sheet, r, c + 1, value, link, style, styles)
+                r += 1
+            if sheet.max_row >= r: #the chart shrank, clear out what's left of the old one
+                sheet.delete_rows(r, sheet.max_row - r + 1)
+            setWidths(sheet, widths)
+        self.dirty = {}
+        saveAs = saveAs or filename
+        self.written = (os.path.realpath(saveAs) if saveAs else None, sheet.title, tuple(heading), rowCount)
+        log.info("Completed writing chart %s with %s albums", self.name, self.size)
+        return
+
+#Shared fonts for every sheet we write, built on first use so openpyxl isn't needed to start up
+@functools.lru_cache(maxsize=None)
+def cellFont(style):
+    from openpyxl.styles import Font
+    if style == 'header':
+        return Font('Times New Roman', 11, True, underline='single')
+    return Font('Times New Roman', 11)
+WIDTH_SCALE = 1.23
+def renderAlbum(a, profileIDs):
+    row = [(a.artist, a.links.artistLink, 'plain'),
+           (a.title, a.links.albumLink, 'plain'),
+           (a.year, None, 'plain'),
+           (a.genre, None, 'plain'),
+           (a.rating, None, 'plain'),
+           (a.noRatings, None, 'plain'),
+           (formatDuration(a.duration), None, 'plain'),
+           (a.country, None, 'plain')]
+    for profile in profileIDs:
+        row.append((a.profiles[profile] if profile in a.profiles.keys() else "?", None, 'plain')) #yes, no, or ?
+    if a.links.onSpotify:
+        row.append(('Yes', a.links.spotifyLink, 'spotify'))
+    else:
+        row.append(('No', None, 'plain'))
+    row.append(('Yes' if a.bought == "Yes" else 'No', None, 'plain'))
+    row.append(('Yes' if a.links.inLibrary in (True, "Yes") else 'No', None, 'plain'))
+    row.append(('Yes' if a.houseListened == "Yes" else 'No', None, 'plain'))
+    return row
+#Overwrites a cell of an existing sheet. Cells that used to be links (a Spotify Yes that's now No) lose them
+def putCell(sheet, row, column, value, link, style, styles):
+    cell = sheet.cell(row=row, column=column, value=value)
+    if not link and cell.hyperlink is not None:
+        cell.hyperlink = None
+    styleCell(cell, link, style, styles)
+#Styles a cell. The first cell of each kind is styled the normal way and every cell after that
+#just copies its style array, which saves openpyxl looking the font up again for every cell
+def styleCell(cell, link, style, styles):
+    if link:
+        cell.hyperlink = link
+    if style is None:
+        return
+    if style in styles.keys():
+        cell._style = copy.copy(styles[style])
+        return
+    if style == 'header':
+        cell.font = cellFont('header')
+    elif style == 'spotify':
+        cell.style = 'Hyperlink'
+        cell.font = cellFont('plain')
+    else:
+        cell.font = cellFont('plain')
+    styles[style] = copy.copy(cell._style)
+def measureRow(row, widths):
+    for c in range(len(row)):
+        value = row[c][0]
+        if value:
+            widths[c] = max(widths[c], len(str(value)))
+def setWidths(sheet, widths, widenOnly=False):
+    from openpyxl.utils import get_column_letter
+    for c in range(len(widths)):
+        if widths[c] > 0:
+            dimension = sheet.column_dimensions[get_column_letter(c + 1)]
+            if not widenOnly or (dimension.width or 0) < widths[c] * WIDTH_SCALE:
+                dimension.width = widths[c] * WIDTH_SCALE
+#New workbook holding a single write only sheet for a chart
+def newChartBook(chartname):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet(chartname)
+    return wb, sheet
+#Workbook loads and saves are the slow part of reading and writing, so they get their own stage timings
+@timedStage('read')
+def loadWorkbook(filename, readOnly=False):
+    from openpyxl import load_workbook
+    return load_workbook(filename, read_only=readOnly)
+@timedStage('render')
+def saveWorkbook(wb, filename):
+    wb.save(filename)
+#Hands back the workbook and sheet a chart should be written into. A file that doesn't exist yet
+#gets a write only workbook, otherwise the chart's sheet is reused (or a fresh one added with new)
+def openChartSheet(filename, chartname, new=False):
+    if not os.path.isfile(filename):
+        return newChartBook(chartname)
+    wb = loadWorkbook(filename)
+    if new or chartname not in wb.sheetnames:
+        sheet = wb.create_sheet(chartname)
+    else:
+        sheet = wb[chartname]
+    return wb, sheet
 
-def getRejectChart(chartname):
-    global date #I actually have no idea why it doesn't have date inhereited
-    log.info("Creating reject chart for {name}".format(name=chartname))
+def getRejectChart(chartname, since=None):
+    log.info("Creating reject chart for %s", chartname)
     dateStr = date.today().strftime("w%m/%d/%Y")
     rejChartName = chartname + " REJECT"
-    log.info("New reject chart name: {name}".format(name=rejChartName))
+    log.info("New reject chart name: %s", rejChartName)
     if chartname in chartLib.keys():
+        chart = chartLib[chartname]
+        chart.ensureIndex()
+        if since is None:
+            rejectIDs = list(chart.rejected.keys())
+        else:
+            log.info("Only using albums rejected since %s", since)
+            rejectIDs = chart.rejectedSince(since)
         dates = {}
-        rejCount = 0
-        with tqdm.tqdm(total=len(albumLib.values()), position=1, bar_format='{desc}', desc='getRejectChart: Beginning process') as desc:
-            for album in tqdm.tqdm(albumLib.values(), position=0, unit="album", total=len(albumLib.values())): #brute force I'm afraid
-                if chartname in album.rank.keys():
-                    log.debug("Found album {a} with history in {c}".format(a=album.title, c=chartname))
-                    desc.set_description("getRejectChart: found album {a} with history in {c}".format(a=album.title, c=chartname))
-                    thisRank = album.rank[chartname]
-                    if thisRank.ranking == -1:
-                        desc.set_description("getRejectChart: album {a} was rejected from {c}".format(a=album.title, c=chartname))
-                        rejCount += 1
-                        hist = reversed(thisRank.rankHistory)
-                        prev = thisRank.lastUpdated
-                        for entry in hist: #find the start of album's reject period
-                            if entry[0] == -1: 
-                                prev = entry[1] 
-                            else:
-                                break
-                        desc.set_description("getRejectChart: album {a} was first rejected on {d}".format(a=album.title, d=prev))
-                        if prev not in dates.keys():
-                            log.info("Adding new reject section for date {d}".format(d=prev))
-                            dates[prev] = [album]
-                        else:
-                            log.info("Appending album to date {d}".format(d=prev))
-                            dates[prev].append(album)
+        for albumID in rejectIDs:
+            rejDate = chart.rejected[albumID]
+            log.debug("Album %s was first rejected on %s", albumLib[albumID].title, rejDate)
+            if rejDate not in dates.keys():
+                log.info("Adding new reject section for date %s", rejDate)
+                dates[rejDate] = [albumLib[albumID]]
+            else:
+                dates[rejDate].append(albumLib[albumID])
         log.info("Finished finding rejects")
-        datelist = sorted(dates.keys(), key= lambda dstr : dstr[6:10]+'/'+dstr[3:5]+'/'+dstr[0:2])
-        #Sorts dates in oneliner fashion
+        datelist = sorted(dates.keys(), key=dateOrdinal)
         i = 1
         rejSections = []
-        for date in datelist:
-            noRejs = len(dates[date])
-            log.debug("Rejected {n} albums from {c} on {d}".format(n=noRejs, c=chartname, d=date))
-            rejSections.append((date, noRejs))
-        rejChart = Chart(rejChartName, rejCount, "REJECT",dateStr)
+        for rejDate in datelist:
+            noRejs = len(dates[rejDate])
+            log.debug("Rejected %s albums from %s on %s", noRejs, chartname, rejDate)
+            rejSections.append((rejDate, noRejs))
+        rejChart = Chart(rejChartName, len(rejectIDs), "REJECT",dateStr)
         rejChart.rejSections = rejSections
         #Rank is NOT guaranteed to be consistent with their original placement
         log.info("Writing albums to reject chart in order by date")
-        for date in datelist:
-            for album in dates[date]:
+        for rejDate in datelist:
+            for album in dates[rejDate]:
                 rejChart.addAlbum(album.idNo, i)
                 i += 1
         return rejChart
     else:
         print("ERROR: COULD NOT FIND CHART")
+#Dates are stored as mm/dd/yyyy strings (reject charts stick a w on the front)
+def dateOrdinal(dateStr):
+    return datetime.strptime(dateStr.lstrip('w'), "%m/%d/%Y").toordinal()
+def dateArgument(text): #argparse type for dates given on the command line, kept as the string the libraries use
+    try:
+        dateOrdinal(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError("{t} is not a date like 01/31/2024 (mm/dd/yyyy)".format(t=text))
+    return text
+def dateString(ordinal): #inverse of dateOrdinal, 0 means no date
+    if not ordinal:
+        return ""
+    return date.fromordinal(ordinal).strftime("%m/%d/%Y")
 def getTimestamp(albumLink):
-    log.debug("Requesting {l}".format(l=albumLink))
-    albPage = requests.get(albumLink)
-    log.debug("Status code: {c}".format(c=albPage.status_code))
-    albInfo = html.fromstring(albPage.content)
+    return parseTimestamp(fetcher.get(albumLink))
+#Pulls the total album length out of an album page
+@timedStage('parse')
+def parseTimestamp(content):
+    from lxml import html
+    albInfo = html.fromstring(content)
     trList = albInfo.xpath("/html/body/div[2]/div[2]/div/div[2]/table/tr/td[2]/p[1]/text()")
-    durationRE = re.compile(r"total(?:[\ ]|[\ ]\w+[\ ])time.*", re.IGNORECASE)
-    temp = []
-    timestampRE =re.compile(r"\d{2,3}\:\d{2}")
-    for j in trList:
-        temp = temp + re.findall(durationRE, j)
-    if len(temp) == 1:
-        log.debug("Found {t} timestamp, using it".format(t=len(temp)))
-        timestamp = re.search(timestampRE, temp[0])
-        if timestamp:
-            timestamp = timestamp.group(0)
-    elif len(temp) == 2:
-        log.debug("Found {t} timestamps, adding them together".format(t=len(temp)))
-        ts1 = re.search(timestampRE, temp[0]).group(0)
-        ts2 = re.search(timestampRE, temp[1])
-        if ts2:
-            ts2 = ts2.group(0)
-            timestamp = addTimes(ts1, ts2)
-        else:
-            timestamp = ts1
-    else:
-        log.debug("No clear timestamps found, manually calculating")
+    totals = []
+    for line in trList:
+        totals += TOTAL_TIME_RE.findall(line)
+    seconds = 0
+    if len(totals) in (1, 2): #one total, or one per disc
+        log.debug("Found %s total times, adding them together", len(totals))
+        for total in totals:
+            seconds += sum(durationsIn(total)[:1])
+    if not seconds:
+        log.debug("No clear total time found, adding up the tracks")
         #trackTimeRE = re.compile(r"(?<=\d\.).*(\d{2}\:\d{2})|(?<=\d\.).*(\d{1}\:\d{2})")
         #I miss this regex. I put a lot of time into it. But it doesn't practically work. Rip
-        trackTimeRE = re.compile(r"\d{1,2}\:\d{2}")
-        accTime = "0:00"
         for track in trList:
-            trLen = re.findall(trackTimeRE, track)
-            if len(trLen) > 0:
-                for ts in trLen:
-                    accTime = addTimes(accTime, ts)
-        if accTime == "0:00":
-            accTime = "Unknown"
-        timestamp = accTime
-    log.info("Found timestamp: {t}".format(t=timestamp))
-    return timestamp
-def readChart(chartsheet, chartname, listeners, overwrite=False):
-    log.info("Reading chart {name}.".format(name=chartname))
-    #chartbook = load_workbook(filename)
-    #chartsheet = chartbook[chartname]
+            seconds += sum(durationsIn(track))
+    log.info("Found timestamp: %s", formatDuration(seconds or None))
+    return seconds or None
+artistRequests = {} #artist id -> future, so an unknown artist is only fetched once even if it's on the chart 5 times
+#Hands back a future for the Artist behind an artist link. Known artists come straight out of artistLib,
+#anything else is fetched once on the pool and then stored in artistLib for every later album, chart and run
+def requestArtist(artistLink):
+    artistID = re.search(albumIdRE, artistLink).group(0)
+    with fetcher.lock:
+        if artistID not in artistLib.keys() and artistID not in artistRequests.keys():
+            log.debug("Artist %s not in library, queueing a fetch", artistID)
+            artistRequests[artistID] = fetcher.submit(fetchArtist, artistID, artistLink)
+        if artistID in artistRequests.keys():
+            return artistRequests[artistID]
+        known = Future()
+        known.set_result(artistLib[artistID])
+        return known
+#An error reply raises (see Fetcher.get), and an artist whose page had no header is used for this
+#album but not kept, so either way the artist is fetched again the next time it is needed
+def fetchArtist(artistID, artistLink):
+    try:
+        artist = Artist(artistID, artistLink)
+        if artist.readHeader(fetcher.get(artistLink)):
+            with fetcher.lock:
+                artistLib[artistID] = artist
+        return artist
+    finally: #a failed fetch isn't remembered either, the next request for the artist tries again
+        with fetcher.lock:
+            artistRequests.pop(artistID, None)
+def getArtist(artistLink):
+    return requestArtist(artistLink).result()
+#Read only workbooks don't hand out hyperlinks, so pull them straight out of the sheet's xml instead
+#Streams the sheet and only keeps the hyperlink elements, returns {(row, column) : target}
+#The links can't be streamed alongside the rows: a sheet's <hyperlinks> come after all of its <sheetData>,
+#so they are all held at once. That is up to 3 short strings per row, far less than the cells themselves
+OOXML_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+OOXML_REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+@timedStage('read')
+def readHyperlinks(filename, sheetname):
+    from openpyxl.utils.cell import coordinate_to_tuple
+    links = {}
+    with zipfile.ZipFile(filename) as book:
+        workbookXML = ElementTree.fromstring(book.read('xl/workbook.xml'))
+        sheetRel = None
+        for sheet in workbookXML.iter(OOXML_NS + 'sheet'):
+            if sheet.get('name') == sheetname:
+                sheetRel = sheet.get(OOXML_REL_NS + 'id')
+        workbookRels = ElementTree.fromstring(book.read('xl/_rels/workbook.xml.rels'))
+        sheetPath = None
+        for rel in workbookRels.iter(PKG_REL_NS + 'Relationship'):
+            if rel.get('Id') == sheetRel:
+                sheetPath = posixpath.normpath(posixpath.join('xl', rel.get('Target'))).lstrip('/')
+        if sheetPath is None:
+            log.error("Could not find sheet %s in %s", sheetname, filename)
+            return links
+        relsPath = posixpath.join(posixpath.dirname(sheetPath), '_rels', posixpath.basename(sheetPath) + '.rels')
+        targets = {}
+        if relsPath in book.namelist():
+            for rel in ElementTree.fromstring(book.read(relsPath)).iter(PKG_REL_NS + 'Relationship'):
+                targets[rel.get('Id')] = rel.get('Target')
+        with book.open(sheetPath) as sheetXML:
+            for event, elem in ElementTree.iterparse(sheetXML):
+                if elem.tag == OOXML_NS + 'hyperlink':
+                    target = targets.get(elem.get(OOXML_REL_NS + 'id'), elem.get('location'))
+                    ref = elem.get('ref').split(':')[0]
+                    links[coordinate_to_tuple(ref)] = target
+                elif elem.tag == OOXML_NS + 'row':
+                    elem.clear() #we don't need the cells, don't let them pile up
+    log.debug("Found %s hyperlinks on %s", len(links), sheetname)
+    return links
+@timedStage('read')
+def readChart(chartsheet, chartname, listeners, overwrite=False, links=None):
+    #chartsheet is expected to come from a read only workbook, so this is one streaming pass over the rows
+    #read only cells don't carry hyperlinks, links is the (row, column) -> target map from readHyperlinks
+    links = links or {}
+    log.info("Reading chart %s.", chartname)
     i = 1
-    max_row=len([row for row in chartsheet if not all([cell.value is None for cell in row])]) 
-    with tqdm.tqdm(total=max_row, position=1, bar_format='{desc}', desc='readChart: Beginning process') as desc:
-        for row in tqdm.tqdm(chartsheet.iter_rows(),total=max_row, unit="album", position=0):#for every row
-            if i == 1:
-                i += 1
-                pass
+    max_row = chartsheet.max_row
+    width = 12 + len(listeners)
+    with progress(total=max_row, position=1, bar_format='{desc}', desc='readChart: Beginning process') as desc:
+        for values in progress(chartsheet.iter_rows(min_row=2, values_only=True),total=max_row, unit="album", position=0):#for every row
+            i += 1
+            if all([value is None for value in values]):
+                break
+            albumLink = links.get((i, 2))
+            if albumLink is None: #reject charts have a date row for each section
+                log.debug("Row %s has no album link, skipping it", i)
+                continue
+            row = list(values) + [None] * (width - len(values))
+            log.info("Reading row %s", i)
+            artist = str(row[0])
+            artistLink = str(links.get((i, 1)))
+            albumName = str(row[1])
+            year = str(row[2])
+            genre = str(row[3])
+            rating = str(row[4])
+            noRatings = str(row[5])
+            duration = parseDuration(row[6])
+            country =  str(row[7])
+            log.debug("Found %s - %s", artist, albumName)
+            desc.set_description("readChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artist))
+            listenInfo = [None]*len(listeners)
+            nextCol = 8
+            for j in range(len(listeners)):
+                listenInfo[j] = str(row[nextCol])
+                nextCol = nextCol + 1
+            log.debug("Found listen values %s", listenInfo)
+            onSpotify = str(row[nextCol])
+            if onSpotify == "Yes":
+                onSpotify = True
+                spLink = str(links.get((i, nextCol + 1), ""))
             else:
-                if i > max_row:
-                    break
-                log.info("Reading row {rownum}".format(rownum=i))
-                artist = str(row[0].value)
-                artistLink = str(row[0].hyperlink.target)
-                albumLink = str(row[1].hyperlink.target)
-                albumName = str(row[1].value)
-                year = str(row[2].value)
-                genre = str(row[3].value)
-                rating = str(row[4].value)
-                noRatings = str(row[5].value)
-                duration = str(row[6].value)
-                country =  str(row[7].value)
-                log.debug("Found {artist} - {album}".format(artist=artist, album=albumName))
-                desc.set_description("readChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artist))
-                listenInfo = [None]*len(listeners)
-                nextCol = 8
-                for j in range(len(listeners)):
-                    listenInfo[j] = str(row[nextCol].value)
-                    nextCol = nextCol + 1
-                log.debug("Found listen values {vals}".format(vals=str(listenInfo)))
-                onSpotify = str(row[nextCol].value)
-                if onSpotify == "Yes":
-                    onSpotify = True
-                    spLink = str(row[nextCol].hyperlink.target)
-                else:
-                    onSpotify = False
-                    spLink = ""
-                bought = str(row[nextCol + 1].value)
-                inLibrary = str(row[nextCol + 2].value)
-                houseListened = str(row[nextCol + 3].value)
-                getID = re.compile(r"(?<=\?id\=).*")
-                gettingID = re.search(getID, albumLink)
-                albumID= gettingID.group(0)
-                if albumID in albumLib.keys():
-                    desc.set_description("readChart: Processing {albumName} by {artist} | Album found in library, syncing.".format(albumName=albumName, artist=artist))
-                    log.info("Found albumID in library")
-                    log.debug("Album ID: {albumID}".format(albumID=albumID))
-                    album = albumLib[albumID]
-                    album.syncListened(listenInfo.copy(), listeners)
-                    album.bought = bought
-                    album.links.inLibrary=inLibrary
-                    album.houseListened=houseListened
-                    if overwrite:
-                        log.info("Overwriting spotify info")
-                        if onSpotify:
-                            album.links.onSpotify = True
-                            album.links.spotifyLink = spLink
-                        else:
-                            album.links.onSpotify = False
-                            album.links.spotifyLink = ""
-                        log.debug("OnSpotfify: {spstatus}, link: {spLink}".format(spstatus=onSpotify, spLink = spLink))
-                        log.debug("Duration: {dur}".format(dur=duration))
-                        album.duration = duration
-                    album = albumLib[albumID]
-                    i += 1
-                else:
-                    #NEED NEW REGEXES
-                    #desc.set_description("readChart: Processing %s by %s | Album not in library, fetching info" % (artist, albumName))
-                    desc.set_description("readChart: Processing {albumName} by {artist} | Album not in library, fetching info.".format(albumName=albumName, artist=artist))
-                    log.info("albumID not found in library")
-                    log.debug("Album ID: {albumID}".format(albumID=albumID))
-                    album = Album(albumID, albumName, artist, year)
-                    album.links.albumLink = albumLink
-                    album.links.artistLink = artistLink
-                    log.debug("Requesting {link}".format(link=albumLink))
-                    apage = requests.get(albumLink)
-                    log.debug("Status code: {code}".format(code=apage.status_code))
-                    acont = apage.content
-                    ahtml = html.fromstring(acont)
-                    rating = ahtml.xpath('//*[@id="avgRatings_1"]/text()')[0]
-                    noRatings = ahtml.xpath('//*[@id="nbRatings_1"]/text()')[0]
-                    #desc.set_description("readChart: Processing %s by %s | Album not in library, syncing info" % (artist, albumName))
-                    desc.set_description("readChart: Processing {albumName} by {artist} | Album not in library, syncing info.".format(albumName=albumName, artist=artist))
-                    album.rating = rating
-                    album.noRatings = noRatings
-                    album.genre = genre
-                    album.setListeningInfo(listenInfo.copy(), listeners)
-                    album.bought = bought
-                    album.links.inLibrary=inLibrary
-                    album.houseListened=houseListened
-                    album.duration = duration
-                    sleep(1) #Must sleep to avoid clogging the site
-                    log.debug("Requesting {link}".format(link=artistLink))
-                    artPage = requests.get(artistLink)
-                    log.debug("Status code: {sc}".format(sc=artPage.status_code))
-                    artInfo = html.fromstring(artPage.content)
-                    headerInfo = artInfo.xpath("/html/body/div[2]/div[2]/div/h2/text()")
-                    country = headerInfo[0].split(' • ')[1]
-                    album.country = country
-                    log.info("Retrieving Spotify status from API")
+                onSpotify = False
+                spLink = ""
+            bought = str(row[nextCol + 1])
+            inLibrary = str(row[nextCol + 2])
+            houseListened = str(row[nextCol + 3])
+            gettingID = re.search(albumIdRE, albumLink)
+            albumID= gettingID.group(0)
+            if albumID in albumLib.keys():
+                desc.set_description("readChart: Processing {albumName} by {artist} | Album found in library, syncing.".format(albumName=albumName, artist=artist))
+                log.info("Found albumID in library")
+                log.debug("Album ID: %s", albumID)
+                album = albumLib[albumID]
+                before = rowState(album)
+                album.syncListened(listenInfo.copy(), listeners)
+                album.bought = bought
+                album.links.inLibrary=inLibrary
+                album.houseListened=houseListened
+                if overwrite:
+                    log.info("Overwriting spotify info")
                     if onSpotify:
                         album.links.onSpotify = True
                         album.links.spotifyLink = spLink
                     else:
                         album.links.onSpotify = False
                         album.links.spotifyLink = ""
-                    log.debug("OnSpotify: {spstatus}, link: {spLink}".format(spstatus=onSpotify, spLink = spLink))
-                    log.debug("Duration: {dur}".format(dur=duration))
-                    albumLib[albumID] = album
-                    i += 1
-    log.info("Finished after reading {numrows} rows".format(numrows=str(i)))
+                    log.debug("OnSpotfify: %s, link: %s", onSpotify, spLink)
+                    log.debug("Duration: %s", duration)
+                    album.duration = duration
+                markAlbum(album, changedFields(before, rowState(album))) #other charts' sheets show this album too
+            else:
+                #NEED NEW REGEXES
+                #desc.set_description("readChart: Processing %s by %s | Album not in library, fetching info" % (artist, albumName))
+                desc.set_description("readChart: Processing {albumName} by {artist} | Album not in library, fetching info.".format(albumName=albumName, artist=artist))
+                log.info("albumID not found in library")
+                log.debug("Album ID: %s", albumID)
+                album = Album(albumID, albumName, artist, year)
+                album.links.albumLink = albumLink
+                album.links.artistLink = artistLink
+                content = fetcher.get(albumLink)
+                with timed('parse'):
+                    from lxml import html
+                    ahtml = html.fromstring(content)
+                    rating = ahtml.xpath('//*[@id="avgRatings_1"]/text()')[0]
+                    noRatings = ahtml.xpath('//*[@id="nbRatings_1"]/text()')[0]
+                #desc.set_description("readChart: Processing %s by %s | Album not in library, syncing info" % (artist, albumName))
+                desc.set_description("readChart: Processing {albumName} by {artist} | Album not in library, syncing info.".format(albumName=albumName, artist=artist))
+                album.rating = rating
+                album.noRatings = noRatings
+                album.genre = genre
+                album.setListeningInfo(listenInfo.copy(), listeners)
+                album.bought = bought
+                album.links.inLibrary=inLibrary
+                album.houseListened=houseListened
+                album.duration = duration
+                artist = getArtist(artistLink) #the fetcher's rate limit keeps us from clogging the site
+                album.artistID = artist.idNo
+                album.country = artist.country
+                log.info("Retrieving Spotify status from API")
+                if onSpotify:
+                    album.links.onSpotify = True
+                    album.links.spotifyLink = spLink
+                else:
+                    album.links.onSpotify = False
+                    album.links.spotifyLink = ""
+                log.debug("OnSpotify: %s, link: %s", onSpotify, spLink)
+                log.debug("Duration: %s", duration)
+                albumLib[albumID] = album
+    log.info("Finished after reading %s rows", i)
     return 
 
 
-def updateChart(name, spObj, listeners, newLink="", updateSpotify=True, updateDuration=True):
+#An update that fails part way through puts the chart and its rankings back the way they were, so saving
+#the libraries afterwards doesn't keep half an update. Albums it fetched stay, they are just newer.
+#The chart's next write does every cell, since other charts may have marked rows on it in the meantime
+def updateChart(name, *args, **kwargs):
+    with albumLock:
+        chart = chartLib.get(name)
+        saved = None if chart is None else snapshotChart(chart)
+    try:
+        return applyChartUpdate(name, *args, **kwargs)
+    except Exception:
+        if saved is not None:
+            log.warning("Rolling %s back to before the update", name)
+            with albumLock:
+                restoreChart(chart, saved)
+        raise
+def snapshotChart(chart): #call with albumLock held
+    chart.ensureIndex()
+    return copy.deepcopy(chart.__dict__), snapshotRankings(chart.name, chart.members)
+def restoreChart(chart, saved): #call with albumLock held
+    state, rankings = saved
+    touched = set(chart.members) #every album the update ranked or rejected
+    chart.__dict__.clear()
+    chart.__dict__.update(state)
+    chart.dirty = None
+    changedCharts.add(chart.name) #the __dict__ swap went around __setattr__
+    restoreRankings(chart.name, rankings, touched)
+def snapshotRankings(name, albumIDs): #album id -> a copy of its ranking on chart name (None if it has none)
+    return {albumID : copy.deepcopy(albumLib[albumID].rank.get(name)) for albumID in albumIDs if albumID in albumLib.keys()}
+def restoreRankings(name, rankings, touched): #puts the rankings of the touched albums back to the snapshot
+    for albumID in touched:
+        album = albumLib.get(albumID)
+        if album is None:
+            continue
+        if rankings.get(albumID) is not None:
+            album.enterRanking(rankings[albumID])
+        elif name in album.rank.keys():
+            album.deleteRanking(name)
+
+#incremental: only albums that are new to the chart, or whose title/artist/year changed, get their
+#album page and spotify status refetched (instead of every album, as updateSpotify/updateDuration do)
+#budget (a RequestBudget) caps the lookups queued for albums already in the library, see schedule
+def applyChartUpdate(name, spObj, listeners, newLink="", updateSpotify=True, updateDuration=True, incremental=False, quiet=False, budget=None):
     dateStr = date.today().strftime("%m/%d/%Y")
     if name not in chartLib.keys():
         print("Could not find chart!")
@@ -643,324 +1575,1126 @@ def updateChart(name, spObj, listeners, newLink="", updateSpotify=True, updateDu
         return
     if newLink == "":
         newLink = chart.link
-    log.info("Updating chart {name} with the listeners {listeners} from {link}".format(name=name, listeners=str(listeners), link=newLink))
-    log.debug("Requesting {link}".format(link=newLink))
-    reqChart = requests.get(newLink)
-    log.debug("Status code: {code}".format(code=reqChart.status_code))
-    parsed = html.fromstring(reqChart.content)
-    rawAlbums = parsed.xpath('/html/body/div[2]/div[2]/div[1]/table[1]/tr')
-    oldAlbums = set(chart.resize(len(rawAlbums))) #this explicitly resizes the referenced old chart, returns the old albums
+    log.info("Updating chart %s with the listeners %s from %s", name, listeners, newLink)
+    oldAlbums = set(chart.entries)
+    #fetch stage: queue up every page and spotify lookup the chart needs, the pool works through them while we process
+    #each row's lookups go out as soon as the row is parsed
+    rows = []
+    jobs = []
+    for row in getChartRows(newLink):
+        rows.append(row)
+        if row['id'] not in albumLib.keys():
+            if budget is not None: #the chart can't be written without it, so a new album is looked up even over budget
+                budget.take(SCHEDULE_ALBUM_MOST, force=True)
+            jobs.append(fetchRow(row, spObj, albumPage=True, artist=True, spotify=True))
+        elif incremental:
+            changed = row['id'] not in oldAlbums or rowChanged(albumLib[row['id']], row)
+            if changed and budget is not None and not budget.take(SCHEDULE_REFETCH_MOST):
+                log.info("Request budget spent, keeping what we have for %s", row['title'])
+                changed = False
+            jobs.append(fetchRow(row, spObj, albumPage=changed, spotify=changed))
+        else:
+            jobs.append(fetchRow(row, spObj, albumPage=updateDuration, spotify=updateSpotify))
+    chart.resize(len(rows)) #this explicitly resizes the referenced old chart
+    chart.date = dateStr #rankings made from here on are dated by this update, not the original scan
+    log.info("Fetching pages for %s of %s albums", sum(1 for job in jobs if job), len(rows))
     i = 0
-    with tqdm.tqdm(total=len(rawAlbums), position=1, bar_format='{desc}', desc='updateChart: Beginning process') as desc:
-        for albumTR in tqdm.tqdm(rawAlbums, position=0, unit="album", total=len(rawAlbums)):
+    with progress(total=len(rows), position=1, bar_format='{desc}', desc='updateChart: Beginning process', disable=quiet) as desc:
+        for row, job in progress(zip(rows, jobs), position=0, unit="album", total=len(rows), disable=quiet):
             i += 1
-            sleep(1)
-            albumLink = "http://www.progarchives.com/" + albumTR[3][0].attrib['href'] 
-            artistLink = "http://www.progarchives.com/" + albumTR[3][2].attrib['href']
-            getID = re.compile(r"(?<=\?id\=).*")
-            gettingID = re.search(getID, albumLink)
-            albumID= gettingID.group(0)
-            if albumID not in albumLib.keys():
-                log.info("AlbumID not found in library")
-                log.debug("AlbumID: {id}".format(id=albumID))
-                albumName = albumTR[3][0][0].text
-                artistName = albumTR[3][2].text
-                desc.set_description("updateChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artistName))
-                genre = albumTR[4][0].text
-                yrRE = re.compile(r"\d{4}")
-                yearDump = albumTR[4].text_content()
-                year = re.search(yrRE, yearDump).group(0)
-                albumRating = albumTR[2][2].text
-                noRatings = albumTR[2][3].text
-                #new album!!!
-                desc.set_description("updateChart: Processing {albumName} by {artist} | Creating new album entry".format(albumName=albumName, artist=artistName))
-                album = Album(albumID, albumName, artistName, year)
-                #set already fetched info
-                album.genre = genre
-                album.rating = albumRating
-                album.noRatings = noRatings
-                album.links.artistLink = artistLink
-                album.links.albumLink = albumLink
-                log.info("Setting listening info for {listeners}".format(listeners=listeners))
-                album.setListeningInfo(['?']*len(listeners), listeners)
-                if album.links.inLibrary == False:
-                    desc.set_description("updateChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
-                    album.links.findInLibrary()
-                desc.set_description("updateChart: Processing {albumName} by {artist} | Finding timestamp".format(albumName=albumName, artist=artistName))
-                album.duration = getTimestamp(albumLink)
-                log.debug("Requesting {link}".format(link=artistLink))
-                artPage = requests.get(artistLink)
-                log.debug("Status code: {sc}".format(sc=artPage.status_code))
-                artInfo = html.fromstring(artPage.content)
-                headerInfo = artInfo.xpath("/html/body/div[2]/div[2]/div/h2/text()")
-                country = headerInfo[0].split(' • ')[1]
-                album.country = country
-                desc.set_description("updateChart: Processing {albumName} by {artist} | Updating Spotify status".format(albumName=albumName, artist=artistName))
-                album.links.findSpotify(spObj)
-                albumLib[albumID] = album
-                chart.addAlbum(albumID, i)
-            else: #If the album has been logged before:
-                log.info("Album found in library!")
-                album = albumLib[albumID]
-                desc.set_description("updateChart: Processing {albumName} by {artist} | Updating album metadata".format(albumName=album.title, artist=album.artist))
-                prevRating = album.rating
-                album.rating = albumTR[2][2].text #new rating
-                log.debug("Previous rating: {pr}. Current rating: {r}".format(pr=prevRating, r=album.rating))
-                prevRatingCount = album.noRatings
-                log.debug("Previous # of ratings: {pr}. Current # of ratings: {r}".format(pr=prevRatingCount, r=album.noRatings))
-                album.noRatings = albumTR[2][3].text #new rating count
-                albumName = albumTR[3][0][0].text
-                if albumName != album.title:
-                    log.debug("Album name changed. Previously was {pt}, now is {t}".format(pt=album.title, t=albumName))
-                    album.title=albumName
-                artistName = albumTR[3][2].text
-                if artistName != album.artist:
-                    log.debug("Album artist changed. Previously was {pa}, now is {a}".format(pa=album.artist, a=artistName))
-                    album.title=albumName
-                genre = albumTR[4][0].text
-                if genre != album.genre:
-                    log.debug("Album genre changed. Previously was {pg}, now is {g}".format(pg=album.genre, g=genre))
-                    album.genre=genre
-                yrRE = re.compile(r"\d{4}")
-                yearDump = albumTR[4].text_content()
-                year = re.search(yrRE, yearDump).group(0)
-                if year != album.year:
-                    log.debug("Album year changed. Previously was {py}, now is {y}".format(py=album.year, y=year))
-                    album.year=year
-                if album.links.inLibrary == False:
-                    desc.set_description("updateChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
-                    album.links.findInLibrary()
-                if updateSpotify: #update spotify maybe
+            wait(job.values()) #wait outside the lock, so other charts can carry on processing
+            with albumLock:
+                albumID = row['id']
+                if albumID not in albumLib.keys():
+                    log.info("AlbumID not found in library")
+                    log.debug("AlbumID: %s", albumID)
+                    albumName = row['title']
+                    artistName = row['artist']
+                    desc.set_description("updateChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artistName))
+                    #new album!!!
+                    desc.set_description("updateChart: Processing {albumName} by {artist} | Creating new album entry".format(albumName=albumName, artist=artistName))
+                    album = Album(albumID, albumName, artistName, row['year'])
+                    #set already fetched info
+                    album.genre = row['genre']
+                    album.rating = row['rating']
+                    album.noRatings = row['noRatings']
+                    album.links.artistLink = row['artistLink']
+                    album.links.albumLink = row['albumLink']
+                    log.info("Setting listening info for %s", listeners)
+                    album.setListeningInfo(['?']*len(listeners), listeners)
+                    if album.links.inLibrary == False:
+                        desc.set_description("updateChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
+                        album.links.findInLibrary()
+                    desc.set_description("updateChart: Processing {albumName} by {artist} | Finding timestamp".format(albumName=albumName, artist=artistName))
+                    album.duration = job['duration'].result()
+                    artist = job['artist'].result()
+                    album.artistID = artist.idNo
+                    album.country = artist.country
                     desc.set_description("updateChart: Processing {albumName} by {artist} | Updating Spotify status".format(albumName=albumName, artist=artistName))
-                    album.links.findSpotify(spObj)
-                if updateDuration:
-                    desc.set_description("updateChart: Processing {albumName} by {artist} | Updating timestamp".format(albumName=albumName, artist=artistName))
-                    album.duration = getTimestamp(albumLink)
-                chart.addAlbum(albumID, i) #
-    rejectAlbums = list(oldAlbums - set(chart.entries))
-    with tqdm.tqdm(total=len(rejectAlbums), position=1, bar_format='{desc}', desc='updateChart: Processing rejects') as desc:
-        for album in tqdm.tqdm(rejectAlbums, total=len(rejectAlbums), position=0, unit="album"):
-            log.debug("Rejecting {title} by {artist}".format(title=albumLib[album].title, artist=albumLib[album].artist))
+                    album.links.setSpotify(job['spotify'].result())
+                    albumLib[albumID] = album
+                    chart.addAlbum(albumID, i)
+                else: #If the album has been logged before:
+                    log.info("Album found in library!")
+                    album = albumLib[albumID]
+                    before = rowState(album)
+                    desc.set_description("updateChart: Processing {albumName} by {artist} | Updating album metadata".format(albumName=album.title, artist=album.artist))
+                    prevRating = album.rating
+                    album.rating = row['rating'] #new rating
+                    log.debug("Previous rating: %s. Current rating: %s", prevRating, album.rating)
+                    prevRatingCount = album.noRatings
+                    log.debug("Previous # of ratings: %s. Current # of ratings: %s", prevRatingCount, album.noRatings)
+                    album.noRatings = row['noRatings'] #new rating count
+                    albumName = row['title']
+                    if albumName != album.title:
+                        log.debug("Album name changed. Previously was %s, now is %s", album.title, albumName)
+                        album.title=albumName
+                    artistName = row['artist']
+                    if artistName != album.artist:
+                        log.debug("Album artist changed. Previously was %s, now is %s", album.artist, artistName)
+                        album.artist=artistName
+                    genre = row['genre']
+                    if genre != album.genre:
+                        log.debug("Album genre changed. Previously was %s, now is %s", album.genre, genre)
+                        album.genre=genre
+                    year = row['year']
+                    if year != album.year:
+                        log.debug("Album year changed. Previously was %s, now is %s", album.year, year)
+                        album.year=year
+                    if album.links.inLibrary == False:
+                        desc.set_description("updateChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
+                        album.links.findInLibrary()
+                    if 'spotify' in job.keys(): #update spotify maybe
+                        desc.set_description("updateChart: Processing {albumName} by {artist} | Updating Spotify status".format(albumName=albumName, artist=artistName))
+                        album.links.setSpotify(job['spotify'].result())
+                    if 'duration' in job.keys():
+                        desc.set_description("updateChart: Processing {albumName} by {artist} | Updating timestamp".format(albumName=albumName, artist=artistName))
+                        album.duration = job['duration'].result()
+                    chart.addAlbum(albumID, i) #
+                    markAlbum(album, changedFields(before, rowState(album))) #this chart's row, and the album's row on any other chart
+    rejectAlbums = [album for album in oldAlbums - set(chart.entries) if album is not None]
+    with progress(total=len(rejectAlbums), position=1, bar_format='{desc}', desc='updateChart: Processing rejects', disable=quiet) as desc:
+        for album in progress(rejectAlbums, total=len(rejectAlbums), position=0, unit="album", disable=quiet):
+            log.debug("Rejecting %s by %s", albumLib[album].title, albumLib[album].artist)
             desc.set_description("updateChart: Rejecting Album: {title} by {artist}".format(title=albumLib[album].title, artist=albumLib[album].artist))
-            albumLib[album].addRanking(name, -1, dateStr)
-    log.info("Successfully updated {chartname}".format(chartname=chart.name))
-    log.info("Total albums: {acnt}, total rejected albums: {rejcnt}, total new albums: {newcnt}".format(acnt=len(chart.entries), rejcnt=len(rejectAlbums), newcnt=(len(chart.entries) - len(rejectAlbums))))
+            with albumLock:
+                chart.rejectAlbum(album, dateStr)
+    log.info("Successfully updated %s", chart.name)
+    log.info("Total albums: %s, total rejected albums: %s, total new albums: %s", len(chart.entries), len(rejectAlbums), len(chart.entries) - len(rejectAlbums))
     return chart
 
-def scanChart(name, link, spObj, listeners, updateSpotify=True, updateDuration=True):
-    log.info("Scanning chart {name} from {link}".format(name=name, link=link))
-    dateStr = date.today().strftime("%m/%d/%Y")
-    log.debug("Sending request for {link}".format(link=link))
-    reqChart = requests.get(link)
-    parsed = html.fromstring(reqChart.content)
-    log.debug("Status code: {code}".format(code=reqChart.status_code))
-    rawAlbums = parsed.xpath('/html/body/div[2]/div[2]/div[1]/table[1]/tr')
-    newChart = Chart(name, len(rawAlbums), link, dateStr)
-    i = 0
-    with tqdm.tqdm(total=len(rawAlbums), position=1, bar_format='{desc}', desc='Seeking album') as desc:
-        for albumTR in tqdm.tqdm(rawAlbums, total=len(rawAlbums), unit="album", position=0, smoothing=0.3):
-            i += 1
-            sleep(1)
-            albumLink = "http://www.progarchives.com/" + albumTR[3][0].attrib['href'] 
-            artistLink = "http://www.progarchives.com/" + albumTR[3][2].attrib['href']
-            getID = re.compile(r"(?<=\?id\=).*")
-            gettingID = re.search(getID, albumLink)
-            albumID= gettingID.group(0)
-            albumName = albumTR[3][0][0].text
-            artistName = albumTR[3][2].text
-            desc.set_description("scanChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artistName))
-            genre = albumTR[4][0].text
-            yrRE = re.compile(r"\d{4}")
-            yearDump = albumTR[4].text_content()
-            year = re.search(yrRE, yearDump).group(0)
-            albumRating = albumTR[2][2].text
-            noRatings = albumTR[2][3].text
-            qwrRE = re.compile(r"\d\.\d*")
-            qwrStr = albumTR[2][4].text
-            qwr = re.search(qwrRE, qwrStr).group(0) #this should never fail
-            log.debug("Found {artist} - {album}".format(artist=artistName, album=albumName))
-            if albumID in albumLib.keys():
-                desc.set_description("scanChart: Processing {albumName} by {artist} | Album found in library, syncing.".format(albumName=albumName, artist=artistName))
-                log.info("Found albumID in library")
-                log.debug("Album ID: {albumID}".format(albumID=albumID))
-                album = albumLib[albumID]
-                if album.links.inLibrary == False:
-                    desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for album on disc.".format(albumName=albumName, artist=artistName))
-                    album.links.findInLibrary()
-                album.rating = albumRating
-                album.noRatings = noRatings
-                if updateSpotify:
-                    desc.set_description("scanChart: Processing {albumName} by {artist} | Updating Spotify status.".format(albumName=albumName, artist=artistName))
-                    album.links.findSpotify(spObj)
-                if updateDuration:
-                    desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for timestamp.".format(albumName=albumName, artist=artistName))
-                    album.duration = getTimestamp(albumLink)
-                newChart.addAlbum(albumID, i)
-            else:
-                desc.set_description("scanChart: Processing {albumName} by {artist} | Album not in library, fetching info.".format(albumName=albumName, artist=artistName))
-                log.info("albumID not found in library")
-                log.debug("Album ID: {albumID}".format(albumID=albumID))
-                album = Album(albumID, albumName, artistName, year)
-                album.genre = genre
-                album.rating = albumRating
-                album.noRatings = noRatings
-                album.links.artistLink = artistLink
-                album.links.albumLink = albumLink
-                log.info("Setting listening info for {title}".format(title=albumName))
-                album.setListeningInfo(['?']*len(listeners), listeners)
-                album.qwr = qwr
-                if album.links.inLibrary == False:
-                    desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
-                    album.links.findInLibrary()
-                album.duration = getTimestamp(albumLink)
-                log.debug("Requesting {link}".format(link=artistLink))
-                artPage = requests.get(artistLink)
-                log.debug("Status code: {stat}".format(stat=artPage.status_code))
-                artInfo = html.fromstring(artPage.content)
-                headerInfo = artInfo.xpath("/html/body/div[2]/div[2]/div/h2/text()")
-                country = headerInfo[0].split(' • ')[1]
-                album.country = country
-                desc.set_description("scanChart: Processing {albumName} by {artist} | Updating spotify status".format(albumName=albumName, artist=artistName))
-                album.links.findSpotify(spObj)
-                albumLib[albumID] = album
-                newChart.addAlbum(albumID, i)
-        desc.set_description("scanChart: chart scan completed")
-    log.info("Successfully found {nAlbs} albums for {name}".format(nAlbs=i, name=newChart.name))
-    newChart.size = i
-    chartLib[name] = newChart
+#A scan ranks albums as it goes but only swaps the new chart in at the end, so one that fails part way
+#takes the rankings it added back off again. Otherwise they'd be saved, and a resume or rescan would
+#rank those albums a second time. The journal stays, so --resume still skips the fetching
+def scanChart(name, *args, **kwargs):
+    with albumLock:
+        old = chartLib.get(name)
+        if old is not None:
+            old.ensureIndex()
+        rankings = snapshotRankings(name, old.members if old is not None else ())
+    try:
+        return applyChartScan(name, *args, **kwargs)
+    except Exception:
+        log.warning("Taking the rankings of the failed scan of %s back off", name)
+        with albumLock:
+            restoreRankings(name, rankings, [albumID for albumID, album in albumLib.items() if name in album.rank.keys() or albumID in rankings.keys()])
+        raise
+
+#quiet turns the progress bars off, for when several charts are being scanned at once
+#resume picks up from the chart's journal (see ScanJournal) if an earlier scan of it was cut short
+def applyChartScan(name, link, spObj, listeners, updateSpotify=True, updateDuration=True, quiet=False, resume=False):
+    log.info("Scanning chart %s from %s", name, link)
+    journal = ScanJournal(name)
+    saved = journal.read() if resume else None
+    if saved is not None and saved[0] == link:
+        link, dateStr, rows, done = saved
+        jobs = None #these go out once the finished albums are back in the library
+        log.info("Resuming %s: %s of %s albums were already done", name, len(done), len(rows))
+    else:
+        if resume:
+            log.warning("No unfinished scan of %s to resume, starting from the top", name)
+        elif os.path.isfile(journal.filename):
+            log.warning("Discarding an unfinished scan of %s (use --resume to continue it)", name)
+        dateStr = date.today().strftime("%m/%d/%Y")
+        #fetch stage: queue up every page and spotify lookup the chart needs, the pool works through them while we process
+        #each row's lookups go out as soon as the row is parsed
+        rows = []
+        jobs = []
+        for row in getChartRows(link):
+            rows.append(row)
+            jobs.append(scanJobs(row, spObj, updateSpotify, updateDuration))
+        done = []
+    journal.start(link, dateStr, rows)
+    try:
+        newChart = Chart(name, len(rows), link, dateStr)
+        with albumLock:
+            if name in chartLib.keys():
+                newChart.inheritIndex(chartLib[name])
+            for rank, snapshot, artist in done: #replay what the journal already has, nothing is fetched for these
+                journal.add(rank, snapshot, artist)
+                restoreAlbum(snapshot, artist)
+                newChart.addAlbum(snapshot.idNo, rank)
+        rows = rows[len(done):]
+        if jobs is None:
+            jobs = [scanJobs(row, spObj, updateSpotify, updateDuration) for row in rows]
+        i = len(done)
+        with progress(total=len(rows), position=1, bar_format='{desc}', desc='Seeking album', disable=quiet) as desc:
+            for row, job in progress(zip(rows, jobs), total=len(rows), unit="album", position=0, smoothing=0.3, disable=quiet):
+                i += 1
+                wait(job.values()) #wait outside the lock, so other charts can carry on processing
+                with albumLock:
+                    albumID = row['id']
+                    albumName = row['title']
+                    artistName = row['artist']
+                    desc.set_description("scanChart: Processing {albumName} by {artist} | Currently reading metadata".format(albumName=albumName, artist=artistName))
+                    log.debug("Found %s - %s", artistName, albumName)
+                    if albumID in albumLib.keys():
+                        desc.set_description("scanChart: Processing {albumName} by {artist} | Album found in library, syncing.".format(albumName=albumName, artist=artistName))
+                        log.info("Found albumID in library")
+                        log.debug("Album ID: %s", albumID)
+                        album = albumLib[albumID]
+                        before = rowState(album)
+                        if album.links.inLibrary == False:
+                            desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for album on disc.".format(albumName=albumName, artist=artistName))
+                            album.links.findInLibrary()
+                        album.rating = row['rating']
+                        album.noRatings = row['noRatings']
+                        if updateSpotify:
+                            desc.set_description("scanChart: Processing {albumName} by {artist} | Updating Spotify status.".format(albumName=albumName, artist=artistName))
+                            album.links.setSpotify(job['spotify'].result())
+                        if updateDuration:
+                            desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for timestamp.".format(albumName=albumName, artist=artistName))
+                            album.duration = job['duration'].result()
+                        markAlbum(album, changedFields(before, rowState(album))) #its row on the other charts it is on
+                    else:
+                        desc.set_description("scanChart: Processing {albumName} by {artist} | Album not in library, fetching info.".format(albumName=albumName, artist=artistName))
+                        log.info("albumID not found in library")
+                        log.debug("Album ID: %s", albumID)
+                        album = Album(albumID, albumName, artistName, row['year'])
+                        album.genre = row['genre']
+                        album.rating = row['rating']
+                        album.noRatings = row['noRatings']
+                        album.links.artistLink = row['artistLink']
+                        album.links.albumLink = row['albumLink']
+                        log.info("Setting listening info for %s", albumName)
+                        album.setListeningInfo(['?']*len(listeners), listeners)
+                        album.qwr = row['qwr']
+                        if album.links.inLibrary == False:
+                            desc.set_description("scanChart: Processing {albumName} by {artist} | Searching for album on disc".format(albumName=albumName, artist=artistName))
+                            album.links.findInLibrary()
+                        album.duration = job['duration'].result()
+                        artist = job['artist'].result()
+                        album.artistID = artist.idNo
+                        album.country = artist.country
+                        desc.set_description("scanChart: Processing {albumName} by {artist} | Updating spotify status".format(albumName=albumName, artist=artistName))
+                        album.links.setSpotify(job['spotify'].result())
+                        albumLib[albumID] = album
+                    journal.add(i, album, artistLib.get(album.artistID))
+                    newChart.addAlbum(albumID, i)
+            desc.set_description("scanChart: chart scan completed")
+        log.info("Successfully found %s albums for %s", i, newChart.name)
+        newChart.size = i
+    finally: #a scan that fails keeps its journal for --resume, but lets go of the file
+        journal.close()
+    journal.finish()
+    with albumLock:
+        chartLib[name] = newChart
     return newChart
+#ScanJournal: write ahead log for a chart scan, so an interrupted scan can carry on where it stopped
+#The first record holds the parsed chart rows and scan date, then there is one record per finished
+#album: a copy of it (without rankings) taken just before its ranking was added, plus its artist.
+#Records are flushed as they are written and a half written one at the end (from a crash) is ignored
+#Journals are only deleted by clearJournals, once the libraries the scan fed have been saved (see Libraries.flush)
+JOURNAL_DIR = "journal"
+finishedJournals = []
+class ScanJournal:
+    def __init__(self, name):
+        self.name = name
+        self.filename = os.path.join(JOURNAL_DIR, hashlib.sha1(name.encode('utf-8')).hexdigest()[:16] + '.journal')
+        self.file = None
+    def read(self): #returns (link, date, rows, [(rank, album, artist)]) or None
+        if not os.path.isfile(self.filename):
+            return None
+        records = []
+        with open(self.filename, 'rb') as f:
+            while True:
+                try:
+                    records.append(pickle.load(f))
+                except EOFError:
+                    break
+                except Exception as e:
+                    log.warning("Journal for %s ends with a broken record (%s), ignoring it", self.name, repr(e))
+                    break
+        if len(records) == 0 or records[0][0] != 'chart' or records[0][1] != self.name:
+            return None
+        kind, name, link, dateStr, rows = records[0]
+        return link, dateStr, rows, [record[1:] for record in records[1:]]
+    def start(self, link, dateStr, rows): #(re)writes the journal from the top, which also drops a broken tail
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        self.file = open(self.filename, 'wb')
+        self.write(('chart', self.name, link, dateStr, rows))
+    def add(self, rank, album, artist):
+        bare = copy.copy(album) #rankings are rebuilt by addAlbum on resume
+        bare.rank = {}
+        self.write(('album', rank, bare, artist))
+    def write(self, record):
+        pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
+        self.file.flush()
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    def finish(self):
+        self.close()
+        finishedJournals.append(self.filename)
+#Puts a journalled album back into the library. If another chart's journal already restored it,
+#only its fields are refreshed so the rankings gathered so far are kept
+def restoreAlbum(snapshot, artist):
+    if artist is not None and artist.idNo not in artistLib.keys():
+        artistLib[artist.idNo] = artist
+    album = albumLib.get(snapshot.idNo)
+    if album is None:
+        albumLib[snapshot.idNo] = snapshot
+        return
+    before = rowState(album)
+    for field in Album.__slots__:
+        if field != 'rank':
+            setattr(album, field, getattr(snapshot, field))
+    album.links.owner = album
+    markAlbum(album, changedFields(before, rowState(album)))
+def clearJournals():
+    while finishedJournals:
+        filename = finishedJournals.pop()
+        if os.path.isfile(filename):
+            os.remove(filename)
+#Scans or updates several charts at once (tasks are (name, call) pairs). Their album lookups are
+#shared through albumLookups, and the results come back in the order given, with None for a chart
+#that failed so the rest of the run can still be written
+CHART_WORKERS = 3
+def runCharts(tasks):
+    charts = []
+    with ThreadPoolExecutor(max_workers=CHART_WORKERS, thread_name_prefix="chart") as pool:
+        futures = [pool.submit(task) for name, task in tasks]
+        for (name, task), future in progress(zip(tasks, futures), total=len(tasks), unit="chart"):
+            try:
+                charts.append(future.result())
+            except Exception as e:
+                log.error("Could not process %s: %s", name, repr(e))
+                charts.append(None)
+    return charts
+#SqliteStore: optional storage backend, used whenever a library filename ends in .db
+#Albums, their rankings and charts each get their own table. A save only serializes the albums and
+#charts marked in changedAlbums/changedCharts, and every row remembers a digest of what was last
+#written, so of those only the ones that really changed get written. It all happens in one
+#transaction so a crash mid-save can't eat the library
+#The album and chart library can (and usually should) point at the same .db file
+SQLITE_EXTS = ('.db', '.sqlite')
+sqliteStores = {} #filename -> store, so the album and chart library share a connection
+def isSqlite(filename):
+    return filename.strip().endswith(SQLITE_EXTS)
+def getStore(filename):
+    filename = filename.strip()
+    if filename not in sqliteStores.keys():
+        sqliteStores[filename] = SqliteStore(filename)
+    return sqliteStores[filename]
+class SqliteStore:
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS albums (id TEXT PRIMARY KEY, digest TEXT, data BLOB)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS rankings (album_id TEXT, chart TEXT, digest TEXT, data BLOB, PRIMARY KEY (album_id, chart))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS charts (name TEXT PRIMARY KEY, digest TEXT, data BLOB)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rankings_album ON rankings (album_id)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS rankings_chart ON rankings (chart)")
+        self.digests = {'albums' : {}, 'rankings' : {}, 'charts' : {}} #what is on disk right now, rankings by album id then chart
+    def blob(self, obj):
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        return hashlib.sha1(data).hexdigest(), data
+    def loadAlbums(self):
+        albumLib = {}
+        for idNo, digest, data in self.conn.execute("SELECT id, digest, data FROM albums"):
+            albumLib[idNo] = pickle.loads(data)
+            self.digests['albums'][idNo] = digest
+        for albumID, chart, digest, data in self.conn.execute("SELECT album_id, chart, digest, data FROM rankings"):
+            if albumID in albumLib.keys():
+                albumLib[albumID].rank[chart] = pickle.loads(data)
+            self.digests['rankings'].setdefault(albumID, {})[chart] = digest
+        return albumLib
+    def loadCharts(self):
+        chartLib = {}
+        for name, digest, data in self.conn.execute("SELECT name, digest, data FROM charts"):
+            chartLib[name] = pickle.loads(data)
+            self.digests['charts'][name] = digest
+        return chartLib
+    #Only the albums in changedAlbums (and ones that left the library) are serialized, everything does the lot
+    def saveAlbums(self, albumLib, everything=False):
+        dirty = set(albumLib.keys()) if everything else set(changedAlbums)
+        changedAlbums.difference_update(dirty)
+        dirty.update(self.digests['albums'].keys() - albumLib.keys())
+        albums = {}
+        rankings = {}
+        for idNo in dirty:
+            album = albumLib.get(idNo)
+            if album is None:
+                continue
+            bare = copy.copy(album) #rankings live in their own table
+            object.__setattr__(bare, 'rank', {}) #not a change to the album
+            albums[idNo] = self.blob(bare)
+            for chart, ranking in album.rank.items():
+                rankings[(idNo, chart)] = self.blob(ranking)
+        onDisk = {(idNo, chart) : digest for idNo in dirty for chart, digest in self.digests['rankings'].get(idNo, {}).items()}
+        try:
+            with self.conn:
+                written = self.sync(self.digests['albums'], albums, dirty - albums.keys(), "INSERT OR REPLACE INTO albums (id, digest, data) VALUES (?, ?, ?)", "DELETE FROM albums WHERE id = ?")
+                written += self.sync(onDisk, rankings, onDisk.keys() - rankings.keys(), "INSERT OR REPLACE INTO rankings (album_id, chart, digest, data) VALUES (?, ?, ?, ?)", "DELETE FROM rankings WHERE album_id = ? AND chart = ?")
+        except Exception:
+            changedAlbums.update(dirty) #still not on disk
+            raise
+        #only trust the new digests once the transaction has gone through
+        for idNo in dirty:
+            self.digests['albums'].pop(idNo, None)
+            self.digests['rankings'].pop(idNo, None)
+        for idNo, (digest, data) in albums.items():
+            self.digests['albums'][idNo] = digest
+        for (idNo, chart), (digest, data) in rankings.items():
+            self.digests['rankings'].setdefault(idNo, {})[chart] = digest
+        log.info("Wrote %s changed albums and rankings (of %s marked) to %s", written, len(dirty), self.filename)
+    def saveCharts(self, chartLib, everything=False):
+        dirty = set(chartLib.keys()) if everything else set(changedCharts)
+        changedCharts.difference_update(dirty)
+        dirty.update(self.digests['charts'].keys() - chartLib.keys())
+        charts = {name : self.blob(chartLib[name]) for name in dirty if name in chartLib.keys()}
+        try:
+            with self.conn:
+                written = self.sync(self.digests['charts'], charts, dirty - charts.keys(), "INSERT OR REPLACE INTO charts (name, digest, data) VALUES (?, ?, ?)", "DELETE FROM charts WHERE name = ?")
+        except Exception:
+            changedCharts.update(dirty)
+            raise
+        for name in dirty:
+            self.digests['charts'].pop(name, None)
+        for name, (digest, data) in charts.items():
+            self.digests['charts'][name] = digest
+        log.info("Wrote %s changed charts to %s", written, self.filename)
+    #writes the rows whose digest differs from onDisk and drops the gone ones that are on disk
+    def sync(self, onDisk, rows, gone, upsert, delete):
+        written = 0
+        for key, (digest, data) in rows.items():
+            if onDisk.get(key) != digest:
+                keyCols = key if isinstance(key, tuple) else (key,)
+                self.conn.execute(upsert, keyCols + (digest, data))
+                written += 1
+        for key in gone:
+            if key in onDisk.keys():
+                self.conn.execute(delete, key if isinstance(key, tuple) else (key,))
+                written += 1
+        return written
+#One shot move from the old .pkl libraries into a .db file
+def migrateLibraries(database, albumLib, chartLib):
+    log.info("Migrating libraries into %s", database)
+    store = getStore(database)
+    store.saveAlbums(albumLib, everything=True)
+    store.saveCharts(chartLib, everything=True)
+    return store
+@timedStage('storage')
 def loadCharts(filename, chartLib):
-    log.info("Loading chart library from {f}".format(f=filename))
+    log.info("Loading chart library from %s", filename)
+    if isSqlite(filename):
+        return getStore(filename).loadCharts()
     if os.path.isfile(filename):
         f = open(filename, 'rb')
         p = pickle.Unpickler(f)
         chartLib = p.load()
         f.close()
     return chartLib
+@timedStage('storage')
 def loadAlbums(filename, albumLib):
-    log.info("Loading album library from {f}".format(f=filename))
+    log.info("Loading album library from %s", filename)
+    if isSqlite(filename):
+        return getStore(filename).loadAlbums()
     if os.path.isfile(filename):
         f = open(filename, 'rb')
         p = pickle.Unpickler(f)
         albumLib = p.load()
         f.close()
     return albumLib
+@timedStage('storage')
+def loadArtists(filename, artistLib):
+    log.info("Loading artist library from %s", filename)
+    if os.path.isfile(filename):
+        f = open(filename, 'rb')
+        p = pickle.Unpickler(f)
+        artistLib = p.load()
+        f.close()
+    return artistLib
+@timedStage('storage')
+def saveArtists(filename, artistLib):
+    log.info("Saving artist library to %s", filename)
+    f = open(filename, 'wb')
+    p = pickle.Pickler(f)
+    p.dump(artistLib)
+    f.close()
+    return artistLib
+@timedStage('storage')
 def saveCharts(filename, chartLib):
-    log.info("Saving chart library to {f}".format(f=filename))
+    log.info("Saving chart library to %s", filename)
+    if isSqlite(filename):
+        getStore(filename).saveCharts(chartLib)
+        return chartLib
     f = open(filename, 'wb')
     p = pickle.Pickler(f)
     p.dump(chartLib)
     f.close()
+    changedCharts.clear() #a pickle always has everything
     return chartLib
+@timedStage('storage')
 def saveAlbums(filename, albumLib):
-    log.info("Saving album library to {f}".format(f=filename))
+    log.info("Saving album library to %s", filename)
+    if isSqlite(filename):
+        getStore(filename).saveAlbums(albumLib)
+        return albumLib
     f = open(filename, 'wb')
     p = pickle.Pickler(f)
     p.dump(albumLib)
     f.close()
+    changedAlbums.clear() #a pickle always has everything
     return albumLib
+#Export: writes the libraries out as plain tables for analysis tools. Each table is a directory of part
+#files (albums/part-00000.csv, ...) so an incremental export just adds a part with the albums that
+#changed since the last one; a later part replaces every row an earlier part had for the same album
+#(or chart, for entries). Rows go out in chunks, so only a chunk of each table is ever held in memory
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+EXPORT_CHUNK = 5000
+EXPORT_STATE = 'export.json' #format, part count and a digest of every exported album and chart
+EXPORT_TABLES = {
+    'albums' : (('album_id', 'str'), ('title', 'str'), ('artist', 'str'), ('artist_id', 'str'), ('year', 'int'), ('genre', 'str'),
+                ('country', 'str'), ('duration_s', 'int'), ('rating', 'float'), ('ratings', 'int'), ('qwr', 'float'),
+                ('on_spotify', 'bool'), ('spotify_link', 'str'), ('in_library', 'bool'), ('bought', 'bool'),
+                ('house_listened', 'bool'), ('album_link', 'str'), ('artist_link', 'str')),
+    'rankings' : (('album_id', 'str'), ('chart', 'str'), ('date', 'str'), ('rank', 'int'), ('rejected', 'bool')),
+    'listens' : (('album_id', 'str'), ('listener', 'str'), ('status', 'str')),
+    'entries' : (('chart', 'str'), ('chart_date', 'str'), ('rank', 'int'), ('album_id', 'str')),
+}
+def exportNumber(value, kind): #numbers on PA come as text, sometimes with commas. None if it isn't one
+    try:
+        return kind(str(value).replace(',', '').strip())
+    except ValueError:
+        return None
+def isYes(value):
+    return value in (True, "Yes")
+def isoDate(ordinal):
+    return date.fromordinal(ordinal).isoformat() if ordinal else None
+def albumRows(album): #(album row, ranking rows, listen rows) for one album
+    row = (album.idNo, album.title, album.artist, album.artistID, exportNumber(album.year, int), album.genre, album.country,
+           album.duration, exportNumber(album.rating, float), exportNumber(album.noRatings, int), exportNumber(album.qwr, float),
+           isYes(album.links.onSpotify), album.links.spotifyLink or None, isYes(album.links.inLibrary), isYes(album.bought),
+           isYes(album.houseListened), album.links.albumLink, album.links.artistLink)
+    rankings = []
+    for chart, ranking in album.rank.items():
+        #the history can repeat its first entry and doesn't hold the current rank, so merge the two and drop repeats
+        history = list(zip(ranking.histRanks, ranking.histDates)) + [(ranking.ranking, ranking.updated)]
+        for i, (rank, day) in enumerate(history):
+            if i == 0 or history[i - 1] != (rank, day):
+                rankings.append((album.idNo, chart, isoDate(day), rank, rank < 0))
+    listens = [(album.idNo, listener, status) for listener, status in album.profiles.items()]
+    return row, rankings, listens
+def chartRows(chart):
+    chartDate = isoDate(dateOrdinal(chart.date)) if chart.date else None
+    return [(chart.name, chartDate, rank, albumID) for rank, albumID in enumerate(chart.entries, 1) if albumID is not None]
+def exportDigest(rows):
+    return hashlib.sha1(json.dumps(rows, default=str).encode()).hexdigest()
+#One part file of one table. Rows are buffered and handed to the format's writer a chunk at a time
+class ExportTable:
+    def __init__(self, path, columns, fmt, chunk):
+        self.path = path
+        self.columns = columns
+        self.chunk = chunk
+        self.buffer = []
+        self.count = 0
+        if fmt == 'parquet':
+            import pyarrow
+            import pyarrow.parquet
+            types = {'str' : pyarrow.string(), 'int' : pyarrow.int64(), 'float' : pyarrow.float64(), 'bool' : pyarrow.bool_()}
+            self.schema = pyarrow.schema([(name, types[kind]) for name, kind in columns])
+            self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+            self.writeChunk = self.writeParquet
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+            if fmt == 'csv':
+                self.writer = csv.writer(self.file)
+                self.writer.writerow([name for name, kind in columns])
+                self.writeChunk = self.writer.writerows
+            else:
+                self.writeChunk = self.writeJsonl
+    def add(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.chunk:
+            self.flush()
+    def flush(self):
+        if self.buffer:
+            self.writeChunk(self.buffer)
+            self.count += len(self.buffer)
+            self.buffer = []
+    def writeJsonl(self, rows):
+        names = [name for name, kind in self.columns]
+        self.file.write(''.join(json.dumps(dict(zip(names, row)), ensure_ascii=False) + '\n' for row in rows))
+    def writeParquet(self, rows):
+        import pyarrow
+        self.writer.write_table(pyarrow.Table.from_arrays([pyarrow.array(column, type=field.type) for column, field in zip(zip(*rows), self.schema)], schema=self.schema))
+    def close(self):
+        self.flush()
+        if hasattr(self, 'file'):
+            self.file.close()
+        else:
+            self.writer.close()
+def loadExportState(directory):
+    path = os.path.join(directory, EXPORT_STATE)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+def clearExport(directory): #a full export starts the tables over
+    for table in EXPORT_TABLES.keys():
+        tableDir = os.path.join(directory, table)
+        if os.path.isdir(tableDir):
+            for name in os.listdir(tableDir):
+                if name.startswith('part-'):
+                    os.remove(os.path.join(tableDir, name))
+#Writes a part of every table. Incremental exports only include albums and charts whose rows changed
+#since the last export. Returns {table : rows written}
+@timedStage('storage')
+def exportLibrary(directory, fmt='csv', incremental=False, chunk=EXPORT_CHUNK):
+    state = loadExportState(directory)
+    if incremental and state is not None and state['format'] != fmt:
+        log.warning("Last export to %s was %s, not %s. Doing a full export instead", directory, state['format'], fmt)
+        state = None
+    if not incremental or state is None:
+        clearExport(directory)
+        state = {'format' : fmt, 'parts' : 0, 'albums' : {}, 'charts' : {}}
+    part = state['parts']
+    log.info("Exporting part %s to %s as %s", part, directory, fmt)
+    tables = {}
+    for table, columns in EXPORT_TABLES.items():
+        os.makedirs(os.path.join(directory, table), exist_ok=True)
+        path = os.path.join(directory, table, "part-{p:05d}.{ext}".format(p=part, ext=fmt))
+        tables[table] = ExportTable(path, columns, fmt, chunk)
+    albums = {}
+    for albumID in sorted(albumLib.keys()):
+        row, rankings, listens = albumRows(albumLib[albumID])
+        digest = exportDigest([row, rankings, listens])
+        albums[albumID] = digest
+        if state['albums'].get(albumID) == digest:
+            continue
+        tables['albums'].add(row)
+        for ranking in rankings:
+            tables['rankings'].add(ranking)
+        for listen in listens:
+            tables['listens'].add(listen)
+    charts = {}
+    for name in sorted(chartLib.keys()):
+        if chartLib[name].isRejectChart: #reject charts are built from the rankings, nothing new in them
+            continue
+        rows = chartRows(chartLib[name])
+        charts[name] = exportDigest(rows)
+        if state['charts'].get(name) == charts[name]:
+            continue
+        for row in rows:
+            tables['entries'].add(row)
+    for table in tables.values():
+        table.close()
+        if part > 0 and table.count == 0: #nothing changed in this table, don't leave an empty part behind
+            os.remove(table.path)
+    counts = {table : tables[table].count for table in tables.keys()}
+    state.update({'parts' : part + 1 if part == 0 or any(counts.values()) else part, 'albums' : albums, 'charts' : charts, 'date' : datetime.now().isoformat(timespec='seconds')})
+    with open(os.path.join(directory, EXPORT_STATE), 'w') as f:
+        json.dump(state, f)
+    return counts
+#Analysis: rank movement over a chart's history. A chart's rankings are loaded into an album x update
+#matrix of ranks (NaN where the album wasn't on the chart that update), and everything else is worked
+#out with whole-matrix NumPy passes instead of walking each album's history
+ANALYZE_TOP = 10
+def rankingsByChart(): #chart name -> [(album id, Ranking)], in one pass over the library
+    charts = {}
+    for albumID, album in albumLib.items():
+        for chart, ranking in album.rank.items():
+            charts.setdefault(chart, []).append((albumID, ranking))
+    return charts
+#(album ids, update days, ranks) for one chart. ranks[a, d] is album a's rank on the d'th update
+def rankMatrix(rankings):
+    import numpy as np
+    albumIDs = []
+    counts = []
+    ranks = array('i') #the histories are already int arrays, so they're joined up before NumPy sees them
+    days = array('i')
+    for albumID, ranking in rankings: #history plus the current rank
+        albumIDs.append(albumID)
+        counts.append(len(ranking.histRanks) + 1)
+        ranks.extend(ranking.histRanks)
+        ranks.append(ranking.ranking)
+        days.extend(ranking.histDates)
+        days.append(ranking.updated)
+    ranks = np.frombuffer(ranks, dtype=np.intc)
+    days = np.frombuffer(days, dtype=np.intc)
+    rows = np.repeat(np.arange(len(albumIDs)), counts)
+    known = (days > 0) & (ranks > 0) #rejections (negative ranks) just mean the album was off the chart
+    updates, cols = np.unique(days[known], return_inverse=True)
+    matrix = np.full((len(albumIDs), len(updates)), np.nan)
+    matrix[rows[known], cols] = ranks[known]
+    return albumIDs, updates, matrix
+def topAlbums(albumIDs, values, mask, count, descending=True): #[(album id, value)] for the top albums among the masked ones
+    import numpy as np
+    order = np.argsort(-values if descending else values, kind='stable')
+    order = order[mask[order]][:count]
+    return [(albumIDs[i], float(values[i])) for i in order]
+def chartStats(albumIDs, updates, matrix, top=ANALYZE_TOP):
+    import numpy as np
+    onChart = ~np.isnan(matrix)
+    tenure = onChart.sum(axis=1) #updates each album has spent on the chart
+    stats = {'albums' : len(albumIDs), 'updates' : len(updates), 'first' : isoDate(int(updates[0])) if len(updates) else None,
+             'last' : isoDate(int(updates[-1])) if len(updates) else None, 'mean tenure' : float(tenure.mean()) if len(albumIDs) else 0.0}
+    stats['longest tenure'] = topAlbums(albumIDs, tenure.astype(float), tenure > 0, top)
+    if len(updates) < 2:
+        stats.update({'climbers' : [], 'fallers' : [], 'volatile' : [], 'churn' : [], 'mean churn' : 0.0})
+        return stats
+    climb = matrix[:, :-1] - matrix[:, 1:] #positive when an album moved up between two updates
+    latest = climb[:, -1]
+    moved = ~np.isnan(latest)
+    stats['climbers'] = topAlbums(albumIDs, np.nan_to_num(latest), moved & (np.nan_to_num(latest) > 0), top)
+    stats['fallers'] = topAlbums(albumIDs, np.nan_to_num(latest), moved & (np.nan_to_num(latest) < 0), top, descending=False)
+    moves = (~np.isnan(climb)).sum(axis=1)
+    volatility = np.zeros(len(albumIDs))
+    some = moves >= 2
+    volatility[some] = np.nanstd(climb[some], axis=1) #spread of an album's moves, in places per update
+    stats['volatile'] = topAlbums(albumIDs, volatility, some, top)
+    stats['mean volatility'] = float(volatility[some].mean()) if some.any() else 0.0
+    entered = (onChart[:, 1:] & ~onChart[:, :-1]).sum(axis=0)
+    left = (~onChart[:, 1:] & onChart[:, :-1]).sum(axis=0)
+    size = np.maximum(onChart[:, 1:].sum(axis=0), 1)
+    churn = entered / size #share of the chart that is new on each update
+    stats['churn'] = [{'date' : isoDate(int(day)), 'entered' : int(e), 'left' : int(l), 'rate' : float(c)} for day, e, l, c in zip(updates[1:], entered, left, churn)]
+    stats['mean churn'] = float(churn.mean())
+    return stats
+def analyzeCharts(names=None, top=ANALYZE_TOP):
+    charts = rankingsByChart()
+    if not names:
+        names = sorted(name for name in charts.keys() if name in chartLib.keys() and not chartLib[name].isRejectChart)
+    results = {}
+    for name in names:
+        if name not in charts.keys():
+            log.error("No rankings found for chart %s", name)
+            continue
+        with timed('analyze'):
+            results[name] = chartStats(*rankMatrix(charts[name]), top=top)
+    return results
+def printChartStats(name, stats):
+    print("{n}: {a} albums over {u} updates ({f} to {l})".format(n=name, a=stats['albums'], u=stats['updates'], f=stats['first'], l=stats['last']))
+    print("  mean tenure {t:.1f} updates, mean churn {c:.1%}, mean volatility {v:.2f} places".format(t=stats['mean tenure'], c=stats['mean churn'],
+                                                                                           v=stats.get('mean volatility', 0.0)))
+    for title, key, fmt in (('Biggest climbers (last update)', 'climbers', "{v:+.0f}"), ('Biggest fallers (last update)', 'fallers', "{v:+.0f}"),
+                            ('Most volatile', 'volatile', "{v:.2f}"), ('Longest on the chart', 'longest tenure', "{v:.0f}")):
+        if stats[key]:
+            print("  " + title)
+            for albumID, value in stats[key]:
+                album = albumLib[albumID]
+                print("    {v:>8}  {t} by {a}".format(v=fmt.format(v=value), t=album.title, a=album.artist))
+    if stats['churn']:
+        print("  Churn per update")
+        for update in stats['churn']:
+            print("    {d}  +{e:<4} -{l:<4} {r:.1%}".format(d=update['date'], e=update['entered'], l=update['left'], r=update['rate']))
+#Refresh scheduling. A chart's past updates give the rates at which its rows change (move or come in new)
+#per day, taking each row's changes as a Poisson process: an update g days after the previous one that found
+#a share s of the rows changed counts as -ln(1 - s) / g. With the days since the last update that gives the
+#share of the chart likely to have changed by now, and the entry rate says how many new albums a refresh will
+#have to look up, which is where its requests go. The charts most likely to have changed go first, for as
+#long as their requests fit in the budget
+SCHEDULE_BUDGET = 300
+SCHEDULE_MIN_CHANGE = 0.01 #charts less likely than this to have changed aren't worth a request
+#the most an album's lookups can take, since a spotify lookup is up to 3 searches (see searchSpotify). The plan
+#expects this much for each new album too, so a plan that fits the budget still fits once the refresh charges it
+SCHEDULE_ALBUM_MOST = 5 #album page, artist page and spotify search for an album new to the library
+SCHEDULE_REFETCH_MOST = 4 #album page and spotify status again for one we already have
+SCHEDULE_PRIOR = (-math.log(0.8) / 7, -math.log(0.95) / 7) #charts without two updates yet: a fifth move and a twentieth are new each week
+SCHEDULE_MAX_SHARE = 0.99 #a chart that changed completely would give an infinite rate
+#RequestBudget: the requests a schedule run may still make. Lookups take the most requests they could
+#need when they are queued (even if the caches end up answering them), so the run stops queuing before
+#the budget is gone rather than after. sent counts the requests that really went out (see Fetcher.throttle),
+#skipped the charts that were left for next time because their chart page didn't fit any more
+class RequestBudget:
+    def __init__(self, total):
+        self.total = total
+        self.left = total
+        self.sent = 0
+        self.skipped = []
+        self.lock = threading.Lock()
+    def take(self, count, force=False): #whether count requests fit, force takes them anyway
+        with self.lock:
+            if not force and count > self.left:
+                return False
+            self.left -= count
+            return True
+    def count(self):
+        with self.lock:
+            self.sent += 1
+    def skip(self, name):
+        with self.lock:
+            self.skipped.append(name)
+def budgetedUpdate(name, budget, *args, **kwargs): #updateChart, as long as the chart page still fits in the budget
+    if not budget.take(1):
+        log.warning("Request budget spent, leaving %s for next time", name)
+        budget.skip(name)
+        return None
+    return updateChart(name, *args, budget=budget, **kwargs)
+def changeRates(updates, matrix): #(rows changed, rows entered) per day, None until there are two updates
+    import numpy as np
+    if len(updates) < 2:
+        return None
+    onChart = ~np.isnan(matrix)
+    now = onChart[:, 1:]
+    moved = now & (matrix[:, 1:] != matrix[:, :-1]) #NaN never equals anything, so new entries count as moved
+    size = np.maximum(now.sum(axis=0), 1)
+    changed = np.minimum(moved.sum(axis=0) / size, SCHEDULE_MAX_SHARE)
+    entered = np.minimum((now & ~onChart[:, :-1]).sum(axis=0) / size, SCHEDULE_MAX_SHARE)
+    days = float(updates[-1] - updates[0])
+    return float(-np.log1p(-changed).sum() / days), float(-np.log1p(-entered).sum() / days)
+def changedShare(rate, days):
+    return 1 - math.exp(-rate * days)
+def planRefresh(names, budget=SCHEDULE_BUDGET, minChange=SCHEDULE_MIN_CHANGE): #one plan per chart, most likely to have changed first
+    rankings = rankingsByChart()
+    today = date.today().toordinal()
+    rates = {}
+    for name in names:
+        with timed('analyze'):
+            rates[name] = changeRates(*rankMatrix(rankings[name])[1:]) if name in rankings.keys() else None
+    known = [rate for rate in rates.values() if rate is not None]
+    prior = tuple(sum(rate[i] for rate in known) / len(known) for i in range(2)) if known else SCHEDULE_PRIOR #new charts act like the rest
+    plans = []
+    for name in names:
+        chart = chartLib[name]
+        changeRate, entryRate = rates[name] or prior
+        days = max(today - dateOrdinal(chart.date), 0)
+        newAlbums = chart.size * changedShare(entryRate, days)
+        plans.append({'chart' : name, 'days' : days, 'history' : rates[name] is not None, 'weekly change' : changedShare(changeRate, 7),
+                      'expected change' : changedShare(changeRate, days), 'requests' : 1 + math.ceil(newAlbums * SCHEDULE_ALBUM_MOST)})
+    plans.sort(key=lambda plan : (-plan['expected change'], plan['requests']))
+    spent = 0
+    for plan in plans:
+        plan['refresh'] = plan['expected change'] >= minChange and spent + plan['requests'] <= budget
+        if plan['refresh']:
+            spent += plan['requests']
+    return plans
+def printPlan(plans, budget):
+    print("{c:<40}{d:>10}{w:>10}{e:>10}{r:>10}".format(c='chart', d='days ago', w='per week', e='changed', r='requests'))
+    for plan in plans:
+        print("{m} {c:<38}{d:>10}{w:>10}{e:>10}{r:>10}".format(m='*' if plan['refresh'] else ' ', c=plan['chart'][:38], d=plan['days'],
+                                                             w="{v:.0%}{h}".format(v=plan['weekly change'], h='' if plan['history'] else '?'),
+                                                             e="{v:.0%}".format(v=plan['expected change']), r=plan['requests']))
+    chosen = [plan for plan in plans if plan['refresh']]
+    print("Refreshing {n} of {t} charts (*), about {r} of {b} requests. ? means too few updates to go on, so the average rate is used".format(
+        n=len(chosen), t=len(plans), r=sum(plan['requests'] for plan in chosen), b=budget))
+#Conditional formatting. The rules only depend on how many listener columns a sheet has (reject charts
+#just cover more rows), so each listener count's rule set is built once per run and copied onto sheets.
+#Installing first takes off any Chart Helper rules the sheet already has, so writing a sheet again
+#replaces its rules instead of stacking up another copy of them
+def listenerChecks(numlisteners, value): #'I2="No",$J2="No"' style run of checks over the listener columns
+    from openpyxl.utils import get_column_letter
+    return ',$'.join(get_column_letter(9 + i) + '2="' + value + '"' for i in range(numlisteners))
+@functools.lru_cache(maxsize=None)
+def formattingRules(numlisteners): #([rules for whole rows], [rules for the listener block]), never added to a sheet themselves
+    from openpyxl.styles import PatternFill, Font
+    from openpyxl.utils import get_column_letter
+    from openpyxl.formatting.rule import FormulaRule
+    from openpyxl.formatting import Rule
+    from openpyxl.styles.differential import DifferentialStyle
+    #9 + numlisteners -> on spotify
+    #10 + numlisteners -> bought
+    #11 + numlisteners -> in library
+    #12 + numlisteners -> "house listened"
+    spotify = get_column_letter(9 + numlisteners)
+    library = get_column_letter(11 + numlisteners)
+    house = get_column_letter(12 + numlisteners)
+    noListeners = listenerChecks(numlisteners, "No")
+    allListened = listenerChecks(numlisteners, "Yes")
+    rowRules = [
+        FormulaRule(formula=['AND($' + spotify + '2="No", $' + library + '2="Yes")'], font=Font(italic=True)),
+        FormulaRule(formula=['AND($' + noListeners + ')'], font=Font(bold=True)),
+        FormulaRule(formula=['AND($' + spotify + '2="No", $' + library + '2="Yes", AND($' + noListeners + '))'], font=Font(bold=True, italic=True)),
+        FormulaRule(formula=['AND($' + spotify + '2="No", $' + library + '2="No")'], font=Font(color='FF0000')),
+        FormulaRule(formula=['AND(AND($' + spotify + '2="No",$' + library + '2="No"), AND($' + noListeners + '))'], font=Font(color='FF0000', bold=True)),
+        FormulaRule(formula=['AND($' + allListened + ')'], font=Font(strikethrough=True)),
+        FormulaRule(formula=['=AND($' + spotify + '2="No", $' + library + '2="Yes", AND($' + allListened + '))'], font=Font(strikethrough=True, italic=True)),
+        FormulaRule(formula=['$' + house + '2="Yes"'], font=Font(strikethrough=True), fill=PatternFill(bgColor='D9D9D9')),
+    ]
+    listenerRules = [
+        Rule(type='containsText', text='Yes', dxf=DifferentialStyle(fill=PatternFill(bgColor="b7e1cd"))),
+        Rule(type='containsText', text='No', dxf=DifferentialStyle(fill=PatternFill(bgColor="EA9999"))),
+    ]
+    return rowRules, listenerRules
+#The formulas of every whole row rule we write for up to most listeners. A sheet may have been written
+#when it had a different number of listeners, so every count that fits in its columns is looked for
+@functools.lru_cache(maxsize=None)
+def chartHelperFormulas(most):
+    return frozenset(rule.formula[0] for numlisteners in range(most + 1) for rule in formattingRules(numlisteners)[0])
+def isChartHelperRule(rule, sqref, formulas): #only rules exactly as we write them, a user's own Yes/No rules are left alone
+    if rule.type == 'containsText':
+        #Excel adds the search formula to a containsText rule when it saves the workbook
+        return (rule.text in ('Yes', 'No') and sqref.startswith('I2:')
+                and list(rule.formula) in ([], ['NOT(ISERROR(SEARCH("' + rule.text + '",I2)))']))
+    return rule.type == 'expression' and len(rule.formula) == 1 and rule.formula[0] in formulas
+def clearConditionalFormatting(sheet, numlisteners): #drops our rules, leaves any the user added by hand
+    from openpyxl.formatting.formatting import ConditionalFormattingList
+    if not sheet.conditional_formatting: #new sheets, including write only ones, have nothing to take off
+        return
+    formulas = chartHelperFormulas(max(numlisteners, sheet.max_column))
+    kept = [(str(cf.sqref), rule) for cf in sheet.conditional_formatting for rule in cf.rules
+            if not isChartHelperRule(rule, str(cf.sqref), formulas)]
+    sheet.conditional_formatting = ConditionalFormattingList()
+    for priority, (sqref, rule) in enumerate(sorted(kept, key=lambda kept: kept[1].priority or 0), 1):
+        rule.priority = priority #numbered again in the same order, ahead of the rules we add after
+        sheet.conditional_formatting.add(sqref, rule)
+@timedStage('render')
 def setConditionalFormatting(sheet, size, numlisteners, chart):
+    from openpyxl.utils import get_column_letter
     log.info("Setting conditional formatting")
-    #M = 9 + numlisteners -> on spotify
-    #N = 10 + numlisteners -> bought
-    #O = 11 + numlisteners -> in library
-    #P = 12 + numlisteners -> "house listened"
     if chart.isRejectChart:
         log.debug("Reject chart found, adjusting chart size")
         size += len(chart.rejSections)
     if size == 0:
         size = 1
-    f1 = Font(bold=True)
-    noListenersStr = "AND($"
-    for i in range(numlisteners):
-        thisCol = get_column_letter(9 + i)
-        noListenersStr = noListenersStr + thisCol + '2="No",$'
-    noListenersStr = noListenersStr[:-2] + ")"
-    noListenersRule = FormulaRule(formula=[noListenersStr], font=f1)
-    f2 = Font(italic=True)
-    noStreamingStr = "AND($" + get_column_letter(9 + numlisteners) + '2="No", $' + get_column_letter(11 + numlisteners) + '2="Yes")'
-    noStreamingRule = FormulaRule(formula=[noStreamingStr], font=f2)
-    f3 = Font(bold=True, italic=True)
-    noStreamingNoListenersStr = "AND($" + get_column_letter(9 + numlisteners) + '2="No", $' + get_column_letter(11 + numlisteners) + '2="Yes", AND($'
-    for i in range(numlisteners):
-        thisCol = get_column_letter(9 + i)
-        noStreamingNoListenersStr = noStreamingNoListenersStr + thisCol + '2="No",$'
-    noStreamingNoListenersStr = noStreamingNoListenersStr[:-2] + "))"
-    noStreamingNoListenersRule= FormulaRule(formula=[noStreamingNoListenersStr], font=f3)
-    f4 = Font(color='FF0000')
-    noStreamingNoLibraryStr = "AND($" + get_column_letter(9 + numlisteners) + '2="No", $' + get_column_letter(11 + numlisteners) + '2="No")'
-    noStreamingNoLibraryRule = FormulaRule(formula=[noStreamingNoLibraryStr], font=f4)
-    f5 = Font(color='FF0000', bold=True)
-    noStreamingNoLibraryNoListenersStr = "AND(AND($" + get_column_letter(9 + numlisteners) + '2="No",$' + get_column_letter(11 + numlisteners) + '2="No"), AND($'
-    for i in range(numlisteners):
-        thisCol = get_column_letter(9 + i)
-        noStreamingNoLibraryNoListenersStr = noStreamingNoLibraryNoListenersStr + thisCol + '2="No",$'
-    noStreamingNoLibraryNoListenersStr = noStreamingNoLibraryNoListenersStr[:-2] + '))'
-    noStreamingNoLibraryNoListenersRule= FormulaRule(formula=[noStreamingNoLibraryNoListenersStr], font=f5)
-    f6 = Font(strikethrough=True)
-    allListenedStr = "AND($"
-    for i in range(numlisteners):
-        thisCol = get_column_letter(9 + i)
-        allListenedStr = allListenedStr + thisCol + '2="Yes",$'
-    allListenedStr = allListenedStr[:-2] + ')'
-    allListenedRule = FormulaRule(formula=[allListenedStr], font=f6)
-    f7 = Font(strikethrough=True, italic=True)
-    allListenedNoStreamingStr = "=AND($" + get_column_letter(9 + numlisteners) + '2="No", $' + get_column_letter(11+numlisteners) + '2="Yes", AND($'
-    for i in range(numlisteners):
-        thisCol = get_column_letter(9 + i)
-        allListenedNoStreamingStr = allListenedNoStreamingStr + thisCol + '2="Yes",$'
-    allListenedNoStreamingStr = allListenedNoStreamingStr[:-2] + "))"
-    allListenedNoStreamingRule = FormulaRule(formula=[allListenedNoStreamingStr], font=f7)
-    f8 = Font(strikethrough=True)
-    fill = PatternFill(bgColor='D9D9D9')
-    allListenedTogetherStr = "$" + get_column_letter(12 + numlisteners) + '2="Yes"'
-    allListenedTogetherRule = FormulaRule(formula=[allListenedTogetherStr], font=f8, fill=fill)
-    fill = PatternFill(bgColor="b7e1cd")
-    dxf = DifferentialStyle(fill=fill)
-    listeningBlockYesRule=Rule(type='containsText', text='Yes', dxf=dxf)
-    fill1 = PatternFill(bgColor="EA9999")
-    dxf = DifferentialStyle(fill=fill1)
-    listeningBlockNoRule=Rule(type='containsText', text='No', dxf=dxf)
+    rowRules, listenerRules = formattingRules(numlisteners)
+    clearConditionalFormatting(sheet, numlisteners)
     log.info("Writing conditional formatting onto every row")
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noStreamingRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noListenersRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noStreamingNoListenersRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noStreamingNoLibraryRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noStreamingNoLibraryNoListenersRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), allListenedRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), allListenedNoStreamingRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), allListenedTogetherRule)
-    sheet.conditional_formatting.add('A2:Q{end}'.format(end=size+1), noStreamingNoListenersRule)
-    sheet.conditional_formatting.add('{lstart}2:{lend}{end}'.format(end=size+1, lstart=get_column_letter(9), lend=get_column_letter(9+numlisteners-1)), listeningBlockYesRule)
-    sheet.conditional_formatting.add('{lstart}2:{lend}{end}'.format(end=size+1, lstart=get_column_letter(9), lend=get_column_letter(9+numlisteners-1)), listeningBlockNoRule)
+    rows = 'A2:{last}{end}'.format(last=get_column_letter(12 + numlisteners), end=size + 1)
+    listenerBlock = '{lstart}2:{lend}{end}'.format(end=size + 1, lstart=get_column_letter(9), lend=get_column_letter(9 + numlisteners - 1))
+    for rule in rowRules:
+        sheet.conditional_formatting.add(rows, copy.copy(rule)) #copies, since adding a rule sets its priority
+    for rule in listenerRules:
+        sheet.conditional_formatting.add(listenerBlock, copy.copy(rule))
     return sheet
-def setColumnWidths(sheet):
-    log.info("Setting column widths")
-    dims = {}
-    for row in sheet.rows:
-        for cell in row:
-            if cell.value:
-                dims[cell.column] = max((dims.get(cell.column, 0), len(str(cell.value))))   
-    dim_holder = DimensionHolder(worksheet=sheet)
-    for col in range(sheet.min_column, sheet.max_column + 1):
-        width = dims[col] * 1.23
-        dim_holder[get_column_letter(col)] = ColumnDimension(sheet, min=col, max=col, width=width)
-    sheet.column_dimensions = dim_holder
-def setup(id, sec, library, albumlib, chartlib):
+#Library filenames from settings.ini as (chart library, album library, artist library), None if it isn't usable
+def readSettings():
+    if not os.path.isfile('settings.ini'):
+        log.error('settings.ini does not exist. Try running setup')
+        return None
+    with open('settings.ini', 'r') as file:
+        lines = file.readlines()
+    if len(lines) not in (6, 7):
+        log.error("settings.ini is not well formed. Try running setup")
+        return None
+    chartlibdir = lines[4].split('=')[1].strip('\n')
+    albumlibdir = lines[5].split('=')[1].strip('\n')
+    if len(lines) == 7:
+        artistlibdir = lines[6].split('=')[1].strip('\n')
+    else: #settings from before the artist library existed
+        artistlibdir = 'artistLib.pkl'
+    return chartlibdir, albumlibdir, artistlibdir
+#Libraries: loads the album, chart and artist libraries and writes them back out. Commands call save() with
+#the libraries they changed. On the command line that writes them there and then, while the daemon defers
+#it and flush()es everything that changed every so often (see serve)
+class Libraries:
+    def __init__(self, chartFile, albumFile, artistFile):
+        self.chartFile = chartFile
+        self.albumFile = albumFile
+        self.artistFile = artistFile
+        self.deferred = False
+        self.pending = set() #'albums', 'artists' and 'charts' changed since they were last written
+    def load(self, artists=True):
+        global albumLib
+        global chartLib
+        global artistLib
+        albumLib = loadAlbums(self.albumFile, albumLib)
+        chartLib = loadCharts(self.chartFile, chartLib)
+        if artists:
+            artistLib = loadArtists(self.artistFile, artistLib)
+            if len(artistLib) == 0:
+                artistLib = seedArtists(artistLib, albumLib)
+    def save(self, *names):
+        self.pending.update(names)
+        if not self.deferred:
+            self.flush()
+    def flush(self):
+        if 'albums' in self.pending:
+            saveAlbums(self.albumFile, albumLib)
+        if 'artists' in self.pending:
+            saveArtists(self.artistFile, artistLib)
+        if 'charts' in self.pending:
+            saveCharts(self.chartFile, chartLib)
+        self.pending.clear()
+        clearJournals() #finished scans are on disk now, so their journals can go
+
+#Daemon mode. serve loads the libraries once and then runs commands sent by main.py --connect over a Unix
+#socket, so a run skips the unpickling, the Spotify login and new HTTP sessions. Requests are run one at a
+#time on the main thread (sqlite connections can't change threads), and the libraries and caches are written
+#every SERVE_FLUSH seconds that something changed, and on the way out.
+#A request is one JSON line, {"argv" : [...], "cwd" : ...} or {"stop" : true}. The reply is JSON lines
+#of {"out" : text} and {"err" : text} as the command prints, then {"exit" : code}
+SERVE_SOCKET = 'charthelper.sock'
+SERVE_FLUSH = 300
+SERVE_REFUSED = (None, 'setup', 'serve', 'migrate') #setup and migrate rewrite settings.ini under the daemon
+def daemonRunning(path):
+    if not os.path.exists(path):
+        return False
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(path)
+        except OSError: #left behind by a daemon that didn't get to clean up
+            return False
+    return True
+def sendRequest(path, request): #passes the daemon's output through and returns its exit code
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        try:
+            conn.connect(path)
+        except OSError as e:
+            log.error("Could not reach the daemon at %s (%s). Start one with serve", path, e)
+            return -1
+        conn.sendall((json.dumps(request) + '\n').encode('utf-8'))
+        for line in conn.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'exit' in message:
+                return message['exit']
+            stream = sys.stdout if 'out' in message else sys.stderr
+            stream.write(message.get('out', message.get('err')))
+            stream.flush()
+    log.error("The daemon hung up before the command finished")
+    return -1
+#Stands in for stdout or stderr while a request runs. The log listener writes from its own thread, hence the lock
+class SocketOutput:
+    def __init__(self, conn, stream, lock):
+        self.conn = conn
+        self.stream = stream
+        self.lock = lock
+        self.gone = False
+    def write(self, text):
+        if text and not self.gone:
+            try:
+                with self.lock:
+                    self.conn.sendall((json.dumps({self.stream : text}) + '\n').encode('utf-8'))
+            except OSError: #the client went away, the command still runs to the end
+                self.gone = True
+        return len(text)
+    def flush(self):
+        pass
+    def isatty(self):
+        return False
+def serve(parser, libraries, path, flushEvery=SERVE_FLUSH):
+    import socket
+    import signal
+    if os.path.exists(path):
+        if daemonRunning(path):
+            log.error("A daemon is already listening on %s", path)
+            return -1
+        os.remove(path)
+    libraries.deferred = True
+    sp = SpotifyClient()
+    stopping = []
+    for signum in (signal.SIGTERM, signal.SIGINT): #finish the request in hand, then write everything out
+        signal.signal(signum, lambda signum, frame : stopping.append(signum))
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    server.settimeout(1) #wakes up now and then to flush and check for signals
+    print("Serving {d} on {p}".format(d=os.getcwd(), p=path))
+    log.info("Daemon started on %s", path)
+    lastFlush = time.monotonic()
+    try:
+        while not stopping:
+            try:
+                conn, address = server.accept()
+            except socket.timeout:
+                conn = None
+            if conn is not None:
+                with conn:
+                    conn.settimeout(None)
+                    if handleRequest(conn, parser, libraries, sp):
+                        break
+            if time.monotonic() - lastFlush >= flushEvery:
+                flushServed(libraries)
+                lastFlush = time.monotonic()
+    finally:
+        server.close()
+        os.remove(path)
+        flushServed(libraries)
+        log.info("Daemon stopped")
+    return 0
+def flushServed(libraries):
+    if libraries.pending:
+        log.info("Writing out %s", ', '.join(sorted(libraries.pending)))
+    libraries.flush()
+    fetcher.cache.flush()
+    spotifyCache.save()
+    if libraryIndex is not None:
+        libraryIndex.save()
+def handleRequest(conn, parser, libraries, sp): #returns True if the daemon was asked to stop
+    global stageTimer
+    line = conn.makefile('r', encoding='utf-8').readline()
+    if not line: #daemonRunning checking up on us
+        return False
+    request = json.loads(line)
+    lock = threading.Lock()
+    out = SocketOutput(conn, 'out', lock)
+    err = SocketOutput(conn, 'err', lock)
+    code = 0
+    if request.get('stop'):
+        log.info("Asked to stop")
+        out.write("Stopping the daemon\n")
+    elif os.path.realpath(request.get('cwd', '')) != os.path.realpath(os.getcwd()):
+        err.write("The daemon serves {d}, run commands from there\n".format(d=os.getcwd()))
+        code = -1
+    else:
+        log.info("Running %s", ' '.join(request['argv']))
+        level = tqdmhandler.level
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                a = parser.parse_args(request['argv'])
+                stageTimer = StageTimer() if a.profile else None
+                setVerbosity(a)
+                if a.command in SERVE_REFUSED:
+                    log.error("The daemon doesn't run %s, stop it first", a.command or 'without a command')
+                    code = -1
+                else:
+                    if libraryIndex is not None and a.command in FETCH_COMMANDS: #the music library may have changed since
+                        libraryIndex.refresh()
+                    code = runCommand(a, libraries, sp)
+            except SystemExit as e: #argparse errors, and commands that bail out with sys.exit
+                code = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception: #what it fetched stays in memory (a failed chart update is rolled back, see updateChart)
+                log.exception("%s failed", ' '.join(request['argv']))
+                code = 1
+            drainLog()
+        tqdmhandler.setLevel(level)
+        gateLogging()
+    with lock:
+        try:
+            conn.sendall((json.dumps({'exit' : code}) + '\n').encode('utf-8'))
+        except OSError:
+            pass
+    return bool(request.get('stop'))
+def setup(id, sec, library, albumlib, chartlib, artistlib):
     with open("settings.ini", 'w') as file:
         file.write('[settings]\n')
         file.write('SPOTIPY_CLIENT_ID={id} \n'.format(id=id))
         file.write('SPOTIPY_CLIENT_SECRET={sec} \n'.format(sec=sec))
         file.write('LIBRARY_DIR={library} \n'.format(library=library))
         file.write('CHARTLIB={clib}'.format(clib=chartlib + '.pkl\n'))
-        file.write('ALBUMLIB={clib}'.format(clib=albumlib + '.pkl'))
-def main():
+        file.write('ALBUMLIB={clib}'.format(clib=albumlib + '.pkl\n'))
+        file.write('ARTISTLIB={alib}'.format(alib=artistlib + '.pkl'))
+def buildParser():
     #USE ARGPARSE
     parser = argparse.ArgumentParser("PAScraper")
     parser.add_argument('--verbose', '-b', action="store_true", help="Enables all info messages")
     parser.add_argument('--debug', '-d', action="store_true", help="Enables all debug messages")
-    parser.add_argument('--log', '-l', action="store", nargs=1, help="Redirects output to given file")
+    parser.add_argument('--log', '-l', action="store", nargs=1, help="Write the log to the given file (default {f})".format(f=LOG_FILE))
+    parser.add_argument('--log-level', action="store", choices=LOG_LEVELS.keys(), default='info', help="Least important messages that go in the log file (default info)")
     parser.add_argument('--version', '-v', action="store_true", help="Displays version")
+    parser.add_argument('--no-cache', action="store_true", help="Do not read or write the page cache")
+    parser.add_argument('--refresh', action="store_true", help="Revalidate every cached page")
+    parser.add_argument('--offline', action="store_true", help="Only use cached pages, never hit the network")
+    parser.add_argument('--spotify-hit-ttl', action="store", type=float, help="Days to trust a cached spotify link")
+    parser.add_argument('--spotify-miss-ttl', action="store", type=float, help="Days to trust a cached 'not on spotify'")
+    parser.add_argument('--profile', action="store", nargs='?', const='profile.json', help="Time each stage of the run and save a JSON report (default profile.json)")
+    parser.add_argument('--connect', action="store_true", help="Send the command to the running daemon (see serve) instead of running it here")
+    parser.add_argument('--socket', action="store", default=SERVE_SOCKET, help="The daemon's socket (default {s})".format(s=SERVE_SOCKET))
     subparsers = parser.add_subparsers(dest='command', help='Commands to run', required=False)
     
     parser_setup = subparsers.add_parser('setup')
@@ -969,6 +2703,7 @@ def main():
     parser_setup.add_argument('library', action='store', nargs=1, help="Provide a directory for your music library")
     parser_setup.add_argument('--albumlib', '-al', action='store', nargs=1, help='album library filename (excluding extension)')
     parser_setup.add_argument('--chartlib', '-cl', action='store', nargs=1, help='chart library filename (excluding extension)')
+    parser_setup.add_argument('--artistlib', '-arl', action='store', nargs=1, help='artist library filename (excluding extension)')
     
     parser_readchart = subparsers.add_parser('readchart')
     parser_readchart.add_argument('filename', nargs=1, action="store", help="Filename of workbook (.xlsx)")
@@ -984,6 +2719,7 @@ def main():
     parser_scanchart.add_argument('--update-duration', '-ud', action='store_true', help='Update duration for logged albums')
     parser_scanchart.add_argument('--write', '-w', action='store', nargs=1, help='Write scanned chart to file')
     parser_scanchart.add_argument('--new', '-n', action='store_true', help='Create new spreadsheet')
+    parser_scanchart.add_argument('--resume', '-r', action='store_true', help='Continue an interrupted scan of this chart')
     
     parser_updatechart = subparsers.add_parser('updatechart')
     parser_updatechart.add_argument('chartname', nargs=1, action='store', help='Name of chart')
@@ -991,7 +2727,9 @@ def main():
     parser_updatechart.add_argument('--newlink',  nargs=1, action='store', help='Link to update chart with')
     parser_updatechart.add_argument('--update-spotify', action='store_true', help='Update spotify')
     parser_updatechart.add_argument('--update-duration', action='store_true', help='Update duration')
+    parser_updatechart.add_argument('--incremental', '-i', action='store_true', help='Only refetch albums that are new or changed')
     parser_updatechart.add_argument('--write', '-w', action='store', nargs=1, help='Write scanned chart to file')
+    parser_updatechart.add_argument('--full', '-f', action='store_true', help='Rewrite every cell, not just the ones that changed')
 
     parser_writechart = subparsers.add_parser('writechart')
     parser_writechart.add_argument('chartname', nargs=1, action='store', help='Name of chart')
@@ -1004,12 +2742,15 @@ def main():
     parser_rejchart.add_argument('listeners', nargs='*', action='store', help='Listeners')
     parser_rejchart.add_argument('--write', '-w', nargs=1, action='store', help='File to write to (.xlsx)')
     parser_rejchart.add_argument('--new', '-n', action='store_true', help='Write to new sheet')
+    parser_rejchart.add_argument('--since', '-s', nargs=1, action='store', type=dateArgument, help='Only albums rejected on or after this date (mm/dd/yyyy)')
 
     parser_updateworkbook = subparsers.add_parser('updateworkbook')
     parser_updateworkbook.add_argument('filename', nargs=1, action='store', help='Filename of workbook to open (.xlsx)')
     parser_updateworkbook.add_argument('listeners', nargs='*', action='store', help='listeners for EVERY chart')
     parser_updateworkbook.add_argument('--update-spotify', action='store_true', help='Update spotify')
     parser_updateworkbook.add_argument('--update-duration', action='store_true', help='Update duration')
+    parser_updateworkbook.add_argument('--incremental', '-i', action='store_true', help='Only refetch albums that are new or changed')
+    parser_updateworkbook.add_argument('--full', '-f', action='store_true', help='Rewrite every sheet and cell, not just the ones that changed')
     parser_updateworkbook.add_argument('--write', '-w', action='store', nargs=1, help='Write scanned chart to file')
     parser_updateworkbook.add_argument('--new', '-n', action='store', nargs=1, help='Write to new file')
 
@@ -1025,7 +2766,37 @@ def main():
     parser_scancharts.add_argument('--update-duration', '-ud', action='store_true', help='Update duration for logged albums')
     parser_scancharts.add_argument('--write', '-w', action='store', nargs=1, help='Write to a given workbook')
     parser_scancharts.add_argument('--new', '-n', action='store', nargs=1,help='Save workbook as new file')
-    
+    parser_scancharts.add_argument('--resume', '-r', action='store_true', help='Continue interrupted scans of these charts')
+
+    parser_export = subparsers.add_parser('export')
+    parser_export.add_argument('directory', nargs=1, action='store', help='Directory to export the library tables into')
+    parser_export.add_argument('--format', '-f', action='store', choices=EXPORT_FORMATS, default='csv', help='File format (parquet needs pyarrow)')
+    parser_export.add_argument('--incremental', '-i', action='store_true', help='Only export albums and charts that changed since the last export')
+    parser_export.add_argument('--chunk', action='store', type=int, default=EXPORT_CHUNK, help='Rows written at a time')
+
+    parser_analyze = subparsers.add_parser('analyze')
+    parser_analyze.add_argument('charts', nargs='*', action='store', help='Charts to analyze (default every chart)')
+    parser_analyze.add_argument('--top', '-t', action='store', type=int, default=ANALYZE_TOP, help='Albums to list for each statistic')
+    parser_analyze.add_argument('--json', '-j', action='store', nargs=1, help='Also save the statistics to this JSON file')
+
+    parser_schedule = subparsers.add_parser('schedule')
+    parser_schedule.add_argument('listeners', nargs='*', action='store', help='Listeners for EVERY chart')
+    parser_schedule.add_argument('--budget', '-b', action='store', type=int, default=SCHEDULE_BUDGET, help='Most requests to spend (default {b})'.format(b=SCHEDULE_BUDGET))
+    parser_schedule.add_argument('--chart', '-c', action='append', help='Only consider this chart (can be given more than once)')
+    parser_schedule.add_argument('--min-change', action='store', type=float, default=SCHEDULE_MIN_CHANGE, help='Skip charts less likely than this to have changed (default {m})'.format(m=SCHEDULE_MIN_CHANGE))
+    parser_schedule.add_argument('--write', '-w', action='store', nargs=1, help='Workbook to write refreshed charts to. Without --chart, only its charts are considered')
+    parser_schedule.add_argument('--dry-run', action='store_true', help='Only print the plan')
+
+    parser_migrate = subparsers.add_parser('migrate')
+    parser_migrate.add_argument('database', nargs=1, action='store', help='SQLite file (.db) to move the album and chart libraries into')
+
+    parser_serve = subparsers.add_parser('serve')
+    parser_serve.add_argument('--flush', action='store', type=float, default=SERVE_FLUSH, help='Seconds between writes of changed libraries (default {f})'.format(f=SERVE_FLUSH))
+    parser_serve.add_argument('--stop', action='store_true', help='Stop the running daemon, after it writes out the libraries')
+    return parser
+
+def main():
+    parser = buildParser()
     a= parser.parse_args()
     if a.version:
         header = '| C H A R T  H E L P E R |'
@@ -1035,15 +2806,15 @@ def main():
         print(header)
         print("Current version: 1.0") 
         print("Created by Hamish Robb, 2020-2022")
+        if a.command is None:
+            return 0
 
-    if a.verbose:
-        log.handlers[1].setLevel(logging.INFO)
-    elif a.debug:
-        log.handlers[1].setLevel(logging.DEBUG)
-    else:
-        log.handlers[1].setLevel(logging.WARNING)
-    chartlibdir = ""
-    albumlibdir = ""
+    setVerbosity(a)
+    if a.command == 'serve' and a.stop: #with or without --connect, this is a request of its own
+        sys.exit(sendRequest(a.socket, {'stop' : True}))
+    if a.connect: #the daemon does the logging, and it's the one holding the log file open
+        sys.exit(sendRequest(a.socket, {'argv' : sys.argv[1:], 'cwd' : os.getcwd()}))
+    openLogFile(a.log[0] if a.log else LOG_FILE, LOG_LEVELS[a.log_level])
     if a.command == 'setup':
         if not a.albumlib:
             albumlib = 'albumLib'
@@ -1053,28 +2824,45 @@ def main():
             chartlib = 'chartLib'
         else:
             chartlib =  a.chartlib[0]
+        if not a.artistlib:
+            artistlib = 'artistLib'
+        else:
+            artistlib = a.artistlib[0]
         if not os.path.isdir(a.library[0]):
-            log.error("Library directory {l} could not be validated".format(l=a.library[0]))
+            log.error("Library directory %s could not be validated", a.library[0])
             return -1
-        setup(a.id[0], a.sec[0], a.library[0], albumlib, chartlib)
-    if not os.path.isfile('settings.ini'):
-        log.error('settings.ini does not exist. Try running setup')
+        setup(a.id[0], a.sec[0], a.library[0], albumlib, chartlib, artistlib)
+        return 0
+    if a.command is None:
+        return 0
+    if daemonRunning(a.socket): #it would write its own copy of the libraries over whatever we save
+        log.error("A daemon is serving this directory. Send commands to it with --connect, or stop it with serve --stop")
         return -1
-    with open('settings.ini', 'r') as file:
-        lines = file.readlines()
-        if len(lines) != 6:
-            log.error("settings.ini is not well formed. Try running setup")
-            return -1
-        chartlibdir = lines[4].split('=')[1].strip('\n')
-        albumlibdir = lines[5].split('=')[1].strip('\n')
-    auth_handler = SpotifyClientCredentials(config('SPOTIPY_CLIENT_ID'), config('SPOTIPY_CLIENT_SECRET'))
-    sp = spotipy.Spotify(auth_manager=auth_handler)
-    wb = Workbook()
-    global albumLib 
-    global chartLib
-    albumLib= loadAlbums(albumlibdir, albumLib)
-    chartLib = loadCharts(chartlibdir, chartLib)
-    
+    settings = readSettings()
+    if settings is None:
+        return -1
+    global stageTimer
+    if a.profile:
+        stageTimer = StageTimer()
+    libraries = Libraries(*settings)
+    #the artist library is only read and written by commands that fetch pages
+    libraries.load(artists=a.command in FETCH_COMMANDS or a.command == 'serve')
+    if a.command == 'serve':
+        return serve(parser, libraries, a.socket, a.flush)
+    return runCommand(a, libraries, SpotifyClient()) #the client only logs in once something actually searches
+
+#Runs one command against the libraries already in memory. The command line runs one per process, the daemon
+#runs one per request. Everything a request can set is set again here, so nothing carries over to the next one
+def runCommand(a, libraries, sp):
+    fetcher.cache.enabled = not a.no_cache
+    fetcher.cache.refresh = a.refresh
+    fetcher.cache.offline = a.offline
+    spotifyCache.enabled = not a.no_cache
+    spotifyCache.hitTTL = SPOTIFY_HIT_TTL if a.spotify_hit_ttl is None else a.spotify_hit_ttl * DAY
+    spotifyCache.missTTL = SPOTIFY_MISS_TTL if a.spotify_miss_ttl is None else a.spotify_miss_ttl * DAY
+    albumLookups.clear() #finished lookups are only good for one command
+    with fetcher.lock:
+        artistRequests.clear()
     if a.command == 'readchart':
         header = '| R E A D  C H A R T |'
         rems = (termsize - len(header)) // 3
@@ -1082,40 +2870,30 @@ def main():
         header = headerPad + header + headerPad
         print(header)
         if not os.path.isfile(a.filename[0]):
-            log.error('{f} is not a valid file'.format(f=a.filename[0]))
+            log.error('%s is not a valid file', a.filename[0])
             sys.exit(1)
-        wb = load_workbook(a.filename[0])
+        wb = loadWorkbook(a.filename[0], True)
         sheet = wb[a.chartname[0]]
-        readChart(sheet, a.chartname[0], a.listeners, a.overwrite)
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+        readChart(sheet, a.chartname[0], a.listeners, a.overwrite, readHyperlinks(a.filename[0], a.chartname[0]))
+        wb.close()
+        libraries.save('albums', 'artists', 'charts')
     elif a.command == 'scanchart':
         header = '| S C A N  C H A R T |'
         rems = (termsize - len(header)) // 3
         headerPad = "~_~"*(rems//2)
         header = headerPad + header + headerPad
         print(header)
-        chart = scanChart(a.chartname[0], a.link[0], sp, a.listeners, a.update_spotify, a.update_duration)
+        chart = scanChart(a.chartname[0], a.link[0], sp, a.listeners, a.update_spotify, a.update_duration, resume=a.resume)
         if a.write:
-            if len(wb.chartsheets) == 0:
-                sheet = wb.active
-                sheet.title = a.chartname[0]
-            else:
-                if a.new:
-                    sheet = wb.create_sheet(a.chartname[0])
-                else:
-                    sheet = wb[a.chartname[0]] 
+            wb, sheet = openChartSheet(a.write[0], a.chartname[0], a.new)
             listeners = a.listeners
             if not a.listeners:
                 listeners = ['Listened?']
-            chart.writeChart(sheet, listeners)
+            chart.writeChart(sheet, listeners, filename=a.write[0])
             chartLib[chart.name] = chart
-            setColumnWidths(sheet)
-            sheet.freeze_panes = sheet['C2']
             sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-            wb.save(a.write[0])
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+            saveWorkbook(wb, a.write[0])
+        libraries.save('albums', 'artists', 'charts')
     elif a.command == 'updatechart':
         header = '| U P D A T E  C H A R T |'
         rems = (termsize - len(header)) // 3
@@ -1126,28 +2904,16 @@ def main():
             link = a.newlink[0]
         else:
             link = ""
-        chart = updateChart(a.chartname[0], sp, a.listeners, link, a.update_spotify, a.update_duration)
+        chart = updateChart(a.chartname[0], sp, a.listeners, link, a.update_spotify, a.update_duration, a.incremental)
         if a.write:
-            if os.path.isfile(a.write[0]):
-                wb = load_workbook(a.write[0])
-            if len(wb.chartsheets) == 0:
-                sheet = wb.active
-                sheet.title = a.chartname[0]
-            else:
-                if a.new:
-                    sheet = wb.create_sheet(a.chartname[0])
-                else:
-                    sheet = wb[a.chartname[0]] 
+            wb, sheet = openChartSheet(a.write[0], a.chartname[0])
             listeners = a.listeners
             if not a.listeners:
                 listeners = ['Listened?']
-            chart.writeChart(sheet, listeners)
-            setColumnWidths(sheet)
-            sheet.freeze_panes = sheet['C2']
+            chart.writeChart(sheet, listeners, a.full, a.write[0])
             sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-            wb.save(a.write[0])
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+            saveWorkbook(wb, a.write[0])
+        libraries.save('albums', 'artists', 'charts')
     elif a.command == 'writechart':
         header = '| W R I T E  C H A R T |'
         rems = (termsize - len(header)) // 3
@@ -1155,88 +2921,167 @@ def main():
         header = headerPad + header + headerPad
         print(header)
         chart = chartLib[a.chartname[0]]
-        if os.path.isfile(a.filename[0]):
-            wb = load_workbook(a.filename[0])
-            if len(wb.worksheets) == 0:
-                sheet = wb.active
-                sheet.title = a.chartname[0]
-            else:
-                if a.new:
-                    sheet = wb.create_sheet(a.chartname[0])
-                else:
-                    sheet = wb[a.chartname[0]] 
-            listeners = a.listeners
-            if not a.listeners:
-                listeners = ['Listened?']
-            chart.writeChart(sheet, listeners)
-            setColumnWidths(sheet)
-            sheet.freeze_panes = sheet['C2']
-            sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-            wb.save(a.filename[0])
+        wb, sheet = openChartSheet(a.filename[0], a.chartname[0], a.new)
+        listeners = a.listeners
+        if not a.listeners:
+            listeners = ['Listened?']
+        chart.writeChart(sheet, listeners, full=True, filename=a.filename[0]) #writechart is how a sheet gets put right, so it never trusts what's there
+        sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
+        saveWorkbook(wb, a.filename[0])
     elif a.command == 'getrejectchart':
         header = '| G E T  R E J E C T  C H A R T |'
         rems = (termsize - len(header)) // 3
         headerPad = "~_~"*(rems//2)
         header = headerPad + header + headerPad
         print(header)
-        chart = getRejectChart(a.chartname[0])
-        if os.path.isfile(a.write[0]):
-            wb = load_workbook(a.write[0])
-            if len(wb.worksheets) == 0:
-                sheet = wb.active
-                sheet.title = a.chartname[0]
-            else:
-                if a.new:
-                    sheet = wb.create_sheet(a.chartname[0])
-                else:
-                    sheet = wb[a.chartname[0]] 
+        chart = getRejectChart(a.chartname[0], a.since[0] if a.since else None)
+        if a.write:
+            wb, sheet = openChartSheet(a.write[0], chart.name, a.new)
             listeners = a.listeners
             if not a.listeners:
                 listeners = ['Listened?']
-            chart.writeChart(sheet, listeners)
-            setColumnWidths(sheet)
-            sheet.freeze_panes = sheet['C2']
+            chart.writeChart(sheet, listeners, filename=a.write[0])
             sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-            wb.save(a.write[0])
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+            saveWorkbook(wb, a.write[0])
+        libraries.save('albums', 'charts')
     elif a.command == "updateworkbook":
         header = '| U P D A T E  W O R K B O O K |'
         rems = (termsize - len(header)) // 3
         headerPad = "~_~"*(rems//2)
         header = headerPad + header + headerPad
         print(header)
-        wb = load_workbook(a.filename[0])
+        wb = loadWorkbook(a.filename[0])
         listeners = a.listeners
         if not a.listeners:
             listeners = ['Listened?']
+        sheets = []
         for sheet in wb.worksheets:
-            if sheet.title in chartLib.keys():
-                if chartLib[sheet.title].isRejectChart:
-                    pass
-            else:
-                log.error("Sheet {title} was not found in chartlib".format(title=sheet.title))
-            chart = updateChart(sheet.title, sp, listeners, updateSpotify=a.update_spotify, updateDuration=a.update_duration)
-            if a.write:
-                chart.writeChart(sheet,listeners)
-                sheet.freeze_panes = sheet['C2']
+            if sheet.title not in chartLib.keys():
+                log.error("Sheet %s was not found in chartlib", sheet.title)
+            elif not chartLib[sheet.title].isRejectChart: #reject charts come from getrejectchart instead
+                sheets.append(sheet)
+        charts = runCharts([(sheet.title, functools.partial(updateChart, sheet.title, sp, listeners, updateSpotify=a.update_spotify,
+                                                            updateDuration=a.update_duration, incremental=a.incremental, quiet=True)) for sheet in sheets])
+        #sheets whose chart didn't change are left alone, and the rest only get their changed cells rewritten
+        changed = 0
+        for sheet, chart in zip(sheets, charts):
+            if a.write and chart is not None:
+                if not a.full and not chart.isStale(sheet, listeners, a.filename[0]) and not a.new:
+                    log.info("Nothing on %s changed, leaving its sheet alone", chart.name)
+                    continue
+                chart.writeChart(sheet, listeners, a.full, a.filename[0], a.new[0] if a.new else None)
                 sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-                setColumnWidths(sheet)
+                changed += 1
+        log.info("Wrote %s of %s sheets", changed, len(sheets))
         if a.new:
-            wb.save(a.new[0])
-        else:
-            wb.save(a.filename[0])
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+            saveWorkbook(wb, a.new[0])
+        elif changed:
+            saveWorkbook(wb, a.filename[0])
+        libraries.save('albums', 'artists', 'charts')
     elif a.command == "readworkbook":
-        wb = load_workbook(a.filename[0])
+        wb = loadWorkbook(a.filename[0], True)
         listeners = a.listeners
         if not a.listeners:
             listeners = ['Listened?']
         for sheet in wb.worksheets:
-            readChart(sheet, sheet.title, listeners, a.overwrite)
-        saveAlbums(albumlibdir, albumLib)
-        saveCharts(chartlibdir, chartLib)
+            readChart(sheet, sheet.title, listeners, a.overwrite, readHyperlinks(a.filename[0], sheet.title))
+        wb.close()
+        libraries.save('albums', 'artists', 'charts')
+    elif a.command == 'migrate':
+        header = '| M I G R A T E |'
+        rems = (termsize - len(header)) // 3
+        headerPad = "~_~"*(rems//2)
+        header = headerPad + header + headerPad
+        print(header)
+        if not isSqlite(a.database[0]):
+            log.error("%s needs to end in one of %s", a.database[0], SQLITE_EXTS)
+            return -1
+        migrateLibraries(a.database[0], albumLib, chartLib)
+        with open('settings.ini', 'r') as file:
+            lines = file.readlines()
+        lines[4] = 'CHARTLIB={db}\n'.format(db=a.database[0])
+        lines[5] = 'ALBUMLIB={db}'.format(db=a.database[0]) + ('\n' if len(lines) > 6 else '')
+        with open('settings.ini', 'w') as file:
+            file.writelines(lines)
+        print("Moved {na} albums and {nc} charts into {db}. settings.ini now points at it".format(na=len(albumLib), nc=len(chartLib), db=a.database[0]))
+    elif a.command == 'export':
+        header = '| E X P O R T |'
+        rems = (termsize - len(header)) // 3
+        headerPad = "~_~"*(rems//2)
+        header = headerPad + header + headerPad
+        print(header)
+        if a.format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            log.error("Exporting to parquet needs pyarrow (pip install pyarrow)")
+            return -1
+        counts = exportLibrary(a.directory[0], a.format, a.incremental, a.chunk)
+        print("Exported {c} to {d}".format(c=', '.join("{n} {t}".format(n=n, t=table) for table, n in counts.items()), d=a.directory[0]))
+    elif a.command == 'analyze':
+        header = '| A N A L Y Z E |'
+        rems = (termsize - len(header)) // 3
+        headerPad = "~_~"*(rems//2)
+        header = headerPad + header + headerPad
+        print(header)
+        if importlib.util.find_spec('numpy') is None:
+            log.error("Analyzing charts needs NumPy (pip install numpy)")
+            return -1
+        results = analyzeCharts(a.charts, a.top)
+        for name, stats in results.items():
+            printChartStats(name, stats)
+        if a.json:
+            with open(a.json[0], 'w') as f:
+                json.dump(results, f, indent=2)
+    elif a.command == 'schedule':
+        header = '| S C H E D U L E |'
+        rems = (termsize - len(header)) // 3
+        headerPad = "~_~"*(rems//2)
+        header = headerPad + header + headerPad
+        print(header)
+        if importlib.util.find_spec('numpy') is None:
+            log.error("Scheduling needs NumPy (pip install numpy)")
+            return -1
+        listeners = a.listeners
+        if not a.listeners:
+            listeners = ['Listened?']
+        wb = None
+        if a.write and os.path.isfile(a.write[0]):
+            wb = loadWorkbook(a.write[0])
+        if a.chart:
+            names = a.chart
+        elif wb is not None:
+            names = [title for title in wb.sheetnames if title in chartLib.keys()]
+        else:
+            names = sorted(chartLib.keys())
+        for name in names:
+            if name not in chartLib.keys():
+                log.error("Could not find chart %s", name)
+        names = [name for name in names if name in chartLib.keys() and not chartLib[name].isRejectChart and chartLib[name].link]
+        plans = planRefresh(names, a.budget, a.min_change)
+        printPlan(plans, a.budget)
+        chosen = [plan['chart'] for plan in plans if plan['refresh']]
+        if chosen and not a.dry_run:
+            budget = RequestBudget(a.budget)
+            fetcher.budget = budget
+            try:
+                charts = runCharts([(name, functools.partial(budgetedUpdate, name, budget, sp, listeners, updateSpotify=False, updateDuration=False,
+                                                            incremental=True, quiet=True)) for name in chosen])
+            finally:
+                fetcher.budget = None
+            print("Sent {s} of {b} requests".format(s=budget.sent, b=a.budget))
+            if budget.skipped:
+                print("The budget ran out before {c}, left for next time".format(c=', '.join(sorted(budget.skipped))))
+            if a.write:
+                if wb is None:
+                    from openpyxl import Workbook
+                    wb = Workbook()
+                for chart in charts:
+                    if chart is None:
+                        continue
+                    sheet = wb[chart.name] if chart.name in wb.sheetnames else wb.create_sheet(chart.name)
+                    if chart.isStale(sheet, listeners, a.write[0]):
+                        chart.writeChart(sheet, listeners, filename=a.write[0])
+                        sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
+                saveWorkbook(wb, a.write[0])
+            libraries.save('albums', 'artists', 'charts')
     elif a.command == 'scancharts':
         header = '| S C A N  C H A R T S |'
         rems = (termsize - len(header)) // 3
@@ -1246,34 +3091,42 @@ def main():
         listeners = a.listeners
         if not a.listeners:
             listeners = ['Listened?']
-        if a.write:
-            if os.path.isfile(a.write[0]):
-                wb = load_workbook(a.write[0])
+        tasks = []
         with open(a.chartfile[0], 'r') as chartfile:
-            lines = chartfile.readlines()
-            for line in lines:
+            for line in chartfile.readlines():
+                if '::' not in line:
+                    continue
                 parsedline = line.split('::')
                 name = parsedline[0]
-                link = parsedline[1]
-                print("Now scanning: {s}".format(s=name))
-                chart = scanChart(name, link, sp, listeners, a.update_spotify, a.update_duration)
-                if a.write:
-                    if name not in wb.sheetnames:
-                        sheet = wb.create_sheet(name)
-                    else:
-                        sheet = wb[name]
-                    chart.writeChart(sheet, listeners)
-                    sheet.freeze_panes = sheet['C2']
-                    sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
-                    setColumnWidths(sheet)
-                saveAlbums(albumlibdir, albumLib)
-                saveCharts(chartlibdir, chartLib)
-                if a.write:
-                    if a.new:
-                        wb.save(a.new[0])
-                    else:
-                        wb.save(a.write[0])
-    sys.exit(0)
+                link = parsedline[1].strip()
+                tasks.append((name, functools.partial(scanChart, name, link, sp, listeners, a.update_spotify, a.update_duration, quiet=True, resume=a.resume)))
+        print("Now scanning: {s}".format(s=', '.join(name for name, task in tasks)))
+        charts = runCharts(tasks)
+        #everything is written once all the scans are done, in chart file order
+        if a.write:
+            if os.path.isfile(a.write[0]):
+                wb = loadWorkbook(a.write[0])
+            else:
+                from openpyxl import Workbook
+                wb = Workbook()
+            for chart in charts:
+                if chart is None:
+                    continue
+                if chart.name not in wb.sheetnames:
+                    sheet = wb.create_sheet(chart.name)
+                else:
+                    sheet = wb[chart.name]
+                chart.writeChart(sheet, listeners, filename=a.write[0], saveAs=a.new[0] if a.new else None)
+                sheet = setConditionalFormatting(sheet, chart.size, len(listeners), chart)
+        libraries.save('albums', 'artists', 'charts')
+        if a.write:
+            if a.new:
+                saveWorkbook(wb, a.new[0])
+            else:
+                saveWorkbook(wb, a.write[0])
+    if stageTimer is not None:
+        reportStages(a.command, a.profile)
+    return 0
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file